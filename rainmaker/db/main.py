@@ -1,11 +1,12 @@
 import os
 
-from sqlalchemy import create_engine, ForeignKey, UniqueConstraint, desc, event
+from sqlalchemy import create_engine, ForeignKey, UniqueConstraint, Index, desc, event, inspect
 from sqlalchemy import Column, Integer, Text, String, Binary, Boolean
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, backref, validates, sessionmaker, object_mapper
+from sqlalchemy.orm import relationship, backref, validates, sessionmaker, object_mapper, object_session
 from sqlalchemy.orm.attributes import get_history
 from sqlalchemy.pool import StaticPool
+from sqlalchemy.schema import CreateColumn
 
 import ujson
 
@@ -25,6 +26,7 @@ def init_db(location=':memory:', echo=False):
     DbConn = sessionmaker(bind=engine)
     Base.metadata.bind = engine
     Base.metadata.create_all()
+    migrate(engine)
 
     @contextmanager
     def yield_conn():
@@ -36,6 +38,98 @@ def init_db(location=':memory:', echo=False):
     DbConn.yield_conn = yield_conn
     return DbConn
 
+def new_session(db):
+    '''
+        Session of its own, sessions are not shared between threads
+        - db is the app's sessionmaker or a session bound to its engine
+    '''
+    if isinstance(db, sessionmaker):
+        return db()
+    return sessionmaker(bind=db.get_bind())()
+
+def migrate(engine):
+    '''
+        Bring existing databases up to date
+        - create_all only adds tables, add columns and indexes missing 
+          on old tables
+        - added columns must be nullable
+        - version logs are copied to file_versions, directory digests
+          are seeded for syncs that have none
+    '''
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        have = set(c['name'] for c in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in have:
+                engine.execute('ALTER TABLE %s ADD COLUMN %s' % (table.name,
+                    CreateColumn(column).compile(engine)))
+        have = set(i['name'] for i in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in have:
+                index.create(engine)
+    _backfill_file_versions(engine)
+    _seed_dir_digests(engine)
+
+# sync files read per batch while copying version logs
+backfill_batch = 1000
+
+def _backfill_file_versions(engine):
+    '''
+        Copy version logs of rows from before the file_versions table
+        - only rows with a log and no file_versions are copied
+        - get_version and the resolver read file_versions only
+    '''
+    session = sessionmaker(bind=engine)()
+    table = FileVersion.__table__
+    last_id = 0
+    try:
+        while True:
+            rows = session.execute('SELECT id, rel_path, ver_data FROM sync_files '
+                'WHERE id > :last_id AND ver_data IS NOT NULL AND NOT EXISTS '
+                '(SELECT 1 FROM file_versions WHERE sync_file_id = '
+                'sync_files.id) ORDER BY id LIMIT :limit', 
+                {'last_id': last_id, 'limit': backfill_batch}).fetchall()
+            if not rows:
+                break
+            now = utils.time_now()
+            versions = {}
+            for sync_file_id, rel_path, ver_data in rows:
+                ver_log = Versions(dict, data=ver_data, on_change=None,
+                    sort=lambda ver: ver.get('version') or 0)
+                for ver in ver_log:
+                    if ver.get('version') is None:
+                        continue
+                    ver = dict({k: ver.get(k) for k in FileVersion.ver_params},
+                        rel_path=ver.get('rel_path') or rel_path)
+                    # the newest entry wins if a version was logged twice
+                    versions[(sync_file_id, ver['version'])] = dict(ver,
+                        sync_file_id=sync_file_id, created_at=now, 
+                        updated_at=now)
+            if versions:
+                session.execute(table.insert(), list(versions.values()))
+            last_id = rows[-1][0]
+        session.commit()
+    finally:
+        session.close()
+
+def _seed_dir_digests(engine):
+    '''
+        Compute directory digests of syncs with files but no digests
+        - digests are kept as xor deltas, rows from before the digests 
+          table would be xor'ed onto zero
+    '''
+    from rainmaker.db import views
+    session = sessionmaker(bind=engine)()
+    try:
+        for sync_id, in session.execute('SELECT id FROM syncs WHERE '
+                'EXISTS (SELECT 1 FROM sync_files WHERE sync_id = syncs.id) '
+                'AND NOT EXISTS (SELECT 1 FROM dir_digests '
+                'WHERE sync_id = syncs.id)').fetchall():
+            views.rebuild_dir_digests(session, sync_id)
+        session.commit()
+    finally:
+        session.close()
+
 class RainBase(Base):
     '''Default class for tables '''
     __abstract__ = True
@@ -78,6 +172,8 @@ class Sync(RainBase):
     stime = Column(Integer, index=True, default=0)
     tox_primary_blob = Column(Binary)    
     tox_sync_blob = Column(Binary) 
+    # chunk hash algorithm agreed with all hosts, md5 while unset
+    hash_algo = Column(String(20))
 
     def rel_path(self, val):
         assert val.startswith(self.path)
@@ -91,9 +187,14 @@ class SyncFile(RainBase):
     """ Sync File """
     __table_args__= (
         UniqueConstraint('sync_id', 'rel_path'),    
+        # covers sync_diff joins
+        Index('ix_sync_files_diff', 'sync_id', 'rel_path', 'file_hash', 
+            'file_size', 'is_dir'),
+        # covers last changed lookups
+        Index('ix_sync_files_changed', 'sync_id', 'updated_at'),
     )
-    ver_params = ['rel_path', 'file_hash', 'file_size', 'does_exist', 'is_dir',
-            'version']
+    ver_params = ['id', 'rel_path', 'file_hash', 'file_size', 'does_exist',
+            'is_dir', 'version']
     __tablename__ = 'sync_files'
     id = Column(Integer, primary_key=True)
     # relative path
@@ -102,7 +203,7 @@ class SyncFile(RainBase):
     file_hash = Column(Integer, default=0)
     # file size
     file_size = Column(Integer, default=0)
-    # file part hashes
+    # file part hashes, packed binary (json in older rows)
     fparts = Column(Text)
     # time modified
     mtime = Column(Integer)
@@ -112,7 +213,7 @@ class SyncFile(RainBase):
     stime = Column(Integer, index=True, default=0)
     # time scan started
     stime_start = Column(Integer, index=True, default=0)
-    # json version data
+    # version log sent to hosts, one json entry per line
     ver_data = Column(Text)
     # file inode
     inode = Column(Integer)
@@ -158,8 +259,8 @@ class SyncFile(RainBase):
     __versions__ = None
 
     @property
-    def vers(self):
-        ''' read only copy of past versions '''
+    def ver_log(self):
+        ''' version log shared with hosts '''
         if self.__versions__ is None:
             versions = Versions(SyncFile, data=self.ver_data,
                             sort=lambda ver: ver.version,
@@ -167,15 +268,35 @@ class SyncFile(RainBase):
             versions.keys = self.ver_params    
             self.__versions__ = versions
         return self.__versions__
+
+    @property
+    def vers(self):
+        ''' read only copy of past versions '''
+        return self.versions
     
     # Debug setter
     @vers.setter
     def vers(self, val):
         self.ver_data = None
-        self.vers.clear()
+        self.ver_log.clear()
         for ver in val:
-            self.vers.add(ver)
-        self.ver_data = self.vers.dump()
+            self.ver_log.add(ver)
+        self.ver_data = self.ver_log.dump()
+        self.versions = [FileVersion.from_dict(ver) for ver in val]
+
+    def get_version(self, version):
+        '''
+            Past version by number
+            - primary key lookup unless versions are already loaded
+        '''
+        session = object_session(self)
+        if 'versions' in self.__dict__ or session is None or self.id is None:
+            for ver in self.versions:
+                if ver.version == version:
+                    return ver
+            return None
+        with session.no_autoflush:
+            return session.query(FileVersion).get((self.id, version))
     
 
     __file_parts__ = None
@@ -188,6 +309,92 @@ class SyncFile(RainBase):
             self.__file_parts__ = FileParts(data=self.fparts, on_change=_on_change)
         return self.__file_parts__
 
+class FileVersion(RainBase):
+    ''' Past version of a sync file '''
+    __tablename__ = 'file_versions'
+    __table_args__= (
+        Index('ix_file_versions_rel_path_hash', 'rel_path', 'file_hash'),
+    )
+    ver_params = ['rel_path', 'file_hash', 'file_size', 'does_exist',
+            'is_dir', 'version']
+
+    sync_file_id = Column(Integer, ForeignKey("sync_files.id"), 
+            primary_key=True)
+    version = Column(Integer, primary_key=True, autoincrement=False)
+    rel_path = Column(Text, nullable=False)
+    file_hash = Column(Integer, default=0)
+    file_size = Column(Integer, default=0)
+    does_exist = Column(Boolean)
+    is_dir = Column(Boolean)
+
+    sync_file = relationship('SyncFile', backref=backref('versions', 
+        order_by=version, cascade='all, delete-orphan'))
+
+    @property
+    def id(self):
+        ''' id of the versioned sync_file '''
+        return self.sync_file_id
+
+    @classmethod
+    def from_dict(klass, ver):
+        return klass(**{k: v for k, v in ver.items() if k in klass.ver_params})
+
+class SyncChange(RainBase):
+    ''' 
+        Append only journal of sync file changes 
+        - seq only grows, peers ask for changes after the last seq they saw
+    '''
+    __tablename__ = 'sync_changes'
+    __table_args__= (
+        Index('ix_sync_changes_seq', 'sync_id', 'seq'),
+        {'sqlite_autoincrement': True},
+    )
+    seq = Column(Integer, primary_key=True)
+    sync_id = Column(Integer, ForeignKey("syncs.id"), nullable=False)
+    sync_file_id = Column(Integer, ForeignKey("sync_files.id"), nullable=False)
+    version = Column(Integer, nullable=False)
+
+class DirDigest(RainBase):
+    '''
+        Digest of a sync directory
+        - digest xors entry digests of every file below the directory,
+          files_digest only those directly in it
+        - kept up to date by observers, peers compare and descend into
+          directories that differ
+    '''
+    __tablename__ = 'dir_digests'
+    __table_args__= (
+        Index('ix_dir_digests_parent', 'sync_id', 'parent', 'path'),
+    )
+    sync_id = Column(Integer, ForeignKey("syncs.id"), primary_key=True)
+    # '' is the sync root
+    path = Column(Text, primary_key=True)
+    # None for the sync root
+    parent = Column(Text)
+    digest = Column(Integer, default=0, nullable=False)
+    files_digest = Column(Integer, default=0, nullable=False)
+    file_count = Column(Integer, default=0, nullable=False)
+
+class ScanCheckpoint(RainBase):
+    '''
+        Directory state when it was last scanned
+        - mtime_ns and nlink change when entries or subdirs are added, 
+          removed or renamed, not when a file is written in place
+        - rows are written once a scan of the directory completed
+    '''
+    __tablename__ = 'scan_checkpoints'
+    sync_id = Column(Integer, ForeignKey("syncs.id"), primary_key=True)
+    # '' is the sync root
+    path = Column(Text, primary_key=True)
+    parent = Column(Text)
+    mtime_ns = Column(Integer, nullable=False)
+    nlink = Column(Integer, nullable=False)
+    scanned_at = Column(Integer, nullable=False)
+
+    def matches(self, st):
+        ''' directory stat result unchanged since scan? '''
+        return (self.mtime_ns, self.nlink) == (st.st_mtime_ns, st.st_nlink)
+
 class ToxServer(RainBase):
     __tablename__ = 'tox_servers'
     id = Column(Integer, primary_key=True)
@@ -208,6 +415,11 @@ class Host(RainBase):
     device_name = Column(String(50))
     version = Column(String(50))
     pubkey = Column(String(150), nullable=False)
+    # last sync_changes seq received from host
+    last_seq = Column(Integer, default=0)
+    # comma separated chunk hash algorithms from the handshake, 
+    # unset for hosts that only know md5
+    hash_algos = Column(Text)
     
     # fk 
     sync_id = Column(Integer, ForeignKey("syncs.id"), index=True) 
@@ -220,6 +432,11 @@ class HostFile(RainBase):
     __tablename__ = 'host_files'
     __table_args__= (
         UniqueConstraint('host_id', 'rid'),    
+        # covers sync_diff joins
+        Index('ix_host_files_diff', 'host_id', 'rel_path', 'file_hash', 
+            'file_size', 'is_dir'),
+        # covers last changed lookups
+        Index('ix_host_files_changed', 'host_id', 'updated_at'),
     )
     __versions__ = None
  
@@ -233,12 +450,13 @@ class HostFile(RainBase):
     # must have default values for sync_join view to work
     rid = Column(Integer, nullable=False)
     rel_path = Column(Text, nullable=False, index=True)
+    # file part hashes, packed binary (json in older rows)
     fparts = Column(Text)
     file_hash = Column(Integer, default=0)
     file_size = Column(Integer, default=0)
     is_dir = Column(Boolean)
     does_exist = Column(Boolean)
-    # json version data
+    # version log, one json entry per line
     ver_data = Column(Text)
     version = Column(Integer, default=0, nullable=False)
     # sync_file_id of last comparison 
@@ -260,22 +478,23 @@ class HostFile(RainBase):
     @property
     def vers(self):
         ''' read only copy of past versions '''
-        if self.__versions__ is not None: 
-            return self.__versions__
-        if self.ver_data is None or len(self.ver_data) == 0:
-            return []
-        self.__versions__ = [HostFile(**ver) for ver in ujson.loads(self.ver_data)]
-        self.__versions__.sort(key=lambda ver: ver.version)        
+        if self.__versions__ is None:
+            self.__versions__ = Versions(HostFile, data=self.ver_data,
+                            sort=lambda ver: ver.version,
+                            on_change=None)
         return self.__versions__
     
     @vers.setter
     def vers(self, val):
         ''' Used for testing '''
-        self.ver_data = ujson.dumps(val)
-        versions = [HostFile(**ver) for ver in val]
-        for v in versions:
-            assert v.version is not None 
-        self.__versions__ = versions
+        for ver in val:
+            assert ver.get('version') is not None 
+        self.ver_data = None
+        self.__versions__ = None
+        self.vers.clear()
+        for ver in val:
+            self.vers.add(ver)
+        self.ver_data = self.vers.dump()
 
     __file_parts__ = None
     
@@ -311,13 +530,33 @@ class Download(RainBase):
     # download complete
     complete = Column(Boolean, default=False)
 
-    # file part hashes
+    # needed part hashes, packed binary (json in older rows)
     nparts = Column(Text)
 
     @property
     def incoming_path(self):
         return self.path + '.part'
 
+    @classmethod
+    def from_host_file(klass, host_file, **kwargs):
+        ''' New download of host_file, kwargs override attributes '''
+        dlo = klass()
+        dlo.update_from_host_file(host_file)
+        for k, v in kwargs.items():
+            setattr(dlo, k, v)
+        return dlo
+
+    def update_from_host_file(self, host_file):
+        ''' Copy file attributes and needed parts from host_file '''
+        self.sync_id = host_file.host.sync_id
+        self.rel_path = host_file.rel_path
+        self.file_hash = host_file.file_hash
+        self.file_size = host_file.file_size
+        self.is_dir = host_file.is_dir
+        self.complete = False
+        self.__needed_parts__ = NeededParts.from_file_parts(
+            host_file.file_parts)
+
     __needed_parts__ = None
     @property
     def needed_parts(self):
@@ -384,3 +623,6 @@ class Resolution(RainBase):
     state = Column(Integer, nullable=False)
     status = Column(Integer, nullable=False)
 
+
+# register save listeners, needs the models above
+from rainmaker.db import observers
@@ -1,5 +1,6 @@
 import ujson
 from sqlalchemy import event
+from sqlalchemy.orm.attributes import get_history
 
 
 '''
@@ -8,7 +9,20 @@ from sqlalchemy import event
     - Download created: start download
 '''
 
-from rainmaker.db.main import SyncFile, Download
+from rainmaker.db.main import SyncFile, FileVersion, SyncChange, Download
+from rainmaker.db import views
+
+versions = FileVersion.__table__
+changes = SyncChange.__table__
+
+# attributes that make a new version, scan bookkeeping such as
+# stime and mtime does not
+versioned = [key for key in SyncFile.ver_params 
+    if key not in ('id', 'version')] + ['fparts']
+
+def _is_new_version(target):
+    ''' any versioned attribute changed since load? '''
+    return any(get_history(target, key).has_changes() for key in versioned)
 
 #
 @event.listens_for(SyncFile, 'before_update')
@@ -16,13 +30,65 @@ from rainmaker.db.main import SyncFile, Download
 def _on_sync_file_save(mapper, connection, target):
     '''
         listen for save events
+        - past version is written to file_versions and the version log
+          when a versioned attribute changed
+        - versions past the log limit are dropped
     '''
-    if target.file_parts.changed:
+    # only touch serializers that were loaded
+    if target.__file_parts__ is not None and target.file_parts.changed:
         target.fparts = target.file_parts.dump()
-    if target.id is not None:
-        target.vers.add(target.before_changes())
+    if target.id is not None and _is_new_version(target):
+        was = target.before_changes()
+        target.ver_log.add(was)
         target.version += 1
-        target.ver_data = target.vers.dump()
+        target.ver_data = target.ver_log.dump()
+        ver = FileVersion.from_dict(was).to_dict(*FileVersion.ver_params)
+        connection.execute(versions.insert().values(
+            sync_file_id=target.id, **ver))
+        connection.execute(versions.delete().where(
+            (versions.c.sync_file_id == target.id) &
+            (versions.c.version <= was['version'] - target.ver_log.limit)))
+
+def _journal(connection, target):
+    connection.execute(changes.insert().values(sync_id=target.sync_id,
+        sync_file_id=target.id, version=target.version))
+
+@event.listens_for(SyncFile, 'after_insert')
+def _on_sync_file_saved(mapper, connection, target):
+    '''
+        journal new files
+        - runs after the row is written so new files have an id
+    '''
+    _journal(connection, target)
+
+@event.listens_for(SyncFile, 'after_update')
+def _on_sync_file_versioned(mapper, connection, target):
+    ''' journal updates that made a new version '''
+    if get_history(target, 'version').has_changes():
+        _journal(connection, target)
+
+@event.listens_for(SyncFile, 'after_insert')
+def _on_sync_file_added(mapper, connection, target):
+    ''' add file to its directory digests '''
+    views.update_dir_digests(connection, target.sync_id, 
+        [(target.rel_path, views.file_digest(target), 1)])
+
+@event.listens_for(SyncFile, 'after_update')
+def _on_sync_file_changed(mapper, connection, target):
+    ''' swap old entry for new in directory digests if they differ '''
+    was = target.before_changes()
+    old, new = views.file_digest(was), views.file_digest(target)
+    if old == new:
+        return
+    views.update_dir_digests(connection, target.sync_id, 
+        [(was['rel_path'], old, -1), (target.rel_path, new, 1)])
+
+@event.listens_for(SyncFile, 'after_delete')
+def _on_sync_file_deleted(mapper, connection, target):
+    ''' take file out of its directory digests '''
+    was = target.before_changes()
+    views.update_dir_digests(connection, target.sync_id, 
+        [(was['rel_path'], views.file_digest(was), -1)])
 
 # 
 @event.listens_for(Download, 'before_update')
@@ -31,9 +97,7 @@ def _on_download_save(mapper, connection, target):
     '''
         listen for save events
     '''
-    if target.file_parts.changed:
-        target.fparts = target.file_parts.dump()
-    if target.needed_parts.changed:
+    if target.__needed_parts__ is not None and target.needed_parts.changed:
         target.nparts = target.needed_parts.dump()
 
 
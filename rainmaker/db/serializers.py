@@ -1,6 +1,16 @@
 
+import array
+import operator
+import struct
+import sys
+
 import ujson
 
+from rainmaker import file_system
+
+# serialized arrays are little endian
+_swap = sys.byteorder != 'little'
+
 class Serializer(object):
     data = None
     _changed = False
@@ -92,23 +102,58 @@ class Serializer(object):
         self._changed = val 
 
 class Versions(Serializer):
+    '''
+        Append only log of past versions, oldest first
+        - one json entry per line, entries are only decoded when read
+        - capped at limit entries, oldest entries are dropped
+        - legacy json lists are converted on load
+    '''
+    limit = 50
     
-    def __init__(self, cls, data, sort, on_change):
+    def __init__(self, cls, data, sort, on_change, limit=None):
         self.keys = []          # Array of keys to dump from object
         self._objects = None
+        self._count = None
         self.cls = cls
         self.sort_f = sort
         self.on_change = on_change
+        if limit is not None:
+            self.limit = limit
         super().__init__(data)
-    
+
+    def load(self, data):
+        '''
+            Populate from log text or legacy json list
+        '''
+        self.changed = False
+        self._objects = None
+        self._count = None
+        data = data or ''
+        if data.startswith('['):
+            entries = sorted(ujson.loads(data), 
+                key=lambda kw: self.sort_f(self.cls(**kw)))
+            data = ''.join(ujson.dumps(kw) + '\n' for kw in entries)
+        self.data = data
+        self._trim()
+
+    def dump(self):
+        self.changed = False
+        return self.data or None
+
+    def __len__(self):
+        if self._count is None:
+            self._count = self.data.count('\n')
+        return self._count
+
     @property
     def objects(self):
         '''
             Load Array of objects
         '''
         if self._objects is None:
-            self._objects = [self.cls(**kwargs) for kwargs in self.data] if self.data else [] 
-            self._objects = sorted(self._objects, key=self.sort_f)
+            self._objects = [self.cls(**ujson.loads(line)) 
+                for line in self.data.splitlines()]
+            self._objects.sort(key=self.sort_f)
         return self._objects
     
     def __getitem__(self, i):
@@ -117,20 +162,49 @@ class Versions(Serializer):
         '''
         return self.objects[i]
 
+    def __iter__(self):
+        return iter(self.objects)
+
     def add(self, kwargs):
         '''
-            Add version to array
+            Append version to log, only keys are stored if set
         '''
         self.changed = True
-        self.objects.insert(0, self.cls(**kwargs))
-        self.data.insert(0, kwargs)
+        if self.keys:
+            kwargs = {k: v for k, v in kwargs.items() if k in self.keys}
+        self.data += ujson.dumps(kwargs) + '\n'
+        if self._count is not None:
+            self._count += 1
+        if self._objects is not None:
+            self._objects.append(self.cls(**kwargs))
+        self._trim()
+
+    def _trim(self):
+        '''
+            Drop oldest entries over limit
+        '''
+        extra = len(self) - self.limit
+        if extra <= 0:
+            return
+        pos = 0
+        for _ in range(extra):
+            pos = self.data.index('\n', pos) + 1
+        self.data = self.data[pos:]
+        self._count = self.limit
+        if self._objects is not None:
+            del self._objects[:extra]
 
     def clear(self):
         self.changed = True
         self._objects = None
-        self.data = []
+        self._count = None
+        self.data = ''
 
 class FilePiece():
+    '''
+        pmd5 holds the chunk hash of the parts algorithm
+    '''
+    __slots__ = ('pmd5', 'padler', 'poffset', 'plen')
     
     def __init__(self, pmd5, padler, poffset, plen):
         self.pmd5 = pmd5
@@ -141,7 +215,11 @@ class FilePiece():
     def dump(self):
         return [self.pmd5, self.padler, self.poffset, self.plen]
 
+    def __eq__(self, other):
+        return isinstance(other, FilePiece) and self.dump() == other.dump()
+
 class NeededPiece(FilePiece):
+    __slots__ = ('pdone',)
     
     def __init__(self, pmd5, padler, poffset, plen, pdone):
         self.pdone = pdone
@@ -150,7 +228,241 @@ class NeededPiece(FilePiece):
     def dump(self):
         return [self.pmd5, self.padler, self.poffset, self.plen, self.pdone]
 
-class FileParts(Serializer):
+def _typecode(size):
+    '''
+        array typecode for unsigned ints of size bytes
+    '''
+    for code in 'BHILQ':
+        if array.array(code).itemsize == size:
+            return code
+    raise TypeError('No %s byte array type' % size)
+
+class PieceArrays(object):
+    '''
+        Pieces stored as columns instead of objects
+        - parallel arrays of offsets, lengths and adlers
+        - digests packed back to back in a bytearray
+        - O(1) indexed access, pieces are only built when accessed
+    '''
+    # (attribute, typecode) of each column, in serialized order
+    COLUMNS = (('offsets', _typecode(8)), ('lens', _typecode(4)),
+        ('adlers', _typecode(4)))
+    def __init__(self, digest_size):
+        self.digest_size = digest_size
+        for name, code in self.COLUMNS:
+            setattr(self, name, array.array(code))
+        self.digests = bytearray()
+
+    @classmethod
+    def from_columns(klass, digest_size, data, count):
+        '''
+            Load count pieces from column data, returns pieces, bytes used
+        '''
+        pieces = klass(digest_size)
+        pos = 0
+        for name, code in klass.COLUMNS:
+            column = getattr(pieces, name)
+            end = pos + count*column.itemsize
+            column.frombytes(data[pos:end])
+            if len(column) != count:
+                raise ValueError('Truncated parts data')
+            if _swap:
+                column.byteswap()
+            pos = end
+        end = pos + count*digest_size
+        pieces.digests[:] = data[pos:end]
+        if len(pieces.digests) != count*digest_size:
+            raise ValueError('Truncated parts data')
+        return pieces, end
+
+    def copy(self):
+        pieces = PieceArrays(self.digest_size)
+        for name, _ in self.COLUMNS:
+            getattr(pieces, name).extend(getattr(self, name))
+        pieces.digests += self.digests
+        return pieces
+
+    def dump(self):
+        '''
+            Columns as little endian bytes
+        '''
+        out = []
+        for name, code in self.COLUMNS:
+            column = getattr(self, name)
+            if _swap:
+                column = array.array(code, column)
+                column.byteswap()
+            out.append(column.tobytes())
+        out.append(bytes(self.digests))
+        return b''.join(out)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __eq__(self, other):
+        return isinstance(other, PieceArrays) and \
+            self.digest_size == other.digest_size and \
+            self.offsets == other.offsets and self.lens == other.lens and \
+            self.adlers == other.adlers and self.digests == other.digests
+
+    def __getitem__(self, i):
+        i = self._index(i)
+        pos = i*self.digest_size
+        pmd5 = self.digests[pos:pos + self.digest_size].hex()
+        return FilePiece(pmd5, self.adlers[i], self.offsets[i], self.lens[i])
+
+    def adler(self, i):
+        '''
+            Adler of piece i, without building the piece
+        '''
+        return self.adlers[self._index(i)]
+
+    def append(self, pmd5, padler, poffset, plen):
+        digest = bytes.fromhex(pmd5)
+        if len(digest) != self.digest_size:
+            raise ValueError('Bad digest size: %s' % pmd5)
+        self.offsets.append(poffset)
+        self.lens.append(plen)
+        self.adlers.append(padler)
+        self.digests += digest
+
+    def truncate(self, pos):
+        '''
+            Drop pieces from pos onward
+        '''
+        for name, _ in self.COLUMNS:
+            del getattr(self, name)[pos:]
+        del self.digests[pos*self.digest_size:]
+
+    def _index(self, i):
+        '''
+            Normalize index i, negatives count from the end
+        '''
+        i = operator.index(i)
+        count = len(self)
+        if i < 0:
+            i += count
+        if i < 0 or i >= count:
+            raise IndexError('Part index out of range')
+        return i
+
+class Parts(Serializer):
+    '''
+        Base for chunk lists, serialized formats:
+        - v1: json list of pieces, chunks hashed with md5
+        - v2: {"v": 2, "algo": name, "parts": [pieces]}
+        - v4: binary, header + columns + subclass extra data
+        dump writes v4, dump_json writes v1/v2 for older peers
+    '''
+    FORMAT_VERSION = 2
+    BINARY_VERSION = 4
+
+    # magic, version, flags, digest size, algo name length
+    HEADER = struct.Struct('<4sBBBB')
+    COUNT = struct.Struct('<I')
+    MAGIC = b'RMPT'
+    FLAGS = 0
+
+    _algo = None
+
+    def load(self, data):
+        '''
+            Populate from binary blob or json string
+        '''
+        self.changed = False if data else True
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            self._load_binary(data)
+            return
+        data = ujson.loads(data) if data else []
+        if isinstance(data, dict):
+            algo, data = data['algo'], data['parts']
+        else:
+            algo = 'md5' if data else file_system.default_algo
+        self._reset(algo)
+        self._load_parts(data)
+
+    def dump(self):
+        '''
+            Dump as binary, mark self as not changed
+        '''
+        self.changed = False
+        algo = self.algo.encode()
+        return b''.join([
+            self.HEADER.pack(self.MAGIC, self.BINARY_VERSION, self.FLAGS,
+                self.data.digest_size, len(algo)),
+            algo,
+            self.COUNT.pack(len(self.data)),
+            self.data.dump(),
+            self._dump_extra()])
+
+    def dump_json(self):
+        '''
+            Dump as json, md5 parts use v1 for md5 only peers
+        '''
+        parts = [x.dump() for x in self]
+        if self.algo == 'md5':
+            return ujson.dumps(parts)
+        return ujson.dumps({'v': self.FORMAT_VERSION, 'algo': self.algo,
+            'parts': parts})
+
+    def _load_binary(self, data):
+        data = memoryview(data)
+        magic, version, flags, digest_size, alen = \
+            self.HEADER.unpack_from(data)
+        if magic != self.MAGIC or version != self.BINARY_VERSION:
+            raise ValueError('Unknown parts format')
+        pos = self.HEADER.size
+        algo = bytes(data[pos:pos + alen]).decode()
+        pos += alen
+        count, = self.COUNT.unpack_from(data, pos)
+        pos += self.COUNT.size
+        self._reset(algo)
+        if digest_size != self.data.digest_size:
+            raise ValueError('Bad digest size for %s' % algo)
+        self.data, used = PieceArrays.from_columns(digest_size, data[pos:],
+            count)
+        self._load_extra(data[pos + used:])
+
+    def _load_extra(self, data):
+        pass
+
+    def _dump_extra(self):
+        return b''
+
+    def _reset(self, algo):
+        '''
+            Empty packed storage for algo
+        '''
+        if algo not in file_system.hash_algos:
+            raise ValueError('Unknown hash algorithm: %s' % algo)
+        self._algo = algo
+        self.data = PieceArrays(file_system.digest_size(algo))
+
+    @property
+    def algo(self):
+        return self._algo
+
+    @algo.setter
+    def algo(self, algo):
+        '''
+            Change algorithm, only allowed while empty
+        '''
+        if len(self.data):
+            raise ValueError('Parts not empty')
+        self._reset(algo)
+
+    def clear(self):
+        '''
+            Wipe contents, new parts use the default algorithm
+        '''
+        self.changed = True
+        self._reset(file_system.default_algo)
+
+class FileParts(Parts):
     chunk_size = 2*10**5
 
     IDX_ADLER = 0
@@ -159,45 +471,54 @@ class FileParts(Serializer):
     def __init__(self, data=None, on_change=None):
         super().__init__(data, on_change)
  
-    def put(self, pmd5, padler, poffset, plen):
+    def put(self, pos, padler, pmd5, plen=None):
         '''
-            Put data for next part
+            Put data for part at pos, drops parts after pos
         '''
         self.changed = True
         if len(self.data) > pos:
-            self.data = self.data[:pos]
+            self.data.truncate(pos)
         elif len(self.data) < pos:
             raise IndexError('Position not ready')
-        fp = FilePiece(pmd5, padler, poffset, plen)
-        self.data.append([adler_v, md5_v])
-    
-    def _load(self, data):
+        plen = self.chunk_size if plen is None else plen
+        self.data.append(pmd5, padler, pos*self.chunk_size, plen)
+
+    def truncate(self, pos):
+        '''
+            Drop parts from pos onward
+        '''
+        if len(self.data) > pos:
+            self.changed = True
+            self.data.truncate(pos)
+
+    def _load_parts(self, data):
         for x in data:
-            self.data.append(FilePiece(*x))
+            self.data.append(*x)
 
     def get_adler(self, pos):
         if len(self.data) > pos:
-            return self.data[pos].padler
+            return self.data.adler(pos)
         return None
    
     def from_host_file(self, host_file):
         '''
             Import settings from host_file
         '''
-        self.load(host_file.file_parts.data)
-        self._complete = None
+        self.load(host_file.file_parts.dump())
 
-from rainmaker.file_system import hash_chunk
-
-class NeededParts(Serializer):
+class NeededParts(Parts):
     '''
         An Array of parts needed for download
+        - done flags are kept in a bitmap after the piece columns
     '''
     
     chunk_size = FileParts.chunk_size
+
+    FLAGS = 1
     
     _complete = None
     _num_incomplete = 0
+    _done = None
 
     @classmethod
     def from_file_parts(klass, file_parts):
@@ -205,10 +526,11 @@ class NeededParts(Serializer):
             Import settings from host_file
         '''
         nparts = klass()
-        data = file_parts.data
-        for args in data:
-            file_piece = NeededPiece(*args)
-            nparts._append(file_piece)
+        nparts.algo = file_parts.algo
+        nparts.data = file_parts.data.copy()
+        nparts._done = bytearray((len(nparts.data) + 7) >> 3)
+        nparts._num_incomplete = len(nparts.data)
+        nparts.changed = True
         return nparts
 
     def __init__(self, data=None, on_change=None):
@@ -219,27 +541,57 @@ class NeededParts(Serializer):
         '''
             Count number of incomplete chunks
         '''
-        if len(self.data) == 0:
-            return
-        self._num_incomplete = 0  
-        for fpiece in self.data:
-            if fpiece.pdone == False:
-                self._num_incomplete += 1  
-    
-    def _load(self, data):
+        done = sum(bin(b).count('1') for b in self._done)
+        self._num_incomplete = len(self.data) - done
+
+    def __getitem__(self, i):
+        if operator.index(i) < 0:
+            raise IndexError('Part index out of range')
+        fpiece = self.data[i]
+        return NeededPiece(*fpiece.dump(), self.is_done(i))
+
+    def get(self, pos):
+        if len(self.data) > pos:
+            return self[pos]
+        return None
+
+    def is_done(self, pos):
+        '''
+            Check done flag of part
+        '''
+        return bool(self._done[pos >> 3] & (1 << (pos & 7)))
+
+    def _set_done(self, pos):
+        self._done[pos >> 3] |= 1 << (pos & 7)
+
+    def _reset(self, algo):
+        super()._reset(algo)
+        self._done = bytearray()
+        self._num_incomplete = 0
+
+    def _load_parts(self, data):
         for args in data:
             self._append(*args)
-    
-    def _dump(self):
-        return [x.dump() for x in self.data]
 
-    def _append(self, *args):
+    def _load_extra(self, data):
+        self._done = bytearray(data[:(len(self.data) + 7) >> 3])
+        if len(self._done) < (len(self.data) + 7) >> 3:
+            raise ValueError('Truncated parts data')
+
+    def _dump_extra(self):
+        return bytes(self._done)
+
+    def _append(self, pmd5, padler, poffset, plen, pdone):
         '''
             Add needed chunk
         '''
-        fpiece = NeededPiece(*args)
-        self.data.append(fpiece)
-        if not fpiece.pdone:
+        pos = len(self.data)
+        self.data.append(pmd5, padler, poffset, plen)
+        if len(self._done) <= pos >> 3:
+            self._done.append(0)
+        if pdone:
+            self._set_done(pos)
+        else:
             self._num_incomplete += 1
         self.changed = True
 
@@ -249,7 +601,7 @@ class NeededParts(Serializer):
             - mark  as completed
         '''
         try:
-            fpiece = self.data[pos]
+            fpiece = self[pos]
         except IndexError as e:
             yield 'We don\'t need that part, index error.'
             return
@@ -262,14 +614,14 @@ class NeededParts(Serializer):
         if fpiece.plen != len(chunk):
             yield 'Part length mismatch'
             return
-        if hash_chunk(chunk) != fpiece.pmd5:
+        if file_system.hash_chunk(chunk, self.algo) != fpiece.pmd5:
             yield 'Part hash mismatch'
             return
 
         yield None
 
         # we only get this far if write went ok
-        self.data[pos].pdone = True
+        self._set_done(pos)
         self._num_incomplete -= 1
         self.changed = True
 
@@ -1,6 +1,13 @@
+import hashlib
+from collections import defaultdict
+
+import ujson
 from sqlalchemy import func
-from sqlalchemy.sql import text, update
-from rainmaker.db.main import SyncFile, HostFile
+from sqlalchemy.sql import text
+from rainmaker import utils, file_system
+from rainmaker.db.main import SyncFile, HostFile, Host, SyncChange, \
+    DirDigest
+from rainmaker.db.serializers import Versions
 
 q_sync_diff = """
     SELECT t1.*
@@ -28,33 +35,111 @@ def sync_diff(session, sync_id, host_id):
         params(t2_id=sync_id, t1_id=host_id).all()
     return (sync_files, host_files)
 
+q_sync_diff_page = q_sync_diff + """
+        AND (t1.rel_path, t1.id) > (:last_path, :last_id)
+    ORDER BY t1.rel_path, t1.id
+    LIMIT :limit
+"""
+
+q_diff_sync_page = q_sync_diff_page % {'t1':'sync', 't2':'host'} 
+q_diff_host_page = q_sync_diff_page % {'t1':'host', 't2':'sync'}
+
+def iter_sync_diff(session, sync_id, host_id, batch_size=500):
+    ''' 
+        Stream sync_diff results ordered by rel_path
+        - pages by (rel_path, id), batch_size rows held at a time
+        - safe to commit between rows, pending changes are not flushed
+    '''
+    def _iter(model, query, t1_id, t2_id):
+        last_path, last_id = '', 0
+        while True:
+            with session.no_autoflush:
+                rows = session.query(model).from_statement(text(query)).\
+                    params(t1_id=t1_id, t2_id=t2_id, last_path=last_path,
+                        last_id=last_id, limit=batch_size).all()
+            if rows:
+                last_path, last_id = rows[-1].rel_path, rows[-1].id
+            for row in rows:
+                yield row
+            if len(rows) < batch_size:
+                return
+    return (_iter(SyncFile, q_diff_sync_page, sync_id, host_id),
+        _iter(HostFile, q_diff_host_page, host_id, sync_id))
+
 q_match_sync = """
-    SELECT 
-        t1.id,
-        t2.id AS cmp_id, 
-        t2.version AS cmp_ver
-    FROM host_files t1
-    LEFT JOIN sync_files t2
-        ON t1.rel_path = t2.rel_path
-        AND t1.file_hash = t2.file_hash 
-        AND t1.is_dir = t2.is_dir
-        AND t1.file_size = t2.file_size
-    WHERE t2.id IS NOT NULL
-        AND t1.host_id = :t1_id
-        AND t1.cmp_id IS NULL
-        AND t2.sync_id = :t2_id
+    UPDATE host_files
+    SET (cmp_id, cmp_ver) = (
+            SELECT t2.id, t2.version 
+            FROM sync_files t2
+            WHERE t2.sync_id = :t2_id
+                AND t2.rel_path = host_files.rel_path
+                AND t2.file_hash = host_files.file_hash 
+                AND t2.is_dir = host_files.is_dir
+                AND t2.file_size = host_files.file_size),
+        updated_at = :now
+    WHERE host_id = :t1_id
+        AND cmp_id IS NULL
+        AND EXISTS (
+            SELECT 1 
+            FROM sync_files t2
+            WHERE t2.sync_id = :t2_id
+                AND t2.rel_path = host_files.rel_path
+                AND t2.file_hash = host_files.file_hash 
+                AND t2.is_dir = host_files.is_dir
+                AND t2.file_size = host_files.file_size)
 """
 
 def sync_match(session, sync_id, host_id):
-    ''' Match host files to sync files that are the same '''
+    ''' 
+        Match host files to sync files that are the same 
+        - one UPDATE, returns number of host files matched
+    '''
     engine = session.get_bind()
     conn = engine.connect()
-    with conn.begin():
-        host_files = engine.execute(q_match_sync, t2_id=sync_id, t1_id=host_id)
-        for hid, cmp_id, cmp_ver in host_files:
-            u = update(HostFile).where(HostFile.id==hid).values(cmp_id=cmp_id, cmp_ver=cmp_ver)
-            conn.execute(u)
+    try:
+        with conn.begin():
+            result = conn.execute(text(q_match_sync), t2_id=sync_id, 
+                t1_id=host_id, now=utils.time_now())
+            return result.rowcount
+    finally:
+        conn.close()
+
+
+host_file_columns = [c.name for c in HostFile.__table__.columns 
+    if c.name != 'id']
+
+q_upsert_host_files = """
+    INSERT INTO host_files (%(columns)s)
+    VALUES (%(values)s)
+    ON CONFLICT(host_id, rid) DO UPDATE SET %(updates)s %(where)s
+"""
 
+def upsert_host_files(session, host_id, files):
+    ''' 
+        Insert or update a page of host files by rid
+        - one statement per page, HostFile objects are not loaded
+        - files are dicts of host_file columns, other keys are ignored
+        - rows older than the stored version are skipped, pages may
+          arrive out of order
+    '''
+    now = utils.time_now()
+    pages = defaultdict(list)
+    for f in files:
+        row = {k: v for k, v in f.items() if k in host_file_columns}
+        row['host_id'] = host_id
+        row['created_at'] = now
+        row.setdefault('updated_at', now)
+        pages[tuple(sorted(row))].append(row)
+    for columns, rows in pages.items():
+        q = q_upsert_host_files % {
+            'columns': ', '.join(columns),
+            'values': ', '.join(':%s' % c for c in columns),
+            'updates': ', '.join('%s = excluded.%s' % (c, c) for c in columns
+                if c not in ('host_id', 'rid', 'created_at')),
+            'where': 'WHERE excluded.version >= host_files.version'
+                if 'version' in columns else ''}
+        session.execute(text(q), rows)
+    return len(files)
 
 def sync_last_changed(session, sync_id):
     sf = session.query(func.max(SyncFile.updated_at)).filter(
@@ -68,3 +153,334 @@ def host_last_changed(session, host_id):
     hf = hf if hf else 0
     return hf
 
+
+def sync_last_seq(session, sync_id):
+    seq = session.query(func.max(SyncChange.seq)).filter(
+        SyncChange.sync_id == sync_id).scalar()
+    seq = seq if seq else 0
+    return seq
+
+def sync_changes(session, sync_id, seq, limit=500, until=None):
+    '''
+        Sync files changed after journal seq
+        - range read on ix_sync_changes_seq, limit journal entries per call
+        - returns (files, last seq read), resume with the returned seq
+    '''
+    q = session.query(SyncChange.seq, SyncChange.sync_file_id).filter(
+        SyncChange.sync_id == sync_id, SyncChange.seq > seq)
+    if until is not None:
+        q = q.filter(SyncChange.seq <= until)
+    rows = q.order_by(SyncChange.seq).limit(limit).all()
+    if not rows:
+        return [], seq
+    ids = set(r.sync_file_id for r in rows)
+    files = session.query(SyncFile).filter(SyncFile.id.in_(ids)).order_by(
+        SyncFile.id).all()
+    return files, rows[-1].seq
+
+def update_hash_algo(session, sync):
+    '''
+        Agree on the chunk hash algorithm with every host of sync
+    '''
+    sync.hash_algo = file_system.negotiate_algo([
+        host.hash_algos.split(',') if host.hash_algos else None 
+        for host in sync.hosts])
+    session.add(sync)
+    return sync.hash_algo
+
+def put_host_hash_algos(session, sync_id, pubkey, algos):
+    '''
+        Record algorithms a host advertised in the handshake
+        - returns the sync's algorithm, None for unknown hosts
+    '''
+    host = session.query(Host).filter(Host.sync_id == sync_id,
+        Host.pubkey == pubkey).first()
+    if host is None:
+        return None
+    host.hash_algos = ','.join(algos) if algos else None
+    session.add(host)
+    algo = update_hash_algo(session, host.sync)
+    session.commit()
+    return algo
+
+# digests stay below 2**63 to fit sqlite integers
+digest_mask = (1 << 63) - 1
+dir_sep = '/'
+
+def entry_digest(rel_path, file_hash, file_size, is_dir, does_exist):
+    ''' Digest of one sync file, xor'd into its directories '''
+    key = ujson.dumps([rel_path, file_hash, file_size, bool(is_dir),
+        bool(does_exist)])
+    h = hashlib.blake2b(key.encode(), digest_size=8).digest()
+    return int.from_bytes(h, 'little') & digest_mask
+
+def file_digest(f):
+    ''' entry_digest of a sync file, host file or dict of either '''
+    if isinstance(f, dict):
+        return entry_digest(f['rel_path'], f['file_hash'], f['file_size'],
+            f['is_dir'], f['does_exist'])
+    return entry_digest(f.rel_path, f.file_hash, f.file_size, f.is_dir,
+        f.does_exist)
+
+def dir_parents(rel_path):
+    ''' Directories holding rel_path, nearest first: a/b/c -> a/b, a, '' '''
+    parts = rel_path.split(dir_sep)[:-1]
+    return [dir_sep.join(parts[:i]) for i in range(len(parts), -1, -1)]
+
+def dir_parent(path):
+    ''' Parent of directory path, None for the root '''
+    if path == '':
+        return None
+    return path.rpartition(dir_sep)[0]
+
+q_update_dir_digests = """
+    INSERT INTO dir_digests (sync_id, path, parent, digest, files_digest,
+        file_count, created_at, updated_at)
+    VALUES (:sync_id, :path, :parent, :digest, :files_digest, :file_count,
+        :now, :now)
+    ON CONFLICT(sync_id, path) DO UPDATE SET
+        digest = (digest | excluded.digest) - (digest & excluded.digest),
+        files_digest = (files_digest | excluded.files_digest)
+            - (files_digest & excluded.files_digest),
+        file_count = file_count + excluded.file_count,
+        updated_at = excluded.updated_at
+"""
+
+q_drop_dir_digests = """
+    DELETE FROM dir_digests
+    WHERE sync_id = :sync_id AND path = :path AND file_count <= 0
+"""
+
+def update_dir_digests(conn, sync_id, entries):
+    '''
+        Xor entries into the digests of their directories
+        - entries are (rel_path, digest, count), count 1 adds a file and
+          -1 removes it, xor'ing the same digest again takes it out
+        - sqlite has no xor, (a | b) - (a & b) is used instead
+        - conn is a connection or session
+    '''
+    deltas = defaultdict(lambda: [0, 0, 0])
+    for rel_path, digest, count in entries:
+        for i, path in enumerate(dir_parents(rel_path)):
+            d = deltas[path]
+            d[0] ^= digest
+            if i == 0:
+                d[1] ^= digest
+            d[2] += count
+    now = utils.time_now()
+    rows = [dict(sync_id=sync_id, path=path, parent=dir_parent(path),
+        digest=d, files_digest=fd, file_count=c, now=now)
+        for path, (d, fd, c) in deltas.items() if d or fd or c]
+    if not rows:
+        return
+    conn.execute(text(q_update_dir_digests), rows)
+    dropped = [dict(sync_id=sync_id, path=r['path']) for r in rows
+        if r['file_count'] < 0]
+    if dropped:
+        conn.execute(text(q_drop_dir_digests), dropped)
+
+def rebuild_dir_digests(session, sync_id):
+    ''' Recompute all directory digests of sync, eg. for older databases '''
+    session.query(DirDigest).filter(DirDigest.sync_id == sync_id).delete()
+    q = session.query(SyncFile.rel_path, SyncFile.file_hash, 
+        SyncFile.file_size, SyncFile.is_dir, SyncFile.does_exist).filter(
+        SyncFile.sync_id == sync_id)
+    update_dir_digests(session, sync_id, 
+        ((f.rel_path, file_digest(f), 1) for f in q.yield_per(1000)))
+
+def _in_chunks(q, column, values, size=500):
+    values = list(values)
+    for i in range(0, len(values), size):
+        for row in q.filter(column.in_(values[i:i + size])):
+            yield row
+
+def get_dir_digests(session, sync_id, paths):
+    ''' {path: DirDigest} of directories in paths that have files '''
+    q = session.query(DirDigest).filter(DirDigest.sync_id == sync_id)
+    return {d.path: d for d in _in_chunks(q, DirDigest.path, paths)}
+
+def child_dir_digests(session, sync_id, paths):
+    ''' {path: {child path: digest}} of child directories of paths '''
+    children = {path: {} for path in paths}
+    q = session.query(DirDigest.parent, DirDigest.path, 
+        DirDigest.digest).filter(DirDigest.sync_id == sync_id)
+    for parent, path, digest in _in_chunks(q, DirDigest.parent, paths):
+        children[parent][path] = digest
+    return children
+
+def dir_files(session, sync_id, path):
+    ''' Sync files directly in directory path '''
+    prefix = path + dir_sep if path else ''
+    q = session.query(SyncFile).filter(SyncFile.sync_id == sync_id)
+    if prefix:
+        # range read on rel_path, chr(ord('/') + 1) ends the prefix
+        q = q.filter(SyncFile.rel_path > prefix, 
+            SyncFile.rel_path < path + chr(ord(dir_sep) + 1))
+    return q.filter(func.instr(func.substr(SyncFile.rel_path, 
+        len(prefix) + 1), dir_sep) == 0).order_by(SyncFile.rel_path).all()
+
+def compare_dirs(session, sync_id, dirs, attrs):
+    '''
+        Directory digests for a peer
+        - dirs maps path to the peer's files_digest of that directory
+        - returns digests and child digests of each directory, and its
+          files as dicts of attrs when files_digest differs
+    '''
+    digests = get_dir_digests(session, sync_id, dirs)
+    children = child_dir_digests(session, sync_id, dirs)
+    result = []
+    for path, peer_files_digest in dirs.items():
+        d = digests.get(path)
+        digest, files_digest = (d.digest, d.files_digest) if d else (0, 0)
+        sync_files = []
+        if files_digest != peer_files_digest:
+            sync_files = [f.to_dict(*attrs) 
+                for f in dir_files(session, sync_id, path)]
+        result.append({'path': path, 'digest': digest, 
+            'files_digest': files_digest, 'children': children[path], 
+            'sync_files': sync_files})
+    return result
+
+# sync file rows at path and below it, a range read on ix_sync_files_diff
+q_subtree = """
+    sync_id = :sync_id AND (rel_path = :path 
+        OR (rel_path > :path || :sep AND rel_path < :path || :sep_end))
+"""
+
+q_subtree_versions = """
+    INSERT INTO file_versions (sync_file_id, version, rel_path, file_hash,
+        file_size, does_exist, is_dir, created_at, updated_at)
+    SELECT id, version, rel_path, file_hash, file_size, does_exist, is_dir,
+        :now, :now
+    FROM sync_files WHERE %(where)s
+"""
+
+q_subtree_update = """
+    UPDATE sync_files SET %(set)s,
+        ver_data = CASE WHEN substr(ver_data, 1, 1) = '[' 
+            -- legacy json list, convert to the log as Versions.load does
+            THEN COALESCE((SELECT group_concat(value, char(10)) || char(10)
+                FROM (SELECT value FROM json_each(sync_files.ver_data) 
+                    ORDER BY json_extract(value, '$.version'))), '')
+            ELSE COALESCE(ver_data, '') END || json_object('id', id, 
+            'rel_path', rel_path, 'file_hash', file_hash, 
+            'file_size', file_size, 
+            'does_exist', json(CASE WHEN does_exist THEN 'true' ELSE 'false' END),
+            'is_dir', json(CASE WHEN is_dir THEN 'true' ELSE 'false' END), 
+            'version', version) || char(10),
+        version = version + 1,
+        updated_at = :now
+    WHERE %(where)s
+"""
+
+# drop the oldest log entry of rows over Versions.limit, as Versions.add
+q_subtree_trim_log = """
+    UPDATE sync_files 
+    SET ver_data = substr(ver_data, instr(ver_data, char(10)) + 1)
+    WHERE %(where)s 
+        AND length(ver_data) - length(replace(ver_data, char(10), '')) 
+            > :limit
+"""
+
+# version was bumped by q_subtree_update, keep :limit rows as the
+# observers do
+q_subtree_trim_versions = """
+    DELETE FROM file_versions
+    WHERE sync_file_id IN (SELECT id FROM sync_files WHERE %(where)s)
+        AND version <= (SELECT s.version - 1 - :limit FROM sync_files s 
+            WHERE s.id = file_versions.sync_file_id)
+"""
+
+q_subtree_journal = """
+    INSERT INTO sync_changes (sync_id, sync_file_id, version, created_at,
+        updated_at)
+    SELECT sync_id, id, version, :now, :now
+    FROM sync_files WHERE %(where)s ORDER BY rel_path
+"""
+
+# rows per statement in subtree updates
+subtree_batch = 5000
+
+def _subtree_params(sync_id, path, **kwargs):
+    return dict(kwargs, sync_id=sync_id, path=path, sep=dir_sep,
+        sep_end=chr(ord(dir_sep) + 1), now=utils.time_now(),
+        limit=Versions.limit)
+
+def _update_files(session, params, where, set):
+    '''
+        Change rows matching where in a few set based statements
+        - keeps what observers do for each file: a version row, the 
+          version log capped at Versions.limit, version + 1, the journal 
+          and directory digests
+        - rows are selected once, each step runs on their ids
+        - returns (id, rel_path, file_hash, file_size, is_dir, does_exist) 
+          of rows before the change, in rel_path order
+    '''
+    rows = session.execute(text('SELECT id, rel_path, file_hash, file_size, '
+        'is_dir, does_exist FROM sync_files WHERE %s ORDER BY rel_path' 
+        % where), params).fetchall()
+    for pos in range(0, len(rows), subtree_batch):
+        # ids are integers read above, safe to inline past sqlite's 
+        # parameter limit
+        ids = 'id IN (%s)' % ','.join(str(int(r.id)) 
+            for r in rows[pos:pos + subtree_batch])
+        session.execute(text(q_subtree_versions % {'where': ids}), params)
+        session.execute(text(q_subtree_update % {'where': ids, 'set': set}),
+            params)
+        while session.execute(text(q_subtree_trim_log % {'where': ids}),
+                params).rowcount:
+            pass
+        session.execute(text(q_subtree_trim_versions % {'where': ids}), 
+            params)
+        session.execute(text(q_subtree_journal % {'where': ids}), params)
+    return rows
+
+def move_subtree(session, sync_id, path, dest):
+    '''
+        Rename directory path and everything below it to dest
+        - one statement per step over a rel_path range, rows are not loaded
+        - returns number of rows moved, None if dest is in use
+        - flush first, loaded SyncFiles are stale afterwards
+    '''
+    params = _subtree_params(sync_id, path, dest=dest)
+    taken = session.execute(text('SELECT 1 FROM sync_files WHERE %s LIMIT 1'
+        % q_subtree), dict(params, path=dest)).first()
+    if taken:
+        return None
+    rows = _update_files(session, params, q_subtree, 
+        'rel_path = :dest || substr(rel_path, length(:path) + 1)')
+    entries = []
+    for r in rows:
+        new_path = dest + r.rel_path[len(path):]
+        entries.append((r.rel_path, file_digest(r), -1))
+        entries.append((new_path, entry_digest(new_path, r.file_hash, 
+            r.file_size, r.is_dir, r.does_exist), 1))
+    update_dir_digests(session, sync_id, entries)
+    return len(rows)
+
+def delete_subtree(session, sync_id, path):
+    '''
+        Mark directory path and everything below it as deleted
+        - same as move_subtree, returns number of rows marked
+    '''
+    return _mark_deleted(session, q_subtree, _subtree_params(sync_id, path))
+
+def delete_unscanned(session, sync_id, stime_start):
+    '''
+        Mark files a scan started at stime_start did not reach as deleted
+        - same as delete_subtree, returns number of rows marked
+    '''
+    return _mark_deleted(session, 
+        'sync_id = :sync_id AND stime_start < :stime_start', 
+        _subtree_params(sync_id, None, stime_start=stime_start))
+
+def _mark_deleted(session, where, params):
+    rows = _update_files(session, params, where + ' AND does_exist', 
+        'does_exist = 0')
+    entries = []
+    for r in rows:
+        entries.append((r.rel_path, file_digest(r), -1))
+        entries.append((r.rel_path, entry_digest(r.rel_path, r.file_hash,
+            r.file_size, r.is_dir, False), 1))
+    update_dir_digests(session, params['sync_id'], entries)
+    return len(rows)
@@ -5,43 +5,337 @@ from .logger import create_log
 log = create_log(__name__)
 
 import hashlib
+import mmap
 import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Condition
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
 
 chunk_size = 200000
 
-def hash_chunk(chunk):
-    m = hashlib.md5()
-    m.update(chunk)
-    return m.hexdigest()
+# Files at least this large are hashed from an mmap
+mmap_threshold = 32*10**6
+
+# Hash pool defaults
+hash_workers = os.cpu_count() or 1
+hash_max_bytes = 64*chunk_size
+
+def _hexdigest(new):
+    def _hash(chunk):
+        return new(chunk).hexdigest()
+    return _hash
+
+# Chunk hash algorithms by name
+hash_algos = {
+    'md5': _hexdigest(hashlib.md5),
+    'sha1': _hexdigest(hashlib.sha1),
+    'blake2b': _hexdigest(lambda chunk: hashlib.blake2b(chunk, digest_size=16)),
+}
+if xxhash:
+    hash_algos['xxh128'] = _hexdigest(xxhash.xxh3_128)
 
-def hash_file(sync_file, offset=0, n=0):
-    ''' Full hash of file, make callback on each round '''
+# Algorithm for newly hashed files until every host of a sync agreed
+# on another one, parts keep the algorithm they were stored with
+default_algo = 'md5'
+# Algorithms offered to hosts, best first. xxh128 needs the optional
+# xxhash package, blake2b comes with hashlib.
+preferred_algos = (['xxh128'] if xxhash else []) + ['blake2b']
+
+def hash_chunk(chunk, algo='md5'):
+    return hash_algos[algo](chunk)
+
+def negotiate_algo(host_algos):
+    '''
+        Chunk hash algorithm for a sync
+        - host_algos has the algorithms each host advertised, None for
+          hosts that did not advertise any, they only know md5
+        - first of preferred_algos all hosts support, else default_algo
+    '''
+    if xxhash is None:
+        log.info('xxhash is not installed, xxh128 is not offered')
+    if not host_algos:
+        return default_algo
+    for algo in preferred_algos:
+        if all(algos and algo in algos for algos in host_algos):
+            return algo
+    return default_algo
+
+def sync_algo(sync_file):
+    '''
+        Algorithm new parts of sync_file are hashed with
+    '''
+    return getattr(sync_file.sync, 'hash_algo', None) or default_algo
+
+def digest_size(algo):
+    '''
+        Size in bytes of digests from algo
+    '''
+    return len(hash_chunk(b'', algo)) // 2
+
+def hash_file(sync_file, offset=0, n=0, use_mmap=None):
+    '''
+        Hash file from part offset, stop after n parts if n
+        - adler is a running value over the whole file
+        - parts are only updated when their adler changes
+        - use_mmap: hash from mmap, default is on for files
+          at least mmap_threshold bytes
+        Returns (adler, scan_len)
+    '''
     parts = sync_file.file_parts
     chunk_size = parts.chunk_size
-    adler = parts.get_adler(offset)
+    algo = sync_algo(sync_file)
+    if not offset and parts.algo != algo:
+        # full hash, move parts to current algorithm
+        parts.clear()
+        parts.algo = algo
+    adler = parts.get_adler(offset - 1) if offset else 1
+    scan_len = offset*chunk_size
+    count = 0
+    eof = True
     with open(sync_file.path, 'rb') as fh:
+        if use_mmap is None:
+            use_mmap = os.fstat(fh.fileno()).st_size >= mmap_threshold
+        chunks = _iter_chunks(fh, offset, chunk_size, use_mmap)
+        try:
+            # For every chunk
+            for data in chunks:
+                # force sign of adler to signed int
+                adler = zlib.adler32(data, adler) & 0xffffffff
+                # Is this the expected adler value?
+                if parts.get_adler(offset) != adler:
+                    # nope, calculate the chunk hash
+                    parts.put(offset, adler, hash_chunk(data, parts.algo),
+                        len(data))
+                # update part_offset
+                offset += 1
+                scan_len += len(data)
+                # break if we've hashed n parts
+                count += 1
+                if count == n:
+                    eof = False
+                    break
+        finally:
+            chunks.close()
+    if eof:
+        # drop parts past the end of file
+        parts.truncate(offset)
+    return (adler, scan_len)
+
+def rehash_file(sync_file):
+    '''
+        Incremental hash for files that were changed in place or
+        appended to
+        - the running adler of every stored full chunk is checked
+          against the file, adler32 is far cheaper than the chunk hash
+        - chunk hashes are redone from the first chunk that differs,
+          or from the first partial chunk if none do
+        - falls back to a full hash_file if the file did not grow
+        Returns (adler, scan_len, bytes_hashed)
+    '''
+    parts = sync_file.file_parts
+    chunk_size = parts.chunk_size
+    size = os.stat(sync_file.path).st_size
+    # stored full chunks, a trailing partial chunk is always rehashed
+    stored_size = sum(parts.data.lens)
+    prefix = stored_size // chunk_size
+    if prefix and stored_size < size:
+        offset = _verified_prefix(sync_file, prefix)
         if offset:
-            fh.seek(offset*chunk_size)
-        # For every chunk
+            adler, scan_len = hash_file(sync_file, offset=offset)
+            return (adler, scan_len, scan_len - offset*chunk_size)
+    adler, scan_len = hash_file(sync_file)
+    return (adler, scan_len, scan_len)
+
+def _verified_prefix(sync_file, prefix):
+    '''
+        Number of leading stored chunks, up to prefix, whose running 
+        adler still matches the file
+    '''
+    parts = sync_file.file_parts
+    adler = 1
+    with open(sync_file.path, 'rb') as fh:
+        chunks = _iter_chunks(fh, 0, parts.chunk_size)
+        try:
+            for pos, data in zip(range(prefix), chunks):
+                adler = zlib.adler32(data, adler) & 0xffffffff
+                if parts.get_adler(pos) != adler:
+                    return pos
+        finally:
+            chunks.close()
+    return prefix
+
+def _iter_chunks(fh, offset, chunk_size, use_mmap=False):
+    '''
+        Yield file chunks starting at part offset
+        - use_mmap: yield memoryview slices of an mmap instead of
+          reading a new bytes object per chunk, slices are released
+          once the caller moves on to the next chunk
+    '''
+    start = offset*chunk_size
+    size = os.fstat(fh.fileno()).st_size
+    if not use_mmap or start >= size:
+        fh.seek(start)
         while True:
-            # Get a chunk of file data
-            data = fh.read(offset*chunk_size)
+            data = fh.read(chunk_size)
             if not data:
-                break # End of file
-            # force sign of adler to signed int
-            adler = zlib.adler32(data, adler) & 0xffffffff
-            # Is this the expected adler value?
-            if parts.get_adler(offset) != adler:
-                # nope, calculate the md5
-                parts.put(offset, adler, hash_chunk(data))
-            # update part_offset
-            offset += 1
-            # break if we've reached zero
-            n += 1
-            if n == offset:
-                break
-    scan_len = chunk_size*offset + len(data)
-    return (adler, scan_len)
+                return # End of file
+            yield data
+    with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        view = memoryview(mm)
+        try:
+            for pos in range(start, len(mm), chunk_size):
+                chunk = view[pos:pos + chunk_size]
+                try:
+                    yield chunk
+                finally:
+                    chunk.release()
+        finally:
+            view.release()
+
+ADLER_BASE = 65521
+
+def adler32_combine(adler1, adler2, len2):
+    '''
+        Combine adler of data1 with adler of data2, giving adler
+        of data1 + data2 (port of zlib's adler32_combine)
+    '''
+    rem = len2 % ADLER_BASE
+    sum1 = adler1 & 0xffff
+    sum2 = (rem * sum1) % ADLER_BASE
+    sum1 += (adler2 & 0xffff) + ADLER_BASE - 1
+    sum2 += ((adler1 >> 16) & 0xffff) + ((adler2 >> 16) & 0xffff) + \
+        ADLER_BASE - rem
+    if sum1 >= ADLER_BASE:
+        sum1 -= ADLER_BASE
+    if sum1 >= ADLER_BASE:
+        sum1 -= ADLER_BASE
+    if sum2 >= (ADLER_BASE << 1):
+        sum2 -= (ADLER_BASE << 1)
+    if sum2 >= ADLER_BASE:
+        sum2 -= ADLER_BASE
+    return sum1 | (sum2 << 16)
+
+class HashPool(object):
+    '''
+        Hash many files and chunks concurrently
+        - chunks are read on the calling thread and hashed by workers,
+          zlib and hashlib release the GIL on large buffers
+        - bytes read but not yet hashed are capped at max_bytes
+        - parts are stored in order, results match hash_file
+    '''
+    def __init__(self, workers=hash_workers, max_bytes=hash_max_bytes):
+        self.workers = workers
+        self.max_bytes = max(max_bytes, chunk_size)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self._inflight = 0
+        self._cond = Condition()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+    def hash_file(self, sync_file):
+        '''
+            Hash a single file, returns (adler, scan_len)
+        '''
+        return self.hash_files([sync_file])[0]
+
+    def hash_files(self, sync_files):
+        '''
+            Hash files concurrently, returns list of (adler, scan_len)
+        '''
+        return [result for sync_file, result in self.map_files(sync_files)]
+
+    def map_files(self, sync_files):
+        '''
+            Hash files concurrently
+            - yields (sync_file, (adler, scan_len)) in order
+            - a file is yielded as soon as it and those before it are done
+        '''
+        pending = deque()
+        for sync_file in sync_files:
+            pending.append((sync_file, self._submit(sync_file)))
+            while pending and all(f.done() for f in pending[0][1]):
+                yield self._collect(*pending.popleft())
+        while pending:
+            yield self._collect(*pending.popleft())
+
+    def _submit(self, sync_file):
+        '''
+            Read file and queue chunks for hashing
+        '''
+        parts = sync_file.file_parts
+        algo = sync_algo(sync_file)
+        if parts.algo != algo:
+            parts.clear()
+            parts.algo = algo
+        size = parts.chunk_size
+        futures = []
+        with open(sync_file.path, 'rb') as fh:
+            while True:
+                self._reserve(size)
+                data = fh.read(size)
+                self._release(size - len(data))
+                if not data:
+                    break
+                futures.append(self.executor.submit(self._hash, data,
+                    parts.algo))
+        return futures
+
+    def _hash(self, data, algo):
+        '''
+            Hash single chunk, runs in worker
+        '''
+        try:
+            return (zlib.adler32(data) & 0xffffffff, hash_chunk(data, algo),
+                len(data))
+        finally:
+            self._release(len(data))
+
+    def _collect(self, sync_file, futures):
+        '''
+            Store hashed chunks in file parts
+        '''
+        parts = sync_file.file_parts
+        adler = 1
+        scan_len = 0
+        for pos, future in enumerate(futures):
+            cadler, digest, size = future.result()
+            adler = adler32_combine(adler, cadler, size)
+            if parts.get_adler(pos) != adler:
+                parts.put(pos, adler, digest, size)
+            scan_len += size
+        parts.truncate(len(futures))
+        return sync_file, (adler, scan_len)
+
+    def _reserve(self, size):
+        '''
+            Block until size bytes fit in the in flight budget
+        '''
+        with self._cond:
+            while self._inflight and self._inflight + size > self.max_bytes:
+                self._cond.wait()
+            self._inflight += size
+
+    def _release(self, size):
+        '''
+            Return bytes to the in flight budget
+        '''
+        if not size:
+            return
+        with self._cond:
+            self._inflight -= size
+            self._cond.notify_all()
 
 class FsActions(object):
     '''
@@ -74,4 +74,5 @@ class Application(object):
 from rainmaker import tasks
 Application.init = tasks.init
 Application.start = tasks.start
+Application.stop = tasks.stop
 Application.init_tox = tasks.init_tox
@@ -1,7 +1,15 @@
+import base64
+import binascii
+
+import ujson
+from sqlalchemy import tuple_
 from sqlalchemy.orm import subqueryload, joinedload
+from rainmaker.net.errors import EventError
+from rainmaker.net.msg_buffer import MAX_CHUNK
 from rainmaker.net.sessions import controller_requires_auth
-from rainmaker.db.main import Sync, SyncFile, Host, HostFile
+from rainmaker.db.main import Sync, SyncFile, Host, HostFile, new_session
 from rainmaker.db import views
+from rainmaker import file_system
 
 import rainmaker.logger
 log = rainmaker.logger.create_log(__name__)
@@ -22,6 +30,57 @@ def paginate(q, page, attrs=None, page_size=200):
     q=q.limit(page_size).offset(page_size*page)
     return [f.to_dict(*attrs) for f in q]
 
+# Keyset pages must fit in max_page_parts transport chunks
+page_size = 200
+max_page_size = 2000
+max_page_parts = 200
+max_page_bytes = max_page_parts * MAX_CHUNK
+# Journal pages are read with one IN query, keep under sqlite's 999 params
+max_changes_size = 500
+# directories compared per list_dir_digests request
+max_dir_paths = 100
+
+def encode_cursor(updated_at, id):
+    ''' Opaque cursor for position (updated_at, id) '''
+    pos = ('%d:%d' % (updated_at, id)).encode()
+    return base64.urlsafe_b64encode(pos).decode()
+
+def decode_cursor(cursor):
+    ''' Position (updated_at, id) of cursor, None for first page '''
+    if not cursor:
+        return None
+    try:
+        updated_at, id = base64.urlsafe_b64decode(cursor.encode()).split(b':')
+        return int(updated_at), int(id)
+    except (ValueError, TypeError, binascii.Error) as e:
+        raise EventError('Bad cursor: %s' % cursor) from e
+
+def paginate_keyset(q, model, cursor=None, attrs=None, size=page_size):
+    '''
+        Paginate results of query by (updated_at, id)
+        - size is capped at max_page_size rows and max_page_bytes
+        - returns rows, cursor of next page or None on last page
+    '''
+    if attrs is None:
+        attrs = []
+    size = max(1, min(int(size), max_page_size))
+    pos = decode_cursor(cursor)
+    if pos is not None:
+        q = q.filter(tuple_(model.updated_at, model.id) > pos)
+    q = q.order_by(model.updated_at, model.id).limit(size)
+    rows, last, used = [], None, 0
+    for f in q:
+        row = f.to_dict(*attrs)
+        used += len(ujson.dumps(row))
+        if rows and used > max_page_bytes:
+            break
+        rows.append(row)
+        last = f
+    else:
+        if len(rows) < size:
+            return rows, None
+    return rows, encode_cursor(last.updated_at, last.id)
+
 def tox_auth_controller(DbConn, tox):
     '''
         Manage authentication of tox friends
@@ -42,6 +101,22 @@ def tox_auth_controller(DbConn, tox):
         sessions.put(pk, 'host', host)
         return host
 
+    def _hash_algos(event):
+        ''' Chunk hash algorithms a peer sent, None from md5 only peers '''
+        return event.allow('hash_algos').val().get('hash_algos')
+
+    def _put_hash_algos(session):
+        '''
+            Store what an authenticated peer supports, the sync moves
+            off md5 once all its hosts support something better
+        '''
+        db = new_session(DbConn)
+        try:
+            views.put_host_hash_algos(db, sync_id, session.peer_addr,
+                session.hash_algos)
+        finally:
+            db.close()
+
     @actions.responds_to('add_primary')
     def _do_add_primary(event):
         if tox.primary.get_address() not in tox.get_friendlist():
@@ -65,6 +140,7 @@ def tox_auth_controller(DbConn, tox):
             session2 = sessions.get_session(addr=addr)
             assert session1 == session2
             peer_nonce = event.val('nonce')
+            session.hash_algos = _hash_algos(event)
             phash = session.get_hash(peer_nonce)
             
             if not session.authenticate(event.val('passwd_hash')):
@@ -82,17 +158,21 @@ def tox_auth_controller(DbConn, tox):
             if event.status != 'ok':
                 action_event.reply('handshake: self auth fail')
                 return
+            _put_hash_algos(session)
             action_event.reply('ok')
         addr=action_event.val('addr')
         session = sessions.get_session(addr=addr)
-        params = {'nonce': session.nonce}
+        params = {'nonce': session.nonce, 
+            'hash_algos': list(file_system.hash_algos)}
         tox.send('new_session', addr=addr, reply=_do_auth, data=params)
  
     @router.responds_to('new_session')
     def _cmd_new_session(event):
         session = sessions.get_session(fid=event.val('fid'))
+        session.hash_algos = _hash_algos(event)
         event.reply('ok', {'nonce': session.nonce, 
-            'passwd_hash': session.get_hash(event.val('nonce'))})
+            'passwd_hash': session.get_hash(event.val('nonce')),
+            'hash_algos': list(file_system.hash_algos)})
 
     @router.responds_to('create_session')
     def _cmd_create_session(event):
@@ -101,6 +181,7 @@ def tox_auth_controller(DbConn, tox):
         if not session.authenticate(event.val('passwd_hash')):
             event.reply('auth fail')
             return
+        _put_hash_algos(session)
         event.reply('ok')
     
 def utils_controller(DbConn, transport):
@@ -163,16 +244,48 @@ def sync_files_controller(DbConn, transport):
     
     @router.responds_to('list_sync_files')
     def _cmd_list_sync_files(event):
-        ''' Get many sync files '''
-        params = event.allow('page', 'since').val()
-        print('params', params)
+        ''' Get many sync files, follow cursor for next page '''
+        params = event.allow('cursor', 'since', 'page_size').val()
         since = int(params.get('since', 0))
-        page = int(params.get('page', 0))
         q = db.query(SyncFile).filter(
             SyncFile.sync_id == sync_id,
             SyncFile.updated_at >= since)
-        sync_files = paginate(q, page, attrs=file_params)
-        event.reply('ok', {'sync_files': sync_files})
+        sync_files, cursor = paginate_keyset(q, SyncFile, 
+            params.get('cursor'), attrs=file_params, 
+            size=params.get('page_size', page_size))
+        event.reply('ok', {'sync_files': sync_files, 'cursor': cursor})
+
+    @router.responds_to('get_last_seq')
+    def _cmd_get_last_seq(event):
+        last = views.sync_last_seq(db, sync_id)
+        event.reply('ok', {'last_seq': last})
+
+    @router.responds_to('list_changes')
+    def _cmd_list_changes(event):
+        ''' Get sync files changed after seq, follow seq for next page '''
+        params = event.allow('seq', 'until', 'page_size').val()
+        seq = int(params.get('seq', 0))
+        until = params.get('until')
+        until = int(until) if until is not None else None
+        size = max(1, min(int(params.get('page_size', page_size)), 
+            max_changes_size))
+        sync_files, seq = views.sync_changes(db, sync_id, seq, size, until)
+        event.reply('ok', {'sync_files': [f.to_dict(*file_params) 
+            for f in sync_files], 'seq': seq})
+
+    @router.responds_to('list_dir_digests')
+    def _cmd_list_dir_digests(event):
+        '''
+            Compare directories with peer
+            - dirs maps path to the peer's files_digest of that directory
+            - reply digest and child digests of each directory, and its 
+              files when files_digest differs
+        '''
+        dirs = event.allow('dirs').val().get('dirs') or {}
+        paths = list(dirs)[:max_dir_paths]
+        reply = views.compare_dirs(db, sync_id, 
+            {path: dirs[path] for path in paths}, file_params)
+        event.reply('ok', {'dirs': reply})
  
 @controller_requires_auth
 def file_parts_controller(DbConn, transport):
@@ -230,14 +343,14 @@ def hosts_controller(DbConn, transport):
     
     @router.responds_to('list_hosts')
     def _cmd_list_hosts(event):
-        params = event.allow('page', 'since').val()
+        params = event.allow('cursor', 'since', 'page_size').val()
         since = int(params.get('since', 0))
-        page = int(params.get('page', 0))
         q = db.query(Host).filter(
             Host.sync_id == sync_id,
             Host.updated_at >= since)
-        hosts = paginate(q, page)
-        event.reply('ok', {'hosts': hosts})
+        hosts, cursor = paginate_keyset(q, Host, params.get('cursor'),
+            size=params.get('page_size', page_size))
+        event.reply('ok', {'hosts': hosts, 'cursor': cursor})
 
 @controller_requires_auth
 def host_files_controller(DbConn, transport):
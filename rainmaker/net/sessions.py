@@ -103,6 +103,8 @@ class Session():
         self._phash = None
         self.valid = False
         self.nonce = rand_str(40)
+        # chunk hash algorithms the peer advertised
+        self.hash_algos = None
 
     def get_hash(self, peer_nonce):
         if len(str(peer_nonce)) < NONCE_LEN:
@@ -1,76 +1,179 @@
 from rainmaker.sync_manager import resolver 
-from rainmaker.db.views import host_last_changed
-from rainmaker.db.main import HostFile, file_params
+from rainmaker.db import views
+from rainmaker.db.views import upsert_host_files
+from rainmaker.db.main import file_params
 
-def sync_with_host(db, host, send):
+# journal entries requested per page, host may send fewer
+sync_page_size = 500
+# page requests kept outstanding
+sync_window = 4
+# directories compared per list_dir_digests request
+reconcile_batch = 100
+
+def sync_with_host(db, host, send, window=None):
     '''
         Sync With Host
+        - read the host's change journal after the last seq we stored
+        - the journal is split into seq ranges, window ranges are requested
+          at once and applied as replies arrive, in any order
+        - host.last_seq only moves over ranges that are all applied and is
+          committed with each page, so an interrupted sync resumes there
     '''
-    params = {'since': 0, 'page': 0, 'before': 0}
+    window = window or sync_window
+    state = {'next': 0, 'until': 0, 'outstanding': 0}
+    # range start -> seq read up to
+    done = {}
 
     def _start():
-        # find last change we have for host
-        htime = host_last_changed(db, host.id)
-        params['since'] = htime
-        send('get_last_changed', reply=_get_last_changed)
+        send('get_last_seq', reply=_get_last_seq)
 
-    def _get_last_changed(event):
+    def _get_last_seq(event):
         # Find last change host has
-        params['before'] = event.val('last_changed')
-        if params['since'] == params['before']:
+        last_seq = event.val('last_seq')
+        if last_seq < (host.last_seq or 0):
+            # host journal was reset, read all of it again
+            host.last_seq = state['next'] = 0
+            done.clear()
+        if host.last_seq == last_seq:
             # were done!
             return
-        send('list_sync_files', params, reply=_recv_files)
+        state['next'] = max(state['next'], host.last_seq or 0)
+        state['until'] = last_seq
+        _fill()
+
+    def _fill():
+        # keep window requests in flight
+        while state['outstanding'] < window and \
+                state['next'] < state['until']:
+            start = state['next']
+            end = min(start + sync_page_size, state['until'])
+            state['next'] = end
+            _request(start, end)
 
-    def _recv_files(event):
-        # get changes
+    def _request(start, end):
+        def _reply(event):
+            _recv_changes(start, end, event)
+        state['outstanding'] += 1
+        params = {'seq': start, 'until': end, 'page_size': sync_page_size}
+        send('list_changes', params, reply=_reply)
 
+    def _recv_changes(start, end, event):
+        state['outstanding'] -= 1
         # get array of params as array of dictionaries
         sf_params =  event.aget('sync_files').require(*file_params).val()
-         
-        if sf_params:
-            recv_sync_files(db, host, sf_params)
-            params['page'] += 1
-            send('list_sync_files', params, reply=_recv_files)
+        seq = event.val('seq')
+        if start < seq < end:
+            # host sent fewer, ask for the rest of the range
+            done[start] = seq
+            _request(seq, end)
+        else:
+            done[start] = end
+        was = last = host.last_seq or 0
+        while last in done:
+            last = done.pop(last)
+        host.last_seq = last
+        recv_sync_files(db, host, sf_params)
+        if was < state['until'] <= last:
+            send('get_last_seq', reply=_check_changed)
         else:
-            params['page'] = 0
-            send('get_last_changed', reply=_check_changed)
+            _fill()
             
     def _check_changed(event):
-        #
-        if params['before'] != event.val('last_changed'):
-            # start over again
-            _start()
+        if host.last_seq != event.val('last_seq'):
+            # host changed while we read, keep reading
+            _get_last_seq(event)
             return
-        # run resolver
-        resolutions = resolver.get_resolutions(db, host)
-        db.commit()
+        # run resolver, each chunk is saved and downloads planned
+        for resolutions in resolver.stream_resolutions(db, host):
+            pass
 
     _start()
 
+def reconcile_with_host(db, host, send, done=None):
+    '''
+        Find files that differ from host by comparing directory digests
+        - starts at the root and only descends into directories whose
+          digest differs, one round trip per directory level
+        - differing host files are stored like sync_with_host pages
+        - done is called with the sorted rel_paths that differ, 
+          directories only we have are reported without descending
+    '''
+    sync_id = host.sync_id
+    state = {'outstanding': 0}
+    differ = set()
+
+    def _request(paths):
+        local = views.get_dir_digests(db, sync_id, paths)
+        batches = [paths[i:i + reconcile_batch] 
+            for i in range(0, len(paths), reconcile_batch)]
+        state['outstanding'] += len(batches)
+        for batch in batches:
+            dirs = {p: local[p].files_digest if p in local else 0 
+                for p in batch}
+            send('list_dir_digests', {'dirs': dirs}, reply=_recv_dirs)
+
+    def _recv_files(path, sf_params):
+        ours = {f.rel_path: views.file_digest(f) 
+            for f in views.dir_files(db, sync_id, path)}
+        theirs = {f['rel_path']: views.file_digest(f) for f in sf_params}
+        changed = set(p for p in set(ours) | set(theirs) 
+            if ours.get(p) != theirs.get(p))
+        differ.update(changed)
+        sf_params = [f for f in sf_params if f['rel_path'] in changed]
+        if sf_params:
+            recv_sync_files(db, host, sf_params)
+
+    def _recv_dirs(event):
+        state['outstanding'] -= 1
+        paths = []
+        for d in event.val('dirs'):
+            path = d['path']
+            local = views.get_dir_digests(db, sync_id, [path]).get(path)
+            if (local.digest if local else 0) == d['digest']:
+                continue
+            if (local.files_digest if local else 0) != d['files_digest']:
+                _recv_files(path, d['sync_files'])
+            ours = views.child_dir_digests(db, sync_id, [path])[path]
+            theirs = d['children']
+            for child in set(ours) | set(theirs):
+                if child not in theirs:
+                    differ.add(child)
+                elif ours.get(child) != theirs[child]:
+                    paths.append(child)
+        if paths:
+            _request(sorted(paths))
+        elif not state['outstanding'] and done:
+            done(sorted(differ))
+
+    _request([''])
+
+def catch_up_with_host(db, host, send):
+    '''
+        Sync with a host we have no journal position for
+        - the host's last seq is read first, then the trees are 
+          reconciled by directory digests instead of reading the journal
+        - differing files are resolved, the seq is stored and
+          sync_with_host reads changes made meanwhile
+    '''
+    def _get_last_seq(event):
+        last_seq = event.val('last_seq')
+
+        def _reconciled(rel_paths):
+            if rel_paths:
+                for resolutions in resolver.stream_resolutions(db, host):
+                    pass
+            host.last_seq = last_seq
+            db.commit()
+            sync_with_host(db, host, send)
+
+        reconcile_with_host(db, host, send, _reconciled)
+
+    send('get_last_seq', reply=_get_last_seq)
+
 def recv_sync_files(db, host, params):
+    ''' Store a page of host sync files as host files, commit host '''
     # convert id to rid
-    # map array to dict of dicts
-    sdict = {}
     for p in params:
-        v = p.pop('id')
-        p['rid'] = v
-        p['host_id'] = host.id
-        sdict[v] = p
-    # find existing files
-    host_files = db.query(HostFile).filter(
-        HostFile.rid.in_(sdict.keys()),
-        HostFile.host_id == host.id).all()
-    # update
-    for hf in host_files:
-        attrs = sdict.pop(hf.rid)
-        hf.update(**attrs)
-        db.add(hf)
-    # create
-    for k, sf in sdict.items():
-        hf = HostFile(**sf)
-        host.host_files.append(hf)
-    # commit
-    db.add(host)
+        p['rid'] = p.pop('id')
+    upsert_host_files(db, host.id, params)
     db.commit()
-
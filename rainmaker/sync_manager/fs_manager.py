@@ -16,6 +16,9 @@ This file is part of Rainmaker.
 """
 #import sys
 import os
+import time
+import threading
+from collections import deque
 from queue import Queue, Empty  # python 3.x
 
 # Watchdog
@@ -23,94 +26,416 @@ from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
 
+from rainmaker.db import views
 from rainmaker.db.main import SyncFile
-from rainmaker.sync_manager.scan_manager import refresh_sync, scan_dir, scan_file
+from sqlalchemy import and_, or_
+
+from rainmaker.sync_manager.scan_manager import refresh_sync, scan_dir, \
+    scan_file, _walk, _stat_changed
 
 import rainmaker.logger
 log = rainmaker.logger.create_log(__name__)
 
 observer = None
 
-def SyncWatch(session, sync):
-    
+# seconds without events before pending changes are written
+debounce_window = 0.5
+# rows loaded per query when applying changes
+load_batch = 500
+# queued events or pending ops that write without waiting for quiet
+commit_trigger = 5000
+# seconds of arrivals averaged for events_per_sec
+rate_window = 5.0
+# seconds before retrying a failed commit, doubled per failure
+retry_delay = 0.5
+retry_max = 30.0
+
+def coalesce(pending, kind, path, dest=None, is_dir=False):
+    '''
+        Fold one event into pending ops keyed by current rel_path
+        - ops are create, modify, delete and move (from src)
+        - create and modifies become one create, create then delete 
+          cancels, delete then create is a modify
+        - move chains become one move from the first src, a move with 
+          changes is flagged modified
+        - rescan replaces anything pending for the directory
+    '''
+    op = pending.get(path)
+    if kind == 'rescan':
+        pending.pop(path, None)
+        pending[path] = {'op': 'rescan', 'is_dir': True}
+    elif kind == 'created':
+        if op and op['op'] == 'delete':
+            pending[path] = dict(op, op='modify', is_dir=is_dir)
+        else:
+            pending[path] = {'op': 'create', 'is_dir': is_dir}
+    elif kind == 'modified':
+        if is_dir:
+            # directory mtimes change with their entries
+            return pending
+        if op is None or op['op'] == 'delete':
+            pending[path] = {'op': 'modify', 'is_dir': is_dir}
+        elif op['op'] == 'move':
+            op['modified'] = True
+    elif kind == 'deleted':
+        if op and op['op'] == 'create':
+            del pending[path]
+        elif op and op['op'] == 'move':
+            del pending[path]
+            pending.setdefault(op['src'], {'op': 'delete', 'is_dir': is_dir})
+        else:
+            pending[path] = {'op': 'delete', 'is_dir': is_dir}
+    elif kind == 'moved':
+        op = pending.pop(path, None)
+        if op and op['op'] in ('create', 'delete'):
+            pending[dest] = dict(op, op='create', is_dir=is_dir)
+        elif op and op['op'] == 'move':
+            if op['src'] == dest:
+                # moved back
+                if op.get('modified'):
+                    pending[dest] = {'op': 'modify', 'is_dir': is_dir}
+            else:
+                pending[dest] = op
+        else:
+            pending[dest] = {'op': 'move', 'src': path, 'is_dir': is_dir,
+                'modified': bool(op)}
+    return pending
+
+def apply_pending(session, sync, pending):
+    '''
+        Write coalesced ops in one transaction
+        - rows for every path touched are loaded with one query per batch
+        - created, modified and moved with changes rows are marked for
+          rescan (stime_start 0), refresh_sync picks them up
+        - directory moves and deletes are range updates of the subtree,
+          moves of entries below a moved directory are already done
+        - a move onto an existing row is applied as a rescan of dest
+        - a directory rescan, eg. after an overflow, only marks entries
+          whose stat differs from their row
+    '''
+    paths = set(pending)
+    paths.update(op['src'] for op in pending.values() if op['op'] == 'move')
+    paths = list(paths)
+    index = {}
+    # (src, dest) of directories moved with their subtree
+    moved = []
+    state = {'stale': False}
+    with session.no_autoflush:
+        for i in range(0, len(paths), load_batch):
+            for sf in session.query(SyncFile).filter(
+                    SyncFile.sync_id == sync.id,
+                    SyncFile.rel_path.in_(paths[i:i + load_batch])):
+                index[sf.rel_path] = sf
+
+    def _get(path):
+        if path not in index and state['stale']:
+            index[path] = session.query(SyncFile).filter(
+                SyncFile.sync_id == sync.id,
+                SyncFile.rel_path == path).first()
+        return index.get(path)
+
+    def _subtree(func, *args):
+        # subtree statements skip the session, loaded rows are stale after
+        session.flush()
+        count = func(session, sync.id, *args)
+        session.expire_all()
+        index.clear()
+        state['stale'] = True
+        return count
+
+    def _implied(src, dest):
+        for a, b in moved:
+            if src.startswith(a + os.sep) and dest == b + src[len(a):]:
+                return True
+        return False
+
+    def _rescan(path, is_dir):
+        sync_file = _get(path)
+        if sync_file is None:
+            sync_file = SyncFile(sync_id=sync.id, rel_path=path)
+            index[path] = sync_file
+        sync_file.is_dir = is_dir
+        sync_file.does_exist = True
+        sync_file.stime_start = 0
+        session.add(sync_file)
+
+    def _delete(path, is_dir):
+        if is_dir:
+            _subtree(views.delete_subtree, path)
+            return
+        sync_file = _get(path)
+        if sync_file is not None:
+            sync_file.does_exist = False
+            session.add(sync_file)
+
+    def _rescan_tree(path):
+        # compare disk and rows below path, rows are loaded by range,
+        # only entries whose stat differs from their row are rescanned
+        root = os.path.join(sync.path, path) if path else sync.path
+        q = session.query(SyncFile).filter(SyncFile.sync_id == sync.id)
+        if path:
+            q = q.filter(or_(SyncFile.rel_path == path, and_(
+                SyncFile.rel_path > path + os.sep,
+                SyncFile.rel_path < path + chr(ord(os.sep) + 1))))
+        rows = {sf.rel_path: sf for sf in q}
+        index.update(rows)
+        seen = set([path]) if path else set()
+        for dirs, files in _walk(root):
+            for entry in dirs:
+                rel_path = sync.rel_path(os.path.abspath(entry.path))
+                seen.add(rel_path)
+                sync_file = rows.get(rel_path)
+                if not (sync_file and sync_file.is_dir and 
+                        sync_file.does_exist):
+                    _rescan(rel_path, True)
+            for entry in files:
+                rel_path = sync.rel_path(os.path.abspath(entry.path))
+                seen.add(rel_path)
+                sync_file = rows.get(rel_path)
+                if sync_file is None or _stat_changed(sync_file, 
+                        entry.stat()):
+                    _rescan(rel_path, False)
+        for rel_path, sync_file in rows.items():
+            if rel_path not in seen and sync_file.does_exist:
+                sync_file.does_exist = False
+                session.add(sync_file)
+
+    with session.no_autoflush:
+        for path, op in pending.items():
+            if op['op'] in ('create', 'modify'):
+                _rescan(path, op['is_dir'])
+            elif op['op'] == 'rescan':
+                _rescan_tree(path)
+            elif op['op'] == 'delete':
+                _delete(path, op['is_dir'])
+            elif op['op'] == 'move':
+                src = op['src']
+                if _implied(src, path):
+                    if op['modified']:
+                        _rescan(path, op['is_dir'])
+                    continue
+                sync_file = _get(src)
+                if sync_file is None or _get(path) or src in pending:
+                    # unknown src or something else lands on a path
+                    _rescan(path, op['is_dir'])
+                    if src not in pending:
+                        _delete(src, op['is_dir'])
+                    continue
+                if op['is_dir']:
+                    if _subtree(views.move_subtree, src, path) is None:
+                        # rows left below dest, rescan instead
+                        _rescan(path, True)
+                        _delete(src, True)
+                    else:
+                        moved.append((src, path))
+                    continue
+                del index[src]
+                sync_file.rel_path = path
+                sync_file._path = None
+                if op['modified']:
+                    sync_file.stime_start = 0
+                index[path] = sync_file
+                session.add(sync_file)
+    session.commit()
+
+class RescanEvent(object):
+    ''' Directory that may have missed events, eg. after an overflow '''
+    event_type = 'rescan'
+    is_directory = True
+
+    def __init__(self, src_path):
+        self.src_path = src_path
+
+def SyncWatch(session, sync, window=None, hash_pool=None, lazy=False):
+    '''
+        Watch sync for changes
+        - events are queued by the observer thread
+        - commit folds queued events into pending ops and writes them
+          once no events came in for window seconds
+        - start runs commit on a worker thread, the session then belongs
+          to the worker until stop
+        - hash_pool hashes changed files concurrently
+        - lazy only watches the root on backends that support it, feed 
+          the rest to watch_dirs, eg. from scan_sync_bulk's on_dirs
+    '''
+    window = debounce_window if window is None else window
     queue = Queue()
+    pending = {}
+    hooks = []
+    # arrival times for events_per_sec
+    arrivals = deque()
+    state = {'last_event': 0, 'pending_since': None, 'worker': None,
+        'failures': 0, 'retry_at': 0}
+    # rel_paths written but not refreshed yet
+    written = []
+    wake = threading.Event()
+    stopping = threading.Event()
+    prefix = sync.path + os.sep
 
     class EventHandler(FileSystemEventHandler):
         
         def dispatch(self, event):
             ''' store events for later '''
-            queue.put(event)
+            now = time.time()
+            state['last_event'] = now
+            arrivals.append(now)
+            queue.put((now, event))
+            if queue.qsize() >= commit_trigger:
+                wake.set()
             
-        def commit(self):
-            ''' run events '''
-            did_get = False
+        def commit(self, force=False):
+            ''' 
+                fold queued events, write them if quiet for window
+                - pending ops past commit_trigger are written anyway
+                - returns True if changes were written
+            '''
             while True:
                 try:
-                    # raise events
-                    event = queue.get_nowait()
-                    super(EventHandler, self).dispatch(event)
-                    did_get = True
+                    received, event = queue.get_nowait()
                 except Empty as e:
                     break
-            if did_get:
-                # refresh db if modifications occurred
-                session.commit()
-                refresh_sync(session, sync)
+                if state['pending_since'] is None:
+                    state['pending_since'] = received
+                self.on_any_event(event)
+            if not pending:
+                state['pending_since'] = None
+                if not written:
+                    return False
+            else:
+                quiet = time.time() - state['last_event'] >= window
+                if not (force or quiet or len(pending) >= commit_trigger):
+                    return False
+                log.info('applying %s coalesced changes' % len(pending))
+                apply_pending(session, sync, pending)
+                written.extend(pending)
+                pending.clear()
+                state['pending_since'] = None
+            # refresh db if modifications occurred
+            refresh_sync(session, sync, hash_pool)
+            paths = written[:]
+            del written[:]
+            for hook in hooks:
+                hook(paths)
+            return True
+
+        def rescan(self, path):
+            ''' queue a rescan of path and everything below it '''
+            self.dispatch(RescanEvent(path))
+
+        def watch_dirs(self, paths):
+            ''' add watches for directories, if the backend is lazy '''
+            if hasattr(observer, 'add_watches'):
+                observer.add_watches(paths)
+
+        def on_commit(self, func):
+            ''' call func with the rel_paths of each written batch '''
+            hooks.append(func)
+            return func
+
+        def stats(self):
+            '''
+                Backpressure metrics
+                - queue_depth: events not folded yet
+                - pending: coalesced ops not written yet
+                - oldest_age: seconds the oldest unwritten event waited
+                - events_per_sec: arrivals over the last rate_window
+                - failures: commits failed in a row, retried with backoff
+            '''
+            now = time.time()
+            while arrivals and arrivals[0] < now - rate_window:
+                arrivals.popleft()
+            oldest = state['pending_since']
+            with queue.mutex:
+                if queue.queue and oldest is None:
+                    oldest = queue.queue[0][0]
+            return {
+                'queue_depth': queue.qsize(),
+                'pending': len(pending),
+                'oldest_age': now - oldest if oldest is not None else 0,
+                'events_per_sec': len(arrivals) / rate_window,
+                'failures': state['failures']}
+
+        def start(self, interval=None):
+            ''' commit on a worker every interval or on commit_trigger '''
+            interval = window if interval is None else interval
+            stopping.clear()
+            worker = threading.Thread(target=self._work, args=(interval,))
+            worker.daemon = True
+            state['worker'] = worker
+            worker.start()
+            return worker
+
+        def stop(self):
+            ''' stop worker after writing what is left '''
+            stopping.set()
+            wake.set()
+            if state['worker'] is not None:
+                state['worker'].join()
+                state['worker'] = None
+
+        def _work(self, interval):
+            while not stopping.is_set():
+                wake.wait(interval)
+                wake.clear()
+                self._commit_safe()
+            self._commit_safe(force=True)
+
+        def _commit_safe(self, force=False):
+            '''
+                commit, keep changes on errors and retry with backoff
+                - apply_pending writes in one transaction, the rollback
+                  leaves pending ops valid to apply again
+            '''
+            if not force and time.time() < state['retry_at']:
+                return
+            try:
+                self.commit(force)
+                state['failures'] = 0
+            except Exception as e:
+                session.rollback()
+                state['failures'] += 1
+                delay = min(retry_max, 
+                    retry_delay * 2 ** (state['failures'] - 1))
+                state['retry_at'] = time.time() + delay
+                log.error('Unable to commit %s changes, retry in %.1fs: %s' 
+                    % (len(pending) + len(written), delay, e))
 
         """ File System Events """
-        def on_moved(self, event):
-            log.info('moved', event)
-            sync_path = session.query(SyncFile).filter(
-                SyncFile.is_dir     == event.is_directory,
-                SyncFile.rel_path   == sync.rel_path(event.src_path),
-                SyncFile.sync_id    == sync.id,
-                SyncFile.does_exist == True).first()
-            sync_path.rel_path = sync.rel_path(event.dest_path)
-            session.add(sync_path)
-        
-        def on_created(self, event):
-            log.info('created: %s' % event.src_path)
-            sync_file = SyncFile(
-                is_dir     = event.is_directory,
-                rel_path   = sync.rel_path(event.src_path),
-                sync_id    = sync.id,
-                does_exist = True)
-            session.add(sync_file)
-            
-        def on_deleted(self, event):
-            # find, mark deleted
-            log.info('deleted: %s' % event.src_path)
-            sync_path = session.query(SyncFile).filter(
-                SyncFile.is_dir     == event.is_directory,
-                SyncFile.rel_path   == sync.rel_path(event.src_path),
-                SyncFile.sync_id    == sync.id,
-                SyncFile.does_exist == True).update({'does_exist': False})
-            if event.is_directory:
-                flike = '%s%s%s' % (sync.rel_path(event.src_path), os.pathsep, '%')
-                sync_path = session.query(SyncFile).filter(
-                    SyncFile.is_dir     == event.is_directory,
-                    SyncFile.rel_path.like(flike),
-                    SyncFile.sync_id    == sync.id,
-                    SyncFile.does_exist == True).\
-                        update({'does_exist': False}, False)
-         
-        def on_modified(self, event):
-            # find, check stime_start and possibly scan
-            if not event.is_directory:
-                log.info('modified: %s' % event.src_path)
-                sync_path = session.query(SyncFile).filter(
-                    SyncFile.is_dir     == event.is_directory,
-                    SyncFile.rel_path   == sync.rel_path(event.src_path),
-                    SyncFile.sync_id    == sync.id,
-                    SyncFile.does_exist == True).update({'stime_start':0})
+        def on_any_event(self, event):
+            if event.event_type == 'rescan' and event.src_path == sync.path:
+                coalesce(pending, 'rescan', '')
+                return
+            if not event.src_path.startswith(prefix):
+                return
+            # watchdog sets dest_path to '' on events other than moved
+            dest = getattr(event, 'dest_path', None) or None
+            if dest is not None and not dest.startswith(prefix):
+                # moved out of sync
+                coalesce(pending, 'deleted', sync.rel_path(event.src_path),
+                    is_dir=event.is_directory)
+                return
+            coalesce(pending, event.event_type, 
+                sync.rel_path(event.src_path), 
+                sync.rel_path(dest) if dest else None, event.is_directory)
     
     eh = EventHandler()
-    observer.schedule(eh, sync.path, recursive = True)
+    if lazy and hasattr(observer, 'add_watches'):
+        observer.schedule(eh, sync.path, recursive = True, lazy = True)
+    else:
+        observer.schedule(eh, sync.path, recursive = True)
     return eh
 
-def init():
+def init(backend=None):
+    '''
+        Start the observer shared by all SyncWatches
+        - backend 'inotify' uses the linux backend, watchdog otherwise
+    '''
     global observer
-    observer = Observer()
+    if backend == 'inotify':
+        from rainmaker.sync_manager.inotify import InotifyObserver
+        observer = InotifyObserver()
+    else:
+        observer = Observer()
     observer.start()
 
 def stop():
@@ -0,0 +1,320 @@
+'''
+    Linux inotify watcher backend for SyncWatch
+    - one inotify fd for all syncs, events are read in batches
+    - directory watches are added lazily, eg. from the scanner's walk
+    - on queue overflow, subtrees with recent events are rescanned at
+      once and every sync again once events go quiet
+'''
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import threading
+
+from watchdog.events import FileCreatedEvent, DirCreatedEvent, \
+    FileDeletedEvent, DirDeletedEvent, FileModifiedEvent, \
+    FileMovedEvent, DirMovedEvent
+
+import rainmaker.logger
+log = rainmaker.logger.create_log(__name__)
+
+IN_MODIFY = 0x00000002
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+watch_mask = IN_MODIFY | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | \
+    IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR
+
+EVENT_HEADER = struct.Struct('iIII')
+# bytes read per batch
+read_size = 64 * 1024
+# seconds a directory counts as active for overflow recovery
+overflow_window = 5.0
+# kernel memory per watch, struct inotify_watch and its fsnotify mark
+kernel_watch_bytes = 1080
+
+available = sys.platform.startswith('linux')
+_libc = None
+
+def _lib():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+            use_errno=True)
+    return _libc
+
+def parse_events(data):
+    '''
+        Split a read into (wd, mask, cookie, name)
+    '''
+    events = []
+    i = 0
+    while i + EVENT_HEADER.size <= len(data):
+        wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, i)
+        i += EVENT_HEADER.size
+        name = data[i:i + length].rstrip(b'\0')
+        i += length
+        events.append((wd, mask, cookie, os.fsdecode(name)))
+    return events
+
+class InotifyObserver(object):
+    '''
+        Watch directories with inotify and dispatch watchdog events
+        - schedule watches the root, the rest of the tree unless lazy
+        - add_watches adds directories, eg. as a scan walks them
+        - handlers get rescan(path) for subtrees that may have lost
+          events on overflow
+    '''
+    def __init__(self):
+        if not available:
+            raise OSError('inotify needs linux')
+        self.fd = _lib().inotify_init1(IN_CLOEXEC | IN_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.paths = {}         # wd -> path
+        self.wds = {}           # path -> wd
+        self.handlers = []      # (root, handler)
+        self.active = {}        # dir path -> last event time
+        self.setup_time = 0.0   # seconds spent adding watches
+        self.failed = 0         # watches the kernel refused
+        self.overflows = 0
+        self.stale = set()      # roots to rescan when quiet, after overflow
+        self.last_event = 0.0
+        self._lock = threading.RLock()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def schedule(self, handler, path, recursive=True, lazy=False):
+        ''' dispatch events below path to handler '''
+        path = os.path.abspath(path)
+        with self._lock:
+            self.handlers.append((path, handler))
+        if recursive and not lazy:
+            self.add_tree(path)
+        else:
+            self.add_watches([path])
+        return handler
+
+    def add_watches(self, paths):
+        ''' watch directories, returns number added '''
+        start = time.time()
+        added = 0
+        with self._lock:
+            for path in paths:
+                path = os.path.abspath(path)
+                if path in self.wds:
+                    continue
+                wd = _lib().inotify_add_watch(self.fd, os.fsencode(path),
+                    watch_mask)
+                if wd < 0:
+                    err = ctypes.get_errno()
+                    if err not in (errno.ENOENT, errno.ENOTDIR):
+                        self.failed += 1
+                        log.error('Unable to watch %s: %s' % (path,
+                            os.strerror(err)))
+                    continue
+                self.paths[wd] = path
+                self.wds[path] = wd
+                added += 1
+        self.setup_time += time.time() - start
+        return added
+
+    def add_tree(self, path):
+        ''' watch path and every directory below it '''
+        dirs = [path]
+        for root, subdirs, files in os.walk(path):
+            dirs.extend(os.path.join(root, d) for d in subdirs)
+        return self.add_watches(dirs)
+
+    def stats(self):
+        '''
+            Watch setup cost
+            - watches: directories watched
+            - setup_time: seconds spent adding watches
+            - bytes_per_watch: kernel memory plus our path maps
+            - overflows: queue overflows, events were lost
+            - stale: syncs waiting for their full rescan after an overflow
+        '''
+        with self._lock:
+            count = len(self.wds)
+            ours = sum(sys.getsizeof(p) for p in self.wds) + \
+                sys.getsizeof(self.wds) + sys.getsizeof(self.paths)
+        return {
+            'watches': count,
+            'failed': self.failed,
+            'setup_time': self.setup_time,
+            'bytes_per_watch': kernel_watch_bytes + ours / count
+                if count else 0,
+            'overflows': self.overflows,
+            'stale': len(self.stale)}
+
+    def start(self):
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+
+    def join(self):
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        os.close(self.fd)
+
+    def _loop(self):
+        while not self._stopping.is_set():
+            ready, _, _ = select.select([self.fd], [], [], 0.1)
+            if not ready:
+                self._idle(time.time())
+                continue
+            try:
+                data = os.read(self.fd, read_size)
+            except BlockingIOError:
+                continue
+            self.handle(parse_events(data))
+
+    def handle(self, events):
+        '''
+            Dispatch a batch of raw events
+            - moved_from and moved_to are paired by cookie in the batch,
+              unpaired halves are deletes and creates
+            - new directories are rescanned, entries can land in them
+              before their watch is added
+        '''
+        now = time.time()
+        moves = {}
+        out = []
+        # new directories, watched and rescanned after their events
+        recover = []
+        with self._lock:
+            self.last_event = now
+            for wd, mask, cookie, name in events:
+                if mask & IN_Q_OVERFLOW:
+                    self._overflow(now)
+                    continue
+                parent = self.paths.get(wd)
+                if parent is None:
+                    continue
+                if mask & IN_IGNORED or mask & IN_DELETE_SELF:
+                    self._forget(parent)
+                    continue
+                self.active[parent] = now
+                path = os.path.join(parent, name)
+                is_dir = bool(mask & IN_ISDIR)
+                if mask & IN_MOVED_FROM:
+                    moves[cookie] = len(out)
+                    out.append([DirDeletedEvent if is_dir
+                        else FileDeletedEvent, path])
+                elif mask & IN_MOVED_TO:
+                    if cookie in moves:
+                        i = moves.pop(cookie)
+                        src = out[i][1]
+                        out[i] = [DirMovedEvent if is_dir
+                            else FileMovedEvent, src, path]
+                        if is_dir:
+                            self._moved(src, path)
+                    else:
+                        out.append([DirCreatedEvent if is_dir
+                            else FileCreatedEvent, path])
+                        if is_dir:
+                            # entries may already be inside
+                            recover.append(path)
+                elif mask & IN_CREATE:
+                    out.append([DirCreatedEvent if is_dir
+                        else FileCreatedEvent, path])
+                    if is_dir:
+                        # mkdir -p and writes may beat the new watch
+                        recover.append(path)
+                elif mask & IN_DELETE:
+                    out.append([DirDeletedEvent if is_dir
+                        else FileDeletedEvent, path])
+                elif mask & IN_MODIFY and not is_dir:
+                    out.append([FileModifiedEvent, path])
+            for i in moves.values():
+                if out[i][0] is DirDeletedEvent:
+                    # moved out of the watched tree
+                    self._unwatch(out[i][1])
+        for cls, *paths in out:
+            event = cls(*paths)
+            for handler in self._handlers_for(paths[0]):
+                handler.dispatch(event)
+        self._recover(recover)
+
+    def _handlers_for(self, path):
+        return [h for root, h in self.handlers
+            if path == root or path.startswith(root + os.sep)]
+
+    def _forget(self, path):
+        wd = self.wds.pop(path, None)
+        self.paths.pop(wd, None)
+        self.active.pop(path, None)
+
+    def _unwatch(self, path):
+        ''' stop watching path and everything below it '''
+        prefix = path + os.sep
+        for p in [p for p in self.wds if p == path or p.startswith(prefix)]:
+            _lib().inotify_rm_watch(self.fd, self.wds[p])
+            self._forget(p)
+
+    def _moved(self, src, dest):
+        ''' watched directories below src now live below dest '''
+        prefix = src + os.sep
+        for path in [p for p in self.wds if p == src or p.startswith(prefix)]:
+            wd = self.wds.pop(path)
+            new = dest + path[len(src):]
+            self.wds[new] = wd
+            self.paths[wd] = new
+
+    def _overflow(self, now):
+        '''
+            Events were dropped, rescan directories that had events lately
+            - nested directories are covered by their topmost active parent
+            - without recent events every watched root is rescanned
+            - dropped events may be anywhere, every root is marked stale
+              and rescanned in full by _idle once events go quiet
+        '''
+        self.overflows += 1
+        roots = [root for root, h in self.handlers]
+        dirs = sorted(p for p, t in self.active.items()
+            if now - t < overflow_window)
+        top = []
+        for path in dirs:
+            if not top or not path.startswith(top[-1] + os.sep):
+                top.append(path)
+        log.error('inotify queue overflow, rescanning %s' % (
+            top or 'all syncs'))
+        if top:
+            self.stale.update(roots)
+        self._recover(top or roots)
+
+    def _idle(self, now):
+        ''' rescan stale roots once no events came for overflow_window '''
+        with self._lock:
+            if not self.stale or now - self.last_event < overflow_window:
+                return
+            roots = sorted(self.stale)
+            self.stale.clear()
+        log.info('rescanning %s after overflow' % roots)
+        self._recover(roots)
+
+    def _recover(self, paths):
+        ''' watch and rescan subtrees at paths '''
+        for path in paths:
+            self.add_tree(path)
+            for handler in self._handlers_for(path):
+                handler.rescan(path)
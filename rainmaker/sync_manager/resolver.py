@@ -1,6 +1,10 @@
-from collections import namedtuple
-from rainmaker.db.views import sync_diff
-from rainmaker.db.main import Download, Resolution
+from collections import namedtuple, defaultdict, deque
+from itertools import groupby
+from operator import attrgetter
+from sqlalchemy.sql import select, bindparam
+from rainmaker.db.views import sync_diff, iter_sync_diff
+from rainmaker.db.main import Download, Resolution, SyncFile
+from rainmaker.db.serializers import NeededParts
 
 # Resolution State Constants
 RES_ERROR       = Resolution.RES_ERROR      # Error during resolution
@@ -19,28 +23,58 @@ CREATED       = Resolution.CREATED
 NO_CHANGE     = Resolution.NO_CHANGE
 
 
-def get_downloads(db, resolutions):
+# downloads looked up / written per statement
+download_batch = 500
+
+def dirs_then_smallest(row):
+    ''' Download priority: dirs, then small files first '''
+    return (not row['is_dir'], row['file_size'] or 0, row['rel_path'])
+
+def get_downloads(db, resolutions, priority=dirs_then_smallest):
     '''
         Store results from resolve syncs
-        - Create Download record
-        - update host_file to point at sync_file
+        - one query per batch finds existing downloads by rel_path
+        - downloads are created / updated with executemany
+        - returns rel_paths to download, ordered by priority
     '''
-    # Create download record
-    def _add_download(r):
-        dlo = db.query(Download).filter(
-            Download.sync_id == r.host_file.host.sync.id,
-            Download.rel_path == r.host_filr.rel_path
-        ).first()
-        if dlo is None:
-            dlo = Download(sync_id = r.host_file.host.sync.id,
-                rel_path=r.host_file.rel_path)
-        dlo.from_host_file(r.host_file)
-        db.add(dlo)
-
+    downloads = Download.__table__
+    rows = {}
     for r in resolutions:
         # Add to download pool
-        if r.state == THEIRS_CHANGED:
-            _add_download(r)
+        if r.status != THEIRS_CHANGED:
+            continue
+        hf = r.host_file
+        nparts = NeededParts.from_file_parts(hf.file_parts)
+        rows[(r.sync_id, hf.rel_path)] = {
+            'sync_id': r.sync_id,
+            'rel_path': hf.rel_path,
+            'file_hash': hf.file_hash,
+            'file_size': hf.file_size,
+            'is_dir': hf.is_dir,
+            'complete': False,
+            'nparts': nparts.dump()}
+
+    keys = list(rows)
+    for i in range(0, len(keys), download_batch):
+        batch = keys[i:i + download_batch]
+        # find existing downloads
+        existing = {}
+        for sync_id in set(k[0] for k in batch):
+            q = select([downloads.c.rel_path, downloads.c.id]).where(
+                (downloads.c.sync_id == sync_id) & 
+                downloads.c.rel_path.in_([k[1] for k in batch 
+                    if k[0] == sync_id]))
+            for rel_path, dlo_id in db.execute(q):
+                existing[(sync_id, rel_path)] = dlo_id
+        inserts = [rows[k] for k in batch if k not in existing]
+        updates = [dict(rows[k], dlo_id=existing[k]) 
+            for k in batch if k in existing]
+        if inserts:
+            db.execute(downloads.insert(), inserts)
+        if updates:
+            db.execute(downloads.update().where(
+                downloads.c.id == bindparam('dlo_id')), updates)
+    return [row['rel_path'] for row in sorted(rows.values(), key=priority)]
             
 #Resolution = namedtuple("Resolution", "status state sync_file host_file")
 
@@ -49,24 +83,182 @@ def get_resolutions(db, host):
     sync_id, host_id = host.sync_id, host.id
     sync_files, host_files = sync_diff(db, sync_id, host_id)
     resolutions = []
-    while len(sync_files) > 0 or len(host_files) > 0:
+    for r in resolve_all(sync_files, host_files):
         # resolve differences
-        r = resolve_files(sync_files, host_files)
         r.host_id = host_id
         r.sync_id = sync_id
         resolutions.append(r)
     get_downloads(db, resolutions)
     return resolutions
 
+def stream_resolutions(db, host, chunk_size=500):
+    '''
+        Resolve, save and plan downloads chunk by chunk
+        - yields each saved chunk of resolutions
+        - memory is bounded by chunk_size
+    '''
+    sync_id, host_id = host.sync_id, host.id
+    chunk = []
+    for r in iter_resolutions(db, sync_id, host_id, chunk_size):
+        r.host_id = host_id
+        r.sync_id = sync_id
+        chunk.append(r)
+        if len(chunk) >= chunk_size:
+            yield _save_resolutions(db, chunk)
+            chunk = []
+    if chunk:
+        yield _save_resolutions(db, chunk)
+
+def _save_resolutions(db, resolutions):
+    db.add_all(resolutions)
+    get_downloads(db, resolutions)
+    db.commit()
+    return resolutions
+
+def iter_resolutions(db, sync_id, host_id, batch_size=500):
+    '''
+        Merge join both sides of sync_diff in rel_path order
+        - host files referencing a sync file are resolved with it
+        - other files are matched by rel_path
+        - only ids of referenced sync files are kept in memory
+    '''
+    # referenced sync file id: resolved yet?
+    claimed = {}
+    _, host_files = iter_sync_diff(db, sync_id, host_id, batch_size)
+    for h in host_files:
+        target = cmp_target(h)
+        if target is not None:
+            claimed[target.cmp_id] = False
+
+    sync_files, host_files = iter_sync_diff(db, sync_id, host_id, batch_size)
+    for syncs, hosts in _merge_by_path(sync_files, host_files):
+        plain = deque()
+        for h in hosts:
+            target = cmp_target(h)
+            if target is None:
+                plain.append(h)
+                continue
+            with db.no_autoflush:
+                f = db.query(SyncFile).get(target.cmp_id)
+            if f is None or f.sync_id != sync_id or claimed[f.id]:
+                # referenced file not found, throw error
+                raise ResolutionQueryError()
+            claimed[f.id] = True
+            ver = None
+            if f.version != target.cmp_ver:
+                ver = f.get_version(target.cmp_ver)
+                if ver is None:
+                    raise ResolutionQueryError()
+            yield resolve_queries(ResolverQuery.result(f, ver),
+                ResolverQuery.result(h, None if target is h else target))
+        for f in syncs:
+            if f.id in claimed:
+                continue
+            h = plain.popleft() if plain else None
+            yield resolve_queries(ResolverQuery.result(f),
+                ResolverQuery.result(h))
+        for h in plain:
+            yield resolve_queries(ResolverQuery.result(),
+                ResolverQuery.result(h))
+
+def _merge_by_path(sync_files, host_files):
+    ''' Group two rel_path ordered streams into (syncs, hosts) '''
+    key = attrgetter('rel_path')
+    syncs = groupby(sync_files, key)
+    hosts = groupby(host_files, key)
+    s, h = next(syncs, None), next(hosts, None)
+    while s is not None or h is not None:
+        if h is None or (s is not None and s[0] < h[0]):
+            yield list(s[1]), []
+            s = next(syncs, None)
+        elif s is None or h[0] < s[0]:
+            yield [], list(h[1])
+            h = next(hosts, None)
+        else:
+            yield list(s[1]), list(h[1])
+            s, h = next(syncs, None), next(hosts, None)
+
 def resolve_files(sync_files, host_files):
     ''' Resolve first file in array '''
     # check self, vers, other/vers for cmp any
     s_query, h_query = query_targets(sync_files, host_files)
+    return resolve_queries(s_query, h_query)
+
+def resolve_queries(s_query, h_query):
+    ''' Resolution for matched queries '''
     direction = resolution_direction(s_query, h_query)
     state = file_state(s_query.head, h_query.head) 
     return Resolution(status=direction, 
             state=state, sync_file=s_query.head,
             host_file=h_query.head)
+
+def resolve_all(sync_files, host_files):
+    '''
+        Resolve all files in one pass
+        - same results and order as calling resolve_files until 
+          both arrays are empty
+        - files are indexed once by id and rel_path
+    '''
+    done = set()
+    sync_by_id = {f.id: f for f in sync_files}
+    hosts_by_path = defaultdict(deque)
+    for h in host_files:
+        hosts_by_path[h.rel_path].append(h)
+
+    def _take_host(rel_path):
+        ''' First host file with rel_path not yet resolved '''
+        hosts = hosts_by_path.get(rel_path)
+        while hosts:
+            h = hosts.popleft()
+            if id(h) not in done:
+                done.add(id(h))
+                return h
+        return None
+
+    # host files that reference a compared sync file
+    for h in host_files:
+        target = cmp_target(h)
+        if target is None:
+            continue
+        done.add(id(h))
+        f = sync_by_id.get(target.cmp_id)
+        if f is None or id(f) in done:
+            # referenced file not found, throw error
+            raise ResolutionQueryError()
+        ver = None
+        if f.version != target.cmp_ver:
+            ver = f.get_version(target.cmp_ver)
+            if ver is None:
+                raise ResolutionQueryError()
+        done.add(id(f))
+        yield resolve_queries(ResolverQuery.result(f, ver),
+            ResolverQuery.result(h, None if target is h else target))
+
+    # sync files, matched to host files by name
+    for f in sync_files:
+        if id(f) in done:
+            continue
+        done.add(id(f))
+        yield resolve_queries(ResolverQuery.result(f),
+            ResolverQuery.result(_take_host(f.rel_path)))
+
+    # host files left have no match
+    for h in host_files:
+        if id(h) in done:
+            continue
+        done.add(id(h))
+        yield resolve_queries(ResolverQuery.result(),
+            ResolverQuery.result(h))
+
+def cmp_target(host_file):
+    ''' Host file or first version that references a sync file '''
+    args = ('cmp_id', 'cmp_ver')
+    if require_not_null(host_file, args):
+        return host_file
+    for v in host_file.vers:
+        if require_not_null(v, args):
+            return v
+    return None
     
 def file_state(sync_file, host_file):
     '''Check file state'''
@@ -119,7 +311,7 @@ def query_targets(sync_files, host_files):
     host_file = host_query.target
     if host_file:
         # find referenced file
-        sync_query.find(id=host_file.cmp_id, version=host_file.cmp_ver)
+        sync_query.find_version(host_file.cmp_id, host_file.cmp_ver)
         if not sync_query.target:
             # referenced file not found, throw error
             raise ResolutionQueryError()
@@ -156,6 +348,14 @@ class ResolverQuery(object):
     def __init__(self, files):
         self.files = files
         self._search_pool_ = files
+
+    @classmethod
+    def result(klass, head=None, ver=None):
+        ''' Query already matched to head and / or ver '''
+        query = klass([head] if head is not None else [])
+        if head is not None:
+            query.add(head, ver)
+        return query
     
     def without_versions(self):
         '''Dont search versions'''
@@ -177,6 +377,23 @@ class ResolverQuery(object):
         self.__search__(where_attrs_equal, kwargs)
         return self
 
+    def find_version(self, id, version):
+        ''' 
+            Find file by id, as head or past version
+            - versions are looked up by key, not scanned
+        '''
+        for f in self._search_pool_:
+            if f.id != id:
+                continue
+            if f.version == version:
+                self.add(f)
+            elif not self._without_versions:
+                ver = f.get_version(version)
+                if ver is not None:
+                    self.add(f, ver)
+            break
+        return self
+
     def require(self, *args):
         ''' Search Files and versions for first not null '''
         self.__search__(require_not_null, args)
@@ -1,12 +1,13 @@
 '''
 TODO: 
     Add try except for file not found, mark deleted
-    try scandir plugin for better walk performance
 '''
 import os
+import stat
 
-from rainmaker.file_system import hash_file
-from rainmaker.db.main import Sync, SyncFile
+from rainmaker.file_system import rehash_file
+from rainmaker.db.main import Sync, SyncFile, ScanCheckpoint
+from rainmaker.db import views
 from rainmaker import utils
 
 import rainmaker.logger
@@ -14,10 +15,34 @@ log = rainmaker.logger.create_log(__name__)
 
 chunk_size = 200000
 
-def scan(session):
+# Rows written per transaction during a bulk scan
+batch_size = 5000
+
+class ScanStats(object):
+    '''
+        Counters for a single scan
+    '''
+    def __init__(self):
+        self.dirs = 0       # directories scanned
+        self.stated = 0     # files checked with stat
+        self.skipped = 0    # files unchanged, never opened
+        self.hashed = 0     # files changed and hashed
+        self.bytes_read = 0 # bytes read while hashing
+        self.dirs_unchanged = 0 # dirs matching their checkpoint
+
+    def __repr__(self):
+        return 'ScanStats(dirs=%s, stated=%s, skipped=%s, hashed=%s, ' \
+            'bytes_read=%s, dirs_unchanged=%s)' % (self.dirs, self.stated, 
+                self.skipped, self.hashed, self.bytes_read, 
+                self.dirs_unchanged)
+
+def scan(session, bulk=False):
     ''' Scan all syncs in DB '''
     for sync in session.query(Sync).all():
-        scan_sync(session, sync)
+        if bulk:
+            scan_sync_bulk(session, sync)
+        else:
+            scan_sync(session, sync)
 
 def scan_sync(session, sync):
     def _scan():
@@ -62,38 +87,388 @@ def scan_sync(session, sync):
         sync_file.path = fpath
         return sync_file
 
-    def _check_for_deleted():
+    _scan()
+    _check_for_deleted(session, sync)
+
+def scan_sync_bulk(session, sync, batch_size=batch_size, hash_pool=None,
+        on_dirs=None):
+    '''
+        Scan sync with a bounded number of transactions
+        - load existing sync_files into a rel_path index once
+        - walk tree and scan anything not seen since scan started
+        - flush inserts and updates every batch_size rows
+        - only open files whose stat info changed
+        - hash changed files concurrently if hash_pool given
+        - on_dirs is called with the paths of each directory's subdirs, 
+          eg. SyncWatch.watch_dirs to add watches as the tree is walked
+        - directory checkpoints are saved when the scan completes
+        Returns ScanStats
+    '''
+    pending = 0
+    stats = ScanStats()
+    to_hash = []
+    fingerprints = {}
+
+    def _scan():
+        # mark as scan started
+        sync.stime_start = utils.time_now()
+        session.add(sync)
+        session.commit()
+        # index existing records by rel_path
+        index = {sf.rel_path: sf for sf in session.query(SyncFile).filter(
+            SyncFile.sync_id == sync.id)}
+        # scan sub dirs and files
+        for dirs, files in _walk(sync.path, fingerprints):
+            if on_dirs is not None and dirs:
+                on_dirs([entry.path for entry in dirs])
+            # scan dirs
+            for entry in dirs:
+                sync_file = _find_or_init(index, entry.path)
+                # skip if currently scanning
+                if sync_file.stime_start < sync.stime_start:
+                    sync_file = _mark_dir(session, sync_file)
+                    index[sync_file.rel_path] = sync_file
+                    stats.dirs += 1
+                    _save(sync_file)
+            # scan files
+            for entry in files:
+                sync_file = _find_or_init(index, entry.path)
+                # skip if currently scanning
+                if sync_file.stime_start < sync.stime_start:
+                    _mark_file(session, sync_file, entry.stat())
+                    stats.stated += 1
+                    if sync_file.file_hash is None:
+                        stats.hashed += 1
+                        # new files go to the pool, others try a rehash
+                        if hash_pool and len(sync_file.file_parts) == 0:
+                            _queue_hash(sync_file)
+                            continue
+                        sync_file.file_hash, read, _ = rehash_file(sync_file)
+                        stats.bytes_read += read
+                    else:
+                        stats.skipped += 1
+                    _finish(sync_file)
+        _hash_queued()
+        # mark as scan complete
+        sync.stime = utils.time_now()
+        session.add(sync)
+        _save_checkpoints(session, sync, fingerprints, replace=True)
+        session.commit()
+
+    def _find_or_init(index, fpath):
         '''
-            Mark all files that didn't show up in scan as deleted
+            Check index or init new file
         '''
-        session.query(SyncFile).filter(SyncFile.does_exist==True,
-            SyncFile.sync_id == sync.id,
-            SyncFile.stime_start < sync.stime_start).\
-                update({'does_exist': False})
+        fpath = os.path.abspath(fpath)
+        rel_path = sync.rel_path(fpath)
+        sync_file = index.get(rel_path)
+        if sync_file is None:
+            sync_file = SyncFile(sync_id=sync.id, rel_path=rel_path)
+            sync_file.stime = 0
+            sync_file.stime_start = 0
+            sync_file.sync = sync
+            index[rel_path] = sync_file
+        return sync_file
+
+    def _queue_hash(sync_file):
+        '''
+            Queue file for hash pool, hash when queue is full
+        '''
+        to_hash.append(sync_file)
+        if len(to_hash) >= hash_pool.workers*4:
+            _hash_queued()
+
+    def _hash_queued():
+        '''
+            Hash queued files concurrently
+        '''
+        if not to_hash:
+            return
+        for sync_file, (adler, scan_len) in hash_pool.map_files(to_hash):
+            sync_file.file_hash = adler
+            stats.bytes_read += scan_len
+            _finish(sync_file)
+        del to_hash[:]
+
+    def _finish(sync_file):
+        '''
+            Record scan completion time and save
+        '''
+        sync_file.stime = utils.time_now()
+        _save(sync_file)
+
+    def _save(sync_file):
+        '''
+            Queue record, commit when batch is full
+        '''
+        nonlocal pending
+        session.add(sync_file)
+        pending += 1
+        if pending >= batch_size:
+            session.commit()
+            pending = 0
+
+    # Keep indexed records loaded between batch commits
+    expire_on_commit = session.expire_on_commit
+    session.expire_on_commit = False
+    try:
+        _scan()
+    finally:
+        session.expire_on_commit = expire_on_commit
+    _check_for_deleted(session, sync)
+    return stats
+
+def scan_sync_changed(session, sync, hash_pool=None, on_dirs=None):
+    '''
+        Scan directories that changed since their checkpoint
+        - every directory is listed once and its files stat'd, nothing
+          is opened unless its stat changed
+        - files written in place leave the directory unchanged, so in
+          unchanged directories only files whose stat changed are marked
+          and hashed, the rest are not written
+        - changed and new directories are compared with their rows,
+          missing entries marked deleted, the checkpoint saved
+        - limitation: like scan_sync_bulk, an edit that keeps size,
+          mtime, ctime and inode is not seen
+        - falls back to scan_sync_bulk without checkpoints
+        Returns ScanStats
+    '''
+    checkpoints = {cp.path: cp for cp in session.query(ScanCheckpoint).filter(
+        ScanCheckpoint.sync_id == sync.id)}
+    if '' not in checkpoints:
+        return scan_sync_bulk(session, sync, hash_pool=hash_pool, 
+            on_dirs=on_dirs)
+    stats = ScanStats()
+
+    def _full(rel_path):
+        return os.path.join(sync.path, rel_path) if rel_path else sync.path
+
+    def _gone(rel_path):
+        # directory vanished, mark it and everything below
+        session.flush()
+        views.delete_subtree(session, sync.id, rel_path)
+        session.expire_all()
+        session.query(ScanCheckpoint).filter(
+            ScanCheckpoint.sync_id == sync.id,
+            ScanCheckpoint.path.in_([p for p in checkpoints 
+                if p == rel_path or p.startswith(rel_path + os.sep)])).\
+                    delete(False)
+
+    def _scan_dir(rel_path, st, changed=True):
+        dirs, files = _list_dir(_full(rel_path))
+        if changed:
+            stats.dirs += 1
+        else:
+            stats.dirs_unchanged += 1
+        rows = {sf.rel_path: sf 
+            for sf in views.dir_files(session, sync.id, rel_path)}
+        seen = set(sync.rel_path(os.path.abspath(entry.path)) 
+            for entry in dirs)
+        for sub, sync_file in rows.items():
+            if sync_file.is_dir and sync_file.does_exist and sub not in seen:
+                _gone(sub)
+        subdirs = []
+        to_hash = []
+        for entry in dirs:
+            sub = sync.rel_path(os.path.abspath(entry.path))
+            sync_file = rows.get(sub) or SyncFile(sync_id=sync.id, 
+                rel_path=sub)
+            if not (sync_file.is_dir and sync_file.does_exist):
+                session.add(_mark_dir(session, sync_file))
+            if not entry.is_symlink():
+                subdirs.append(sub)
+        for entry in files:
+            sub = sync.rel_path(os.path.abspath(entry.path))
+            seen.add(sub)
+            sync_file = rows.get(sub)
+            if sync_file is None:
+                sync_file = SyncFile(sync_id=sync.id, rel_path=sub)
+                sync_file.sync = sync
+            stats.stated += 1
+            if not (changed or _stat_changed(sync_file, entry.stat())):
+                stats.skipped += 1
+                continue
+            _mark_file(session, sync_file, entry.stat())
+            if sync_file.file_hash is None:
+                stats.hashed += 1
+                to_hash.append(sync_file)
+            else:
+                stats.skipped += 1
+                sync_file.stime = utils.time_now()
+                session.add(sync_file)
+        if hash_pool is not None:
+            hashed = hash_pool.map_files(to_hash)
+        else:
+            hashed = ((sf, rehash_file(sf)[:2]) for sf in to_hash)
+        for sync_file, (adler, scan_len) in hashed:
+            sync_file.file_hash = adler
+            sync_file.stime = utils.time_now()
+            stats.bytes_read += scan_len
+            session.add(sync_file)
+        for sub, sync_file in rows.items():
+            if sub not in seen and sync_file.does_exist:
+                sync_file.does_exist = False
+                session.add(sync_file)
+        if changed:
+            _save_checkpoints(session, sync, {_full(rel_path): st})
         session.commit()
-        
-    _scan()
-    _check_for_deleted()
+        return subdirs
+
+    stack = ['']
+    while stack:
+        rel_path = stack.pop()
+        try:
+            st = os.stat(_full(rel_path))
+        except FileNotFoundError:
+            st = None
+        if st is None or not stat.S_ISDIR(st.st_mode):
+            if not rel_path:
+                log.error('Unable to scan: %s is missing' % sync.path)
+                return stats
+            # removed since its parent was checked
+            _gone(rel_path)
+            session.commit()
+            continue
+        cp = checkpoints.get(rel_path)
+        subdirs = _scan_dir(rel_path, st, cp is None or not cp.matches(st))
+        if on_dirs is not None and subdirs:
+            on_dirs([_full(sub) for sub in subdirs])
+        stack.extend(subdirs)
+    sync.stime = utils.time_now()
+    session.add(sync)
+    session.commit()
+    return stats
+
+def _walk(path, fingerprints=None):
+    '''
+        Walk tree using os.scandir
+        - yields (dirs, files) lists of DirEntry for each directory
+        - DirEntry gets the entry type from the listing, no stat is
+          needed to split dirs and files
+        - DirEntry.stat() is one system call per entry on POSIX (free on
+          Windows), cached for later calls
+        - does not descend into symlinked dirs (same as os.walk)
+        - fingerprints gets the stat of each directory listed, taken
+          before the listing so later changes are seen by the next scan
+    '''
+    stack = [path]
+    while stack:
+        dir_path = stack.pop()
+        try:
+            st = os.stat(dir_path)
+            dirs, files = _list_dir(dir_path)
+        except OSError as e:
+            log.error('Unable to scan: %s' % e)
+            continue
+        if fingerprints is not None:
+            fingerprints[dir_path] = st
+        yield dirs, files
+        stack.extend(d.path for d in dirs if not d.is_symlink())
+
+def _list_dir(path):
+    ''' (dirs, files) lists of DirEntry in path '''
+    dirs, files = [], []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                dirs.append(entry)
+            else:
+                files.append(entry)
+    return dirs, files
+
+def _save_checkpoints(session, sync, fingerprints, replace=False):
+    '''
+        Record directory stats of a completed scan
+        - fingerprints maps full path to stat result
+        - replace drops checkpoints of directories not in fingerprints
+    '''
+    now = utils.time_now()
+    table = ScanCheckpoint.__table__
+    if replace:
+        session.execute(table.delete().where(table.c.sync_id == sync.id))
+    rows = []
+    for path, st in fingerprints.items():
+        rel_path = sync.rel_path(path) if path != sync.path else ''
+        rows.append(dict(sync_id=sync.id, path=rel_path, 
+            parent=os.path.dirname(rel_path) if rel_path else None,
+            mtime_ns=st.st_mtime_ns, nlink=st.st_nlink, scanned_at=now,
+            created_at=now, updated_at=now))
+    if rows:
+        session.execute(table.insert().prefix_with('OR REPLACE'), rows)
+
+def _check_for_deleted(session, sync):
+    '''
+        Mark all files that didn't show up in scan as deleted
+        - versioned and journaled like any other change
+    '''
+    session.flush()
+    views.delete_unscanned(session, sync.id, sync.stime_start)
+    # loaded rows are stale
+    session.expire_all()
+    session.commit()
 
 
-def refresh_sync(session, sync):
+def refresh_sync(session, sync, hash_pool=None):
     '''
         Check database for new files to scan
+        - files are stat'd here and hashed by hash_pool if given, on 
+          this thread otherwise
+        - rows are committed every batch_size once hashed, not one by one
     '''
     sync_files = session.query(SyncFile).filter(
         SyncFile.sync_id == sync.id,                
         SyncFile.does_exist == True,
         SyncFile.stime_start == 0).all()
-    for sf in sync_files:
-        if sf.is_dir:
-            scan_dir(session, sf)
+
+    def _refresh(batch):
+        to_hash = []
+        for sf in batch:
+            if sf.is_dir:
+                session.add(_mark_dir(session, sf))
+                continue
+            try:
+                _mark_file(session, sf)
+            except FileNotFoundError:
+                # gone again before we got to it
+                sf.does_exist = False
+                session.add(sf)
+                continue
+            if sf.file_hash is None:
+                to_hash.append(sf)
+            else:
+                sf.stime = utils.time_now()
+                session.add(sf)
+        if hash_pool is not None:
+            hashed = hash_pool.map_files(to_hash)
         else:
-            scan_file(session, sf)
+            hashed = ((sf, rehash_file(sf)[:2]) for sf in to_hash)
+        for sf, (adler, _) in hashed:
+            sf.file_hash = adler
+            sf.stime = utils.time_now()
+            session.add(sf)
+        session.commit()
+
+    # keep loaded rows between batch commits
+    expire_on_commit = session.expire_on_commit
+    session.expire_on_commit = False
+    try:
+        for i in range(0, len(sync_files), batch_size):
+            _refresh(sync_files[i:i + batch_size])
+    finally:
+        session.expire_on_commit = expire_on_commit
 
 def scan_dir(session, sync_file):
     '''
         Scan and add this dir to db
     '''
+    sync_file = _mark_dir(session, sync_file)
+    session.add(sync_file)
+    session.commit()
+
+def _mark_dir(session, sync_file):
+    '''
+        Mark as scanned dir, return record to save
+    '''
     if sync_file.is_dir == False and sync_file.id is not None:
         # used to be a file, now its a dir
         sync_file.does_exist = False
@@ -107,8 +482,7 @@ def scan_dir(session, sync_file):
     sync_file.does_exist = True
     sync_file.stime_start = utils.time_now()
     sync_file.stime = utils.time_now()
-    session.add(sync_file)
-    session.commit()
+    return sync_file
 
 def scan_file(session, sync_file):
     ''' 
@@ -117,21 +491,51 @@ def scan_file(session, sync_file):
             - slow      adler32
             - fast      mtime, inode, ctime
     '''
+    _mark_file(session, sync_file, commit=True)
+    # Save progress
+    session.add(sync_file)
+    session.commit()
+    # check if hashing needed 
+    if sync_file.file_hash is None:
+        # run hasher
+        sync_file.file_hash, _, _ = rehash_file(sync_file)
+    # record scan completion time
+    sync_file.stime = utils.time_now()
+    # save 
+    session.add(sync_file)
+    session.commit()
+
+def _stat_changed(sync_file, finfo):
+    ''' True if _mark_file would ask for a hash, given stat result finfo '''
+    return sync_file.id is None or sync_file.is_dir or \
+        not sync_file.does_exist or sync_file.file_hash is None or \
+        sync_file.file_size != finfo.st_size or \
+        sync_file.mtime != finfo.st_mtime or \
+        sync_file.ctime != finfo.st_ctime or \
+        sync_file.inode != finfo.st_ino
+
+def _mark_file(session, sync_file, finfo=None, commit=False):
+    '''
+        Mark as scanned file and check stat info,
+        file_hash is set to None if hashing is needed
+        - finfo: stat result, looked up if not given
+    '''
     # Mark old directory as deleted if is_dir
     if sync_file.is_dir and sync_file.id is not None:
         sync_file.stime_start = utils.time_now()
         sync_file.stime = utils.time_now()
         sync_file.does_exist = False
         session.add(sync_file)
-        session.commit()
+        if commit:
+            session.commit()
     # start scan
     sync_file.stime_start = utils.time_now()
     sync_file.stime = 0
     sync_file.is_dir = False
     sync_file.does_exist = True
-    # Check file state
-    with open(sync_file.path, 'rb' ) as f:
-        finfo = os.fstat(f.fileno())
+    # Check file state, no need to open the file
+    if finfo is None:
+        finfo = os.stat(sync_file.path)
     # Marking file_hash as None signals that a scan should be done 
     # file size changed?
     if sync_file.file_size != finfo.st_size:
@@ -149,17 +553,6 @@ def scan_file(session, sync_file):
     if sync_file.inode != finfo.st_ino:     #
         sync_file.inode = finfo.st_ino      #
         sync_file.file_hash = None          #
-    # Save progress
-    session.add(sync_file)
-    session.commit()
-    # check if hashing needed 
-    if sync_file.file_hash is None:
-        # run hasher
-        hash_file(sync_file)
-    # record scan completion time
-    sync_file.stime = utils.time_now()
-    # save 
-    session.add(sync_file)
-    session.commit()
+    return sync_file
 
 
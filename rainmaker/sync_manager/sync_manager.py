@@ -7,7 +7,8 @@ from queue import Queue
 
 from rainmaker.net.controllers import register_controller_routes
 from rainmaker.tox.tox_ring import PrimaryBot, SyncBot
-from rainmaker.db.main import Sync
+from rainmaker.db.main import Sync, Host, new_session
+from rainmaker.sync_manager import actions
 
 class FsManager(object):
     def __init__(self, spm):
@@ -16,7 +17,24 @@ class FsManager(object):
         self.sync = spm.sync
 
     def start(self):
-        self.watcher = SyncWatch(self.app.db, self.sync)
+        '''
+            Watch the sync, changes are written by the watcher's worker
+            - the worker gets its own session and hash pool
+            - lazy backends watch the root, verify adds the rest as it
+              walks the tree
+        '''
+        self.session = new_session(self.app.db)
+        sync = self.session.query(Sync).get(self.sync.id)
+        self.hash_pool = HashPool()
+        self.watcher = SyncWatch(self.session, sync, 
+            hash_pool=self.hash_pool, lazy=True)
+        self.watcher.start()
+
+    def stop(self):
+        ''' write what is left, then release the session and pool '''
+        self.watcher.stop()
+        self.hash_pool.shutdown()
+        self.session.close()
 
 class ToxManager(object):
     '''
@@ -106,7 +124,11 @@ class ToxManager(object):
         params = {'pk': addr}
         tox.trigger('ping', params=params)
 
-from rainmaker.sync_manager.scan_manager import scan_sync, refresh_sync
+from threading import Thread
+from rainmaker.sync_manager.scan_manager import scan_sync_bulk, \
+    scan_sync_changed, refresh_sync
+from rainmaker.file_system import HashPool
+
 class SyncPathManager(object):
     '''
         Manage a single sync path
@@ -120,16 +142,45 @@ class SyncPathManager(object):
         self.tox_manager = ToxManager(self)
     
     def start(self, start_primary=False): 
-        self.scan()
+        '''
+            Watch first, then check what changed while stopped
+            - the watcher sees changes made during the check
+        '''
         self.fs_manager.start()
+        self.verify()
         self.tox_manager.start(start_primary)
 
+    def stop(self):
+        ''' stop watching, then shut down tox '''
+        self.fs_manager.stop()
+        self.tox_manager.stop()
+
     def scan(self):
         log.info('%s starting scan of %s' % (self.app.device_name, self.sync.path))
-        stats = scan_sync(self.app.db, self.sync)
+        with HashPool() as pool:
+            stats = scan_sync_bulk(self.app.db, self.sync, hash_pool=pool)
         log.info('Scan completed of: %s' % self.sync.path)
         log.info(stats)
 
+    def verify(self):
+        '''
+            Scan directories changed since their checkpoint in a thread
+        '''
+        self.verify_thread = Thread(target=self._verify)
+        self.verify_thread.daemon = True
+        self.verify_thread.start()
+
+    def _verify(self):
+        session = new_session(self.app.db)
+        sync = session.query(Sync).get(self.sync.id)
+        log.info('%s verifying %s' % (self.app.device_name, sync.path))
+        with HashPool() as pool:
+            stats = scan_sync_changed(session, sync, hash_pool=pool,
+                on_dirs=self.fs_manager.watcher.watch_dirs)
+        log.info('Verify completed of: %s' % sync.path)
+        log.info(stats)
+        session.close()
+
 class SyncManager(object):
     '''
         Manage all syncs
@@ -143,7 +194,21 @@ class SyncManager(object):
         self.syncs.append(spm)
         return spm
        
-    def sync_with_host(self, host):
-        db = self.app.Session()
-        sync_with_host(db, host.sync, host)
+    def stop(self):
+        for spm in self.syncs:
+            spm.stop()
+
+    def sync_with_host(self, host, send):
+        '''
+            Bring host files up to date
+            - hosts we read a journal from continue where we stopped
+            - new hosts are reconciled by directory digests first
+            - send(cmd, params, reply) talks to the host
+        '''
+        db = new_session(self.app.db)
+        host = db.query(Host).get(host.id)
+        if host.last_seq:
+            actions.sync_with_host(db, host, send)
+        else:
+            actions.catch_up_with_host(db, host, send)
 
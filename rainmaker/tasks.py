@@ -20,6 +20,12 @@ def start(self):
     else:
         log.info('%s skipping sync auto start...' % self.device_name)
 
+def stop(self):
+    log.info('%s stopping...' % self.device_name)
+    self.stopping = True
+    self.sync_manager.stop()
+    fs_manager.stop()
+
 def init(self):
     log.info("Starting rainmaker version: %s" % self.version)
     log.info('Checking installation...')
@@ -5,7 +5,7 @@ import rainmaker.db.main as db
 from rainmaker.db import serializers
 
 from rainmaker.utils import rand_str
-from rainmaker.file_system import FsActions
+from rainmaker.file_system import FsActions, hash_chunk
 from rainmaker.main import Application
 from rainmaker.sync_manager import scan_manager
 
@@ -19,7 +19,7 @@ def FileParts(a_file):
     pos = 0
     
     while pos*fp.chunk_size < fsize:
-        fp.put(pos, 12345, '34567890')
+        fp.put(pos, 12345, hash_chunk(str(pos).encode(), fp.algo))
         pos += 1
     a_file.fparts = fp.dump()
     
@@ -0,0 +1,56 @@
+import tracemalloc
+
+import ujson
+
+from rainmaker.db.serializers import FileParts, NeededParts
+from rainmaker.file_system import hash_chunk
+
+
+class DictPiece():
+    '''
+        Piece as loaded before parts were stored in columns
+    '''
+    
+    def __init__(self, pmd5, padler, poffset, plen):
+        self.pmd5 = pmd5
+        self.padler = padler
+        self.poffset = poffset
+        self.plen = plen
+
+def _measure(f):
+    '''
+        Bytes still allocated by the result of f
+    '''
+    tracemalloc.start()
+    try:
+        start = tracemalloc.get_traced_memory()[0]
+        result = f()
+        return tracemalloc.get_traced_memory()[0] - start, result
+    finally:
+        tracemalloc.stop()
+
+def test_parts_memory(count=50000):
+    fp = FileParts()
+    for pos in range(count):
+        fp.put(pos, pos, hash_chunk(str(pos).encode(), fp.algo))
+    blob = fp.dump()
+    js = fp.dump_json()
+
+    def _load_objs():
+        loaded = ujson.loads(js)
+        # md5 parts dump as the v1 list, others as the v2 dict
+        if isinstance(loaded, dict):
+            loaded = loaded['parts']
+        return [DictPiece(*x) for x in loaded]
+
+    objs_size, objs = _measure(_load_objs)
+    fparts_size, fparts = _measure(lambda: FileParts(data=blob))
+    nparts_size, nparts = _measure(lambda: NeededParts.from_file_parts(fparts))
+    print('%s parts: objects %s, file parts %s, needed parts %s bytes' % (
+        count, objs_size, fparts_size, nparts_size))
+    assert len(objs) == len(fparts) == len(nparts) == count
+    assert fparts_size < objs_size / 4
+    assert nparts_size < objs_size / 4
+
+if __name__ == '__main__':
+    test_parts_memory(500000)
@@ -0,0 +1,45 @@
+import time
+
+from rainmaker.db.main import SyncFile, HostFile
+from rainmaker.sync_manager import resolver
+
+
+def _files(count):
+    ''' 
+        Differing files:
+        - every 3rd host file references its sync file 
+        - the rest share a name with a sync file or are new
+    '''
+    sync_files, host_files = [], []
+    for i in range(count):
+        sync_files.append(SyncFile(id=i, rel_path='s/%s' % i, version=0,
+            file_hash=1, is_dir=False, does_exist=True))
+        h = HostFile(id=i, rel_path='s/%s' % i, version=0, file_hash=2,
+            is_dir=False, does_exist=True)
+        if i % 3 == 0:
+            h.cmp_id, h.cmp_ver = i, 0
+        elif i % 3 == 1:
+            h.rel_path = 'h/%s' % i
+        host_files.append(h)
+    return sync_files, host_files
+
+def _result(r):
+    return (r.status, r.state, r.sync_file, r.host_file)
+
+def test_resolve_all_is_linear(count=1000):
+    sync_files, host_files = _files(count)
+    start = time.time()
+    results = [_result(r) for r in resolver.resolve_all(sync_files, host_files)]
+    single_pass = time.time() - start
+
+    start = time.time()
+    expected = []
+    while sync_files or host_files:
+        expected.append(_result(resolver.resolve_files(sync_files, host_files)))
+    per_file = time.time() - start
+    print('%s files: resolve_all %.3fs, resolve_files %.3fs' % (
+        count, single_pass, per_file))
+    assert results == expected
+
+if __name__ == '__main__':
+    test_resolve_all_is_linear(10000)
@@ -1,28 +1,93 @@
-import cProfile
+import time
+
+from sqlalchemy.sql import text, update
 
 import rainmaker
 from rainmaker.tests import test_helper
 from rainmaker.tests import factory_helper
 from rainmaker.db import views
-from rainmaker.db.main import init_db, Host, HostFile
+from rainmaker.db.main import init_db, Host, HostFile, SyncFile
 
 
-def test_can_sync_match(fcount=3000):
-    session = init_db()
-    local= factory_helper.Sync() 
-    files = factory_helper.SyncFile(local, fcount, does_exist=True, fake=True)
+# set based sync_match must beat the per row version by this much
+min_speedup = 5
+
+def _populate(session, fcount):
+    ''' sync and host with fcount files, all but every 7th matching '''
+    local = factory_helper.Sync(fake=True)
     host = Host(sync=local, pubkey='')
     session.add(local)
     session.add(host)
     session.commit()
-    for f in files:
-        hf = f.to_host_file()
-        host.host_files.append(hf)
-    session.add(host)
+    rows = [dict(sync_id=local.id, rel_path=str(i), file_hash=i,
+        file_size=i, is_dir=False, does_exist=True, version=0,
+        created_at=0, updated_at=0) for i in range(fcount)]
+    session.execute(SyncFile.__table__.insert(), rows)
+    for i, row in enumerate(rows):
+        row.pop('sync_id')
+        row.update(host_id=host.id, rid=i)
+        if i % 7 == 0:
+            row['file_hash'] = -i - 1
+    session.execute(HostFile.__table__.insert(), rows)
     session.commit()
-    cProfile.runctx('views.sync_match(s, lid, hid)', globals(),
-            {'s':session,'lid':local.id,'hid':host.id})
+    return local.id, host.id
 
-if __name__ == '__main__':
-    test_can_sync_match(5000)
+def _sync_match_per_row(session, sync_id, host_id):
+    ''' sync_match as it was: one UPDATE per matched file '''
+    q_match = """
+        SELECT t1.id, t2.id AS cmp_id, t2.version AS cmp_ver
+        FROM host_files t1
+        LEFT JOIN sync_files t2
+            ON t1.rel_path = t2.rel_path
+            AND t1.file_hash = t2.file_hash
+            AND t1.is_dir = t2.is_dir
+            AND t1.file_size = t2.file_size
+        WHERE t2.id IS NOT NULL
+            AND t1.host_id = :t1_id
+            AND t1.cmp_id IS NULL
+            AND t2.sync_id = :t2_id
+    """
+    engine = session.get_bind()
+    conn = engine.connect()
+    count = 0
+    with conn.begin():
+        host_files = conn.execute(text(q_match), t2_id=sync_id,
+            t1_id=host_id).fetchall()
+        for hid, cmp_id, cmp_ver in host_files:
+            u = update(HostFile).where(HostFile.id==hid).values(
+                cmp_id=cmp_id, cmp_ver=cmp_ver)
+            conn.execute(u)
+            count += 1
+    conn.close()
+    return count
+
+def _timed(f, *args):
+    start = time.time()
+    result = f(*args)
+    return time.time() - start, result
 
+def _matches(session):
+    return session.execute(text('SELECT id, cmp_id, cmp_ver FROM host_files '
+        'ORDER BY id')).fetchall()
+
+def test_can_sync_match(fcount=5000):
+    session = init_db()
+    sync_id, host_id = _populate(session, fcount)
+    per_row, old_count = _timed(_sync_match_per_row, session, sync_id, host_id)
+    expected = _matches(session)
+    session.execute(HostFile.__table__.update().values(cmp_id=None,
+        cmp_ver=None))
+    session.commit()
+    set_based, count = _timed(views.sync_match, session, sync_id, host_id)
+    print('%s files: per row %.3fs, set based %.3fs' % (
+        fcount, per_row, set_based))
+    unmatched = (fcount + 6) // 7
+    assert count == old_count == fcount - unmatched
+    assert _matches(session) == expected
+    assert session.query(HostFile).filter(
+        HostFile.cmp_id == None).count() == unmatched
+    assert per_row > set_based * min_speedup
+
+if __name__ == '__main__':
+    for fcount in (5000, 50000, 500000):
+        test_can_sync_match(fcount)
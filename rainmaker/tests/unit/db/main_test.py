@@ -1,8 +1,14 @@
+import os
+
+from sqlalchemy.orm import sessionmaker
+
 from rainmaker.tests import test_helper, factory_helper
 from rainmaker.main import Application
 from rainmaker.db.main import init_db, HostFile, SyncFile, Sync, \
-        Host, Resolution, Download
-from rainmaker.db import main
+        Host, Resolution, Download, DirDigest
+from rainmaker.db import main, views
+from rainmaker.net.events import Event
+from rainmaker.sync_manager import actions
 fh = factory_helper
 
 def test_db_init():
@@ -76,3 +82,85 @@ def test_lazy_loading():
     assert r.download is not None
 
 
+
+def test_migrate_seeds_dir_digests():
+    test_helper.clean_temp_dir()
+    path = os.path.join(test_helper.user_dir, 'old.db')
+    def _replica(db):
+        sync = fh.Sync(fake=True)
+        db.add(sync)
+        for rel_path in ['a', 'd/b', 'd/e/c']:
+            sync.sync_files.append(SyncFile(rel_path=rel_path, file_hash=1,
+                file_size=1, is_dir=False, does_exist=True))
+        db.commit()
+        return sync
+    db = init_db(path)
+    sync_id = _replica(db).id
+    # a database from before the digests table
+    db.execute('DROP TABLE dir_digests')
+    db.commit()
+    db.close()
+    db = init_db(path)
+    sync = db.query(Sync).get(sync_id)
+    db2 = init_db()
+    sync2 = _replica(db2)
+    def _digests(db, sync_id):
+        return sorted((d.path, d.digest, d.files_digest, d.file_count) 
+            for d in db.query(DirDigest).filter(DirDigest.sync_id == sync_id))
+    assert _digests(db, sync.id) == _digests(db2, sync2.id)
+    # replicas from before and after the upgrade reconcile as equal
+    host = fh.Host(sync, 1)
+    db.commit()
+    sent, result = [], []
+    def _fake_send(cmd, params=None, reply=None):
+        sent.append(sorted(params['dirs']))
+        reply(Event(cmd, {'dirs': views.compare_dirs(db2, sync2.id, 
+            params['dirs'], main.file_params)}))
+    actions.reconcile_with_host(db, host, _fake_send, result.extend)
+    assert (sent, result) == ([['']], [])
+
+def test_migrate_copies_version_logs():
+    test_helper.clean_temp_dir()
+    path = os.path.join(test_helper.user_dir, 'old.db')
+    db = init_db(path)
+    sync = fh.Sync(fake=True)
+    db.add(sync)
+    moved = SyncFile(rel_path='a', file_hash=1, file_size=1, is_dir=False,
+        does_exist=True)
+    legacy = SyncFile(rel_path='b', file_hash=1, file_size=1, is_dir=False,
+        does_exist=True)
+    sync.sync_files.extend([moved, legacy])
+    db.commit()
+    for rel_path in ['c', 'd']:
+        db.refresh(moved)
+        moved.rel_path = rel_path
+        db.commit()
+    legacy.ver_data = '[{"version": 1, "file_size": 3}, ' \
+        '{"version": 0, "rel_path": "e", "file_size": 2}]'
+    db.commit()
+    ids = moved.id, legacy.id
+    # a database from before the file_versions table
+    db.execute('DROP TABLE file_versions')
+    db.commit()
+    db.close()
+    db = init_db(path)
+    moved, legacy = [db.query(SyncFile).get(i) for i in ids]
+    assert [(v.version, v.rel_path) for v in moved.versions] == \
+        [(0, 'a'), (1, 'c')]
+    assert moved.get_version(1).rel_path == 'c'
+    assert [(v.version, v.rel_path, v.file_size) for v in legacy.versions] \
+        == [(0, 'e', 2), (1, 'b', 3)]
+    # nothing is copied twice
+    db.close()
+    db = init_db(path)
+    assert db.query(main.FileVersion).count() == 4
+
+def test_new_session_from_sessionmaker_or_session():
+    db = init_db()
+    DbConn = sessionmaker(bind=db.get_bind())
+    for conn in [DbConn, db]:
+        session = main.new_session(conn)
+        assert session is not conn
+        assert session.get_bind() is db.get_bind()
+        assert session.query(Sync).count() == 0
+        session.close()
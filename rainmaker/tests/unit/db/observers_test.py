@@ -1,7 +1,9 @@
 import rainmaker.tests.factory_helper as fh
 
-from rainmaker.db.main import init_db, SyncFile, Download, Resolution
+from rainmaker.db.main import init_db, SyncFile, FileVersion, SyncChange, \
+        Download, Resolution
 from rainmaker.db import observers
+from rainmaker.file_system import hash_chunk
 
 
 
@@ -44,7 +46,7 @@ def test_sync_file_update_observer():
     assert len(sync_file.vers) == 0
 
     # Create version by altering serialized attribute of record
-    sync_file.file_parts.put(0, 1234, 'test')
+    sync_file.file_parts.put(0, 1234, hash_chunk(b'test', sync_file.file_parts.algo))
     assert sync_file.file_parts.changed == True
     db.add(sync_file)
     db.commit()
@@ -55,7 +57,7 @@ def test_sync_file_update_observer():
     assert len(sync_file.vers) == 1
     
     # Assert change saved to file_part
-    assert sync_file.file_parts.get(0) == [1234, 'test']
+    assert sync_file.file_parts.get_adler(0) == 1234
 
     # Create version by altering attribute of record
     sync_file.file_hash = 'defgh'
@@ -70,3 +72,57 @@ def test_sync_file_update_observer():
     #print('vlen', len(sync_file.vers))
     assert len(sync_file.vers) == 2
 
+
+def test_sync_file_versions_are_indexed_rows():
+    db = init_db()
+    sync = fh.Sync(fake=True)
+    fh.SyncFile(sync, 1, fake=True, is_dir=False)
+    db.add(sync)
+    db.commit()
+    first_path = db.query(SyncFile).first().rel_path
+    for path in ['b', 'c']:
+        sync_file = db.query(SyncFile).first()
+        sync_file.rel_path = path
+        db.commit()
+    sync_file = db.query(SyncFile).first()
+    assert db.query(FileVersion).count() == 2
+    ver = sync_file.get_version(1)
+    assert ver.id == sync_file.id
+    assert ver.rel_path == 'b'
+    assert sync_file.get_version(2) is None
+    assert [v.rel_path for v in sync_file.vers] == [first_path, 'b']
+
+def test_sync_file_saves_are_journaled():
+    db = init_db()
+    sync = fh.Sync(fake=True)
+    fh.SyncFile(sync, 2, fake=True, is_dir=False)
+    db.add(sync)
+    db.commit()
+    sync_file = db.query(SyncFile).first()
+    sync_file.file_hash = 'defgh'
+    db.commit()
+    changes = db.query(SyncChange).order_by(SyncChange.seq).all()
+    assert len(changes) == 3
+    assert [c.seq for c in changes] == [1, 2, 3]
+    assert all(c.sync_id == sync.id for c in changes)
+    assert (changes[-1].sync_file_id, changes[-1].version) == \
+        (sync_file.id, sync_file.version)
+
+def test_scan_bookkeeping_makes_no_version():
+    db = init_db()
+    sync = fh.Sync(fake=True)
+    fh.SyncFile(sync, 1, fake=True, is_dir=False)
+    db.add(sync)
+    db.commit()
+    sync_file = db.query(SyncFile).first()
+    sync_file.stime_start = sync_file.stime_start + 10
+    sync_file.stime = sync_file.stime_start + 1
+    sync_file.file_size = sync_file.file_size
+    db.commit()
+    assert sync_file.version == 0
+    assert db.query(FileVersion).count() == 0
+    assert db.query(SyncChange).count() == 1
+    sync_file.does_exist = False
+    db.commit()
+    assert sync_file.version == 1
+    assert db.query(SyncChange).count() == 2
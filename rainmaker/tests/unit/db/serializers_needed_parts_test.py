@@ -1,9 +1,10 @@
+import zlib
 import ujson
 from rainmaker.db.serializers import NeededParts, NeededPiece, FileParts
 from rainmaker.file_system import hash_chunk
 
 def gen_piece_args(chunk=b''):
-    return [hash_chunk(chunk), '', 0, len(chunk), False]
+    return [hash_chunk(chunk), zlib.adler32(chunk), 0, len(chunk), False]
 
 def test_needed_parts_can_load():
     # Setup
@@ -67,3 +68,19 @@ def test_can_import_from_file_parts():
     np = NeededParts.from_file_parts(fp)
     assert len(np.data) == 0
 
+
+def test_needed_parts_binary_round_trip_keeps_done_flags():
+    fp = FileParts()
+    chunks = [str(i).encode()*10 for i in range(11)]
+    for pos, chunk in enumerate(chunks):
+        fp.put(pos, zlib.adler32(chunk), hash_chunk(chunk, fp.algo), len(chunk))
+    np = NeededParts.from_file_parts(fp)
+    for pos in [0, 3, 10]:
+        assert list(np.yield_chunk(pos, chunks[pos])) == [None]
+    loaded = NeededParts(np.dump())
+    assert loaded.parts_count == 11
+    assert loaded.algo == fp.algo
+    assert [loaded[i].pdone for i in range(11)] == \
+        [i in (0, 3, 10) for i in range(11)]
+    assert loaded.complete == False
+    assert loaded[3].pmd5 == hash_chunk(chunks[3], fp.algo)
@@ -1,24 +1,56 @@
+import ujson
 from nose.tools import assert_raises
 
-from rainmaker.db.serializers import FileParts, NeededParts
+from rainmaker.db.serializers import FileParts, NeededParts, Versions
 from rainmaker.tests.factory_helper import Sync, Host, HostFile 
-from rainmaker.db.main import init_db
+from rainmaker.db.main import init_db, SyncFile
+from rainmaker import file_system
+from rainmaker.file_system import hash_chunk
 
 def test_file_parts_can_put_get_dump_load():
     fp = FileParts()
-    fp.put(0, 12345, 67890)
+    pmd5 = hash_chunk(b'', fp.algo)
+    fp.put(0, 12345, pmd5)
     assert fp.get_adler(0) == 12345
     assert fp.get_adler(1) == None 
     assert_raises(IndexError, fp.put, 3, 123, 456)
-    fp.put(1, 12345, 67890)
-    fp.put(2, 123456, 67890)
+    fp.put(1, 12345, pmd5)
+    fp.put(2, 123456, pmd5)
     assert fp.get_adler(2) == 123456
-    fp.put(0, 12345, 67890)
+    fp.put(0, 12345, pmd5)
     assert fp.get_adler(2) == None
     assert_raises(IndexError, fp.put, 2, 12345, 456)
     assert fp.data == FileParts(data=fp.dump()).data
     assert len(fp.data) == 1
     
+def test_file_parts_load_legacy_md5_format():
+    legacy = ujson.dumps([[hash_chunk(b'abc'), 12345, 0, 3]])
+    fp = FileParts(data=legacy)
+    assert fp.algo == 'md5'
+    assert fp.get_adler(0) == 12345
+    # md5 parts are dumped in the legacy format
+    assert ujson.loads(fp.dump_json()) == ujson.loads(legacy)
+
+def test_file_parts_dump_tags_format_and_algorithm():
+    fp = FileParts()
+    assert fp.algo == file_system.default_algo
+    fp.algo = 'blake2b'
+    fp.put(0, 12345, hash_chunk(b'abc', 'blake2b'), 3)
+    data = ujson.loads(fp.dump_json())
+    assert data['v'] == FileParts.FORMAT_VERSION
+    assert data['algo'] == 'blake2b'
+    loaded = FileParts(data=fp.dump())
+    assert loaded.algo == 'blake2b'
+    assert loaded.data == fp.data
+    np = NeededParts.from_file_parts(loaded)
+    assert np.algo == 'blake2b'
+    assert list(np.yield_chunk(0, b'abc')) == [None]
+    assert np.complete == True
+
+def test_file_parts_reject_unknown_algorithm():
+    data = ujson.dumps({'v': 2, 'algo': 'nope', 'parts': []})
+    assert_raises(ValueError, FileParts, data)
+
 def test_needed_parts_can_copy_host_file():
     # Setup
     sync = Sync(fake=True)
@@ -62,3 +94,56 @@ def test_empty_needed_parts_is_complete():
     assert np.parts_count == 0
     assert np.complete == True    
 
+
+def test_file_parts_binary_format_is_compact_and_indexed():
+    fp = FileParts()
+    pmd5 = hash_chunk(b'', fp.algo)
+    for pos in range(1000):
+        fp.put(pos, pos, pmd5)
+    blob = fp.dump()
+    assert isinstance(blob, bytes)
+    loaded = FileParts(data=blob)
+    assert len(loaded.data) == 1000
+    assert loaded.get_adler(999) == 999
+    assert loaded[500].pmd5 == pmd5
+    assert loaded[500].poffset == 500*FileParts.chunk_size
+    # fixed width records with raw digests
+    assert len(blob) - len(FileParts().dump()) == 1000*(16 + fp.data.digest_size)
+    assert len(blob) < len(fp.dump_json())
+    # json rows still load
+    assert FileParts(data=fp.dump_json()).data == loaded.data
+
+
+def test_file_parts_reject_unknown_binary_versions():
+    fp = FileParts()
+    fp.put(0, 1, hash_chunk(b'x', fp.algo))
+    blob = bytearray(fp.dump())
+    blob[4] = 3
+    with assert_raises(ValueError):
+        FileParts(data=bytes(blob))
+
+
+def _versions(data=None, limit=None):
+    return Versions(SyncFile, data=data, sort=lambda v: v.version,
+        on_change=None, limit=limit)
+
+def test_versions_append_log_is_lazy_and_capped():
+    vers = _versions(limit=3)
+    for v in range(5):
+        vers.add({'version': v, 'file_size': v*10})
+    data = vers.dump()
+    assert data.count('\n') == 3
+    loaded = _versions(data, limit=3)
+    assert len(loaded) == 3
+    assert loaded._objects is None
+    assert [v.version for v in loaded] == [2, 3, 4]
+    loaded.add({'version': 5})
+    assert [v.version for v in loaded] == [3, 4, 5]
+
+def test_versions_load_legacy_json_list():
+    data = ujson.dumps([{'version': 1}, {'version': 0, 'file_size': 5}])
+    vers = _versions(data)
+    assert len(vers) == 2
+    assert vers[0].file_size == 5
+    vers.add({'version': 2})
+    assert _versions(vers.dump())[2].version == 2
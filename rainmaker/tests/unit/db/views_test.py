@@ -1,7 +1,15 @@
+import os
+
+from sqlalchemy import inspect
+from sqlalchemy.sql import text
+
 from rainmaker.tests import test_helper
 from rainmaker.tests import factory_helper
 from rainmaker.db import views
-from rainmaker.db.main import init_db, Host, HostFile
+from rainmaker.db.serializers import Versions
+from rainmaker import file_system
+from rainmaker.db.main import init_db, Host, HostFile, SyncFile, DirDigest, \
+    FileVersion
 
 def test_can_diff_empty():
     session = init_db()
@@ -90,7 +98,8 @@ def test_can_sync_match(fcount=50):
         host.host_files.append(hf)
     session.add(host)
     session.commit()
-    views.sync_match(session, local.id, host.id)
+    assert views.sync_match(session, local.id, host.id) == fcount
+    assert views.sync_match(session, local.id, host.id) == 0
     host_files = session.query(HostFile).all()
     assert len(host_files) == fcount
     for f in host_files:
@@ -108,3 +117,233 @@ def test_find_last_changed():
     result = views.host_last_changed(db, 1)
     assert result > 0
 
+def test_hosts_agree_on_hash_algo():
+    db = init_db()
+    sync = factory_helper.Sync(fake=True)
+    host1 = Host(sync=sync, pubkey='a')
+    host2 = Host(sync=sync, pubkey='b')
+    db.add_all([sync, host1, host2])
+    db.commit()
+    preferred = file_system.preferred_algos
+    file_system.preferred_algos = ['sha1']
+    try:
+        assert views.put_host_hash_algos(db, sync.id, 'a', ['sha1']) == 'md5'
+        assert views.put_host_hash_algos(db, sync.id, 'b', ['md5', 'sha1']) \
+            == 'sha1'
+        assert sync.hash_algo == 'sha1'
+        assert views.put_host_hash_algos(db, sync.id, 'c', ['sha1']) is None
+        # a host without algos falls back to md5
+        assert views.put_host_hash_algos(db, sync.id, 'b', None) == 'md5'
+    finally:
+        file_system.preferred_algos = preferred
+
+
+
+def _query_plan(session, query):
+    params = dict(t1_id=1, t2_id=1, last_path='', last_id=0, limit=1,
+        sync_id=1, path='d', sep='/', sep_end='0')
+    rows = session.execute(text('EXPLAIN QUERY PLAN ' + query), params)
+    return [row[-1] for row in rows]
+
+def test_sync_diff_joins_on_covering_indexes():
+    session = init_db()
+    for query, index in [
+            (views.q_diff_sync, 'ix_host_files_diff'),
+            (views.q_diff_host, 'ix_sync_files_diff'),
+            (views.q_diff_sync_page, 'ix_host_files_diff'),
+            (views.q_diff_host_page, 'ix_sync_files_diff')]:
+        plan = _query_plan(session, query)
+        assert 'SEARCH t2 USING COVERING INDEX %s' % index in plan[1], plan
+        assert not any(p.startswith('SCAN') for p in plan), plan
+    # pages seek to last position
+    assert 'rel_path>?' in _query_plan(session, views.q_diff_sync_page)[0]
+
+def test_init_db_adds_missing_indexes():
+    test_helper.clean_temp_dir()
+    path = os.path.join(test_helper.user_dir, 'old.db')
+    session = init_db(path)
+    session.execute('DROP INDEX ix_host_files_diff')
+    session.execute('ALTER TABLE hosts DROP COLUMN last_seq')
+    session.commit()
+    session.close()
+    session = init_db(path)
+    indexes = inspect(session.get_bind()).get_indexes('host_files')
+    assert 'ix_host_files_diff' in [i['name'] for i in indexes]
+    columns = inspect(session.get_bind()).get_columns('hosts')
+    assert 'last_seq' in [c['name'] for c in columns]
+
+def test_sync_changes_resume_after_seq():
+    db = init_db()
+    sync = factory_helper.Sync(fake=True)
+    factory_helper.SyncFile(sync, 5, fake=True, is_dir=False)
+    db.add(sync)
+    db.commit()
+    assert views.sync_last_seq(db, sync.id) == 5
+    for sync_file in db.query(SyncFile).limit(2):
+        sync_file.file_size += 1
+    db.commit()
+    last = views.sync_last_seq(db, sync.id)
+    assert last == 7
+    files, seq = views.sync_changes(db, sync.id, 0, limit=3)
+    assert (len(files), seq) == (3, 3)
+    files, seq = views.sync_changes(db, sync.id, seq, limit=3, until=6)
+    assert (len(files), seq) == (3, 6)
+    files, seq = views.sync_changes(db, sync.id, seq)
+    assert seq == 7
+    assert [f.version for f in files] == [1]
+    # files changed twice are sent once per page
+    files, seq = views.sync_changes(db, sync.id, 0)
+    assert (len(files), seq) == (5, 7)
+    assert views.sync_changes(db, sync.id, seq) == ([], 7)
+    assert views.sync_changes(db, sync.id + 1, 0) == ([], 0)
+
+def _tree(db, paths):
+    ''' sync with a file at each path '''
+    sync = factory_helper.Sync(fake=True)
+    db.add(sync)
+    db.commit()
+    for path in paths:
+        db.add(SyncFile(sync_id=sync.id, rel_path=path, file_hash=len(path),
+            file_size=len(path), is_dir=False, does_exist=True))
+    db.commit()
+    return sync
+
+def _digests(db, sync_id):
+    return sorted((d.path, d.parent, d.digest, d.files_digest, d.file_count)
+        for d in db.query(DirDigest).filter(DirDigest.sync_id == sync_id))
+
+def test_dir_digests_update_incrementally():
+    db = init_db()
+    sync = _tree(db, ['a', 'd/b', 'd/e/c', 'd/e/f', 'g/h'])
+    root = views.get_dir_digests(db, sync.id, [''])['']
+    assert root.file_count == 5
+    assert views.child_dir_digests(db, sync.id, ['', 'd']) == {
+        '': {'d': views.get_dir_digests(db, sync.id, ['d'])['d'].digest,
+            'g': views.get_dir_digests(db, sync.id, ['g'])['g'].digest},
+        'd': {'d/e': views.get_dir_digests(db, sync.id, ['d/e'])['d/e'].digest}}
+    assert [f.rel_path for f in views.dir_files(db, sync.id, 'd')] == ['d/b']
+    assert [f.rel_path for f in views.dir_files(db, sync.id, '')] == ['a']
+    # change, move and delete
+    sync_file = db.query(SyncFile).filter(SyncFile.rel_path == 'd/e/c').one()
+    sync_file.file_size = 99
+    db.query(SyncFile).filter(SyncFile.rel_path == 'd/b').one().rel_path = 'x'
+    db.delete(db.query(SyncFile).filter(SyncFile.rel_path == 'g/h').one())
+    db.commit()
+    incremental = _digests(db, sync.id)
+    assert 'g' not in [d[0] for d in incremental]
+    assert incremental != []
+    views.rebuild_dir_digests(db, sync.id)
+    db.commit()
+    assert _digests(db, sync.id) == incremental
+    # same tree, same root
+    other = _tree(db, ['a', 'x', 'd/e/c', 'd/e/f'])
+    assert views.get_dir_digests(db, other.id, [''])[''].digest != root.digest
+    for path, (file_hash, size) in {'d/e/c': (5, 99), 'x': (3, 3)}.items():
+        sync_file = db.query(SyncFile).filter(SyncFile.sync_id == other.id,
+            SyncFile.rel_path == path).one()
+        sync_file.file_hash, sync_file.file_size = file_hash, size
+    db.commit()
+    assert _digests(db, other.id) == incremental
+
+def test_move_subtree_renames_in_range():
+    db = init_db()
+    sync = _tree(db, ['d/a', 'd/e/b', 'da', 'x'])
+    db.add(SyncFile(sync_id=sync.id, rel_path='d', is_dir=True, 
+        does_exist=True))
+    db.commit()
+    seq = views.sync_last_seq(db, sync.id)
+    assert views.move_subtree(db, sync.id, 'd', 'x') is None
+    assert views.move_subtree(db, sync.id, 'd', 'm/n') == 3
+    db.commit()
+    files = {f.rel_path: f for f in db.query(SyncFile)}
+    assert sorted(files) == ['da', 'm/n', 'm/n/a', 'm/n/e/b', 'x']
+    moved = files['m/n/e/b']
+    assert moved.version == 1
+    assert [v.rel_path for v in moved.ver_log] == ['d/e/b']
+    assert moved.ver_log[0].does_exist is True
+    assert moved.get_version(0).rel_path == 'd/e/b'
+    assert views.sync_changes(db, sync.id, seq)[1] == seq + 3
+    incremental = _digests(db, sync.id)
+    views.rebuild_dir_digests(db, sync.id)
+    assert _digests(db, sync.id) == incremental
+    # subtree reads are index range scans
+    plan = _query_plan(db, 'SELECT 1 FROM sync_files WHERE %s' % 
+        views.q_subtree)
+    assert 'USING COVERING INDEX ix_sync_files_diff' in ' '.join(plan), plan
+    assert views.delete_subtree(db, sync.id, 'm/n/e') == 1
+    assert views.delete_subtree(db, sync.id, 'm/n/e') == 0
+    db.commit()
+    assert [f.does_exist for f in db.query(SyncFile).filter(
+        SyncFile.rel_path.like('m/%')).order_by(SyncFile.rel_path)] == \
+            [True, True, False]
+    incremental = _digests(db, sync.id)
+    views.rebuild_dir_digests(db, sync.id)
+    assert _digests(db, sync.id) == incremental
+
+def test_subtree_moves_cap_the_version_log():
+    db = init_db()
+    sync = _tree(db, ['d/a'])
+    sync_file = db.query(SyncFile).filter(SyncFile.rel_path == 'd/a').one()
+    # a legacy json list is converted
+    sync_file.ver_data = '[{"version": -1}, {"version": -2}]'
+    db.commit()
+    views.move_subtree(db, sync.id, 'd', 'e')
+    db.commit()
+    db.expire_all()
+    assert [v.version for v in sync_file.ver_log] == [-2, -1, 0]
+    limit = Versions.limit
+    Versions.limit = 3
+    try:
+        for i in range(1, 5):
+            views.move_subtree(db, sync.id, 'd' if i % 2 == 0 else 'e', 
+                'e' if i % 2 == 0 else 'd')
+        db.commit()
+    finally:
+        Versions.limit = limit
+    # ver_log is cached on the loaded row
+    db.expunge_all()
+    sync_file = db.query(SyncFile).filter(SyncFile.rel_path == 'e/a').one()
+    assert sync_file.ver_data.count('\n') == 3
+    assert [v.rel_path for v in sync_file.ver_log] == ['d/a', 'e/a', 'd/a']
+
+def test_subtree_moves_keep_as_many_versions_as_file_saves():
+    db = init_db()
+    sync = _tree(db, ['d/a', 'f'])
+    limit = Versions.limit
+    Versions.limit = 3
+    try:
+        for i in range(5):
+            views.move_subtree(db, sync.id, 'd' if i % 2 == 0 else 'e', 
+                'e' if i % 2 == 0 else 'd')
+            sync_file = db.query(SyncFile).filter(
+                SyncFile.rel_path == ('f' if i % 2 == 0 else 'g')).one()
+            sync_file.rel_path = 'g' if i % 2 == 0 else 'f'
+            db.commit()
+    finally:
+        Versions.limit = limit
+    def _versions(rel_path):
+        sync_file = db.query(SyncFile).filter(
+            SyncFile.rel_path == rel_path).one()
+        return sorted(v.version for v in db.query(FileVersion).filter(
+            FileVersion.sync_file_id == sync_file.id))
+    assert _versions('e/a') == _versions('g') == [2, 3, 4]
+
+def test_delete_subtree_only_touches_rows_it_deletes():
+    db = init_db()
+    sync = _tree(db, ['d/a', 'd/b'])
+    gone = db.query(SyncFile).filter(SyncFile.rel_path == 'd/b').one()
+    gone.does_exist = False
+    db.commit()
+    seq = views.sync_last_seq(db, sync.id)
+    # deleted earlier in the same millisecond
+    db.execute(text('UPDATE sync_files SET updated_at = 5'))
+    time_now = views.utils.time_now
+    views.utils.time_now = lambda: 5
+    try:
+        assert views.delete_subtree(db, sync.id, 'd') == 1
+    finally:
+        views.utils.time_now = time_now
+    db.commit()
+    changes, _ = views.sync_changes(db, sync.id, seq)
+    assert [f.rel_path for f in changes] == ['d/a']
+    assert [v.version for v in gone.vers] == [0]
@@ -0,0 +1,148 @@
+import os
+import zlib
+
+from rainmaker.db.main import SyncFile
+from rainmaker.db.serializers import FileParts
+from rainmaker.file_system import hash_file, rehash_file, adler32_combine, HashPool
+from rainmaker.tests import factory_helper
+from rainmaker import file_system
+from rainmaker.file_system import hash_chunk
+
+def _sync_files(count=5):
+    sync = factory_helper.Sync()
+    factory_helper.Files(sync.path, count)
+    sync_files = []
+    for name in sorted(os.listdir(sync.path)):
+        sync_file = SyncFile(rel_path=name)
+        sync_file.sync = sync
+        sync_files.append(sync_file)
+    return sync_files
+
+def _parts(sync_file):
+    return [p.dump() for p in sync_file.file_parts.data]
+
+def test_adler32_combine_matches_running_adler():
+    data1, data2 = b'abc'*1000, b'xyz'*7777
+    combined = adler32_combine(zlib.adler32(data1), zlib.adler32(data2), len(data2))
+    assert combined == zlib.adler32(data1 + data2)
+    assert adler32_combine(1, zlib.adler32(data2), len(data2)) == zlib.adler32(data2)
+
+def test_hash_pool_matches_hash_file():
+    serial = _sync_files()
+    expected = [hash_file(sf) for sf in serial]
+    parallel = [SyncFile(rel_path=sf.rel_path) for sf in serial]
+    for sf in parallel:
+        sf.sync = serial[0].sync
+    with HashPool(workers=3, max_bytes=1) as pool:
+        results = pool.hash_files(parallel)
+    assert results == expected
+    for s, p in zip(serial, parallel):
+        assert _parts(s) == _parts(p)
+        assert len(p.file_parts) > 0
+
+def test_hash_file_mmap_matches_read():
+    sync = factory_helper.Sync()
+    path = os.path.join(sync.path, 'big')
+    with open(path, 'wb') as f:
+        f.write(os.urandom(int(FileParts.chunk_size*3.5)))
+    results = []
+    for use_mmap in [False, True]:
+        sync_file = SyncFile(rel_path='big')
+        sync_file.sync = sync
+        results.append((hash_file(sync_file, use_mmap=use_mmap), _parts(sync_file)))
+    assert results[0] == results[1]
+    assert len(results[1][1]) == 4
+
+def test_rehash_file_only_hashes_appended_data():
+    sync = factory_helper.Sync()
+    path = os.path.join(sync.path, 'log')
+    chunk_size = FileParts.chunk_size
+    with open(path, 'wb') as f:
+        f.write(os.urandom(int(chunk_size*10.5)))
+    sync_file = SyncFile(rel_path='log')
+    sync_file.sync = sync
+    adler, scan_len, bytes_hashed = rehash_file(sync_file)
+    assert bytes_hashed == scan_len
+    with open(path, 'ab') as f:
+        f.write(os.urandom(chunk_size))
+    adler, scan_len, bytes_hashed = rehash_file(sync_file)
+    # the tail from the partial chunk
+    assert bytes_hashed == int(chunk_size*1.5)
+    # same result as a fresh full hash
+    fresh = SyncFile(rel_path='log')
+    fresh.sync = sync
+    assert hash_file(fresh) == (adler, scan_len)
+    assert _parts(fresh) == _parts(sync_file)
+
+def test_rehash_file_finds_edits_anywhere_in_the_prefix():
+    sync = factory_helper.Sync()
+    path = os.path.join(sync.path, 'vm')
+    chunk_size = FileParts.chunk_size
+    with open(path, 'wb') as f:
+        f.write(os.urandom(chunk_size*10))
+    sync_file = SyncFile(rel_path='vm')
+    sync_file.sync = sync
+    rehash_file(sync_file)
+    # edit a chunk no sample would hit, then grow
+    with open(path, 'r+b') as f:
+        f.seek(chunk_size*7 + 3)
+        f.write(b'changed')
+        f.seek(0, 2)
+        f.write(b'appended')
+    adler, scan_len, bytes_hashed = rehash_file(sync_file)
+    assert bytes_hashed == chunk_size*3 + len(b'appended')
+    fresh = SyncFile(rel_path='vm')
+    fresh.sync = sync
+    assert hash_file(fresh) == (adler, scan_len)
+    assert _parts(fresh) == _parts(sync_file)
+
+def test_rehash_file_falls_back_to_full_hash_on_change():
+    sync = factory_helper.Sync()
+    path = os.path.join(sync.path, 'db')
+    chunk_size = FileParts.chunk_size
+    with open(path, 'wb') as f:
+        f.write(os.urandom(chunk_size*4))
+    sync_file = SyncFile(rel_path='db')
+    sync_file.sync = sync
+    rehash_file(sync_file)
+    with open(path, 'r+b') as f:
+        f.write(b'changed')
+        f.seek(0, 2)
+        f.write(b'appended')
+    adler, scan_len, bytes_hashed = rehash_file(sync_file)
+    assert bytes_hashed == scan_len == chunk_size*4 + len(b'appended')
+
+def test_hash_algos_are_registered():
+    for algo in ['md5', 'sha1', 'blake2b', file_system.default_algo]:
+        assert algo in file_system.hash_algos
+    assert hash_chunk(b'abc') == hash_chunk(b'abc', 'md5')
+    assert hash_chunk(b'abc', 'blake2b') != hash_chunk(b'abc', 'md5')
+
+def test_full_hash_moves_parts_to_the_sync_algo():
+    sync_file = _sync_files(1)[0]
+    assert sync_file.file_parts.algo == 'md5'
+    sync_file.sync.hash_algo = 'sha1'
+    hash_file(sync_file)
+    assert sync_file.file_parts.algo == 'sha1'
+    for piece in sync_file.file_parts.data:
+        assert len(piece.pmd5) == 40
+
+def test_algo_is_md5_until_all_hosts_support_another():
+    preferred = file_system.preferred_algos
+    file_system.preferred_algos = ['sha1']
+    try:
+        negotiate = file_system.negotiate_algo
+        assert negotiate([]) == 'md5'
+        assert negotiate([['md5', 'sha1'], None]) == 'md5'
+        assert negotiate([['md5', 'sha1'], ['sha1']]) == 'sha1'
+    finally:
+        file_system.preferred_algos = preferred
+    assert file_system.default_algo == 'md5'
+
+def test_peers_agree_on_blake2b_without_xxhash():
+    # stock installs offer md5, sha1 and blake2b
+    algos = ['md5', 'sha1', 'blake2b']
+    assert file_system.negotiate_algo([algos, algos]) == 'blake2b'
+    assert file_system.negotiate_algo([algos, ['md5']]) == 'md5'
+    # xxh128 is preferred where both peers have xxhash
+    assert file_system.preferred_algos[-1] == 'blake2b'
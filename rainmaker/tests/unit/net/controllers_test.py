@@ -4,8 +4,10 @@ from rainmaker.db.main import init_db
 from rainmaker.tests.factory_helper import Sync, SyncFile
 from rainmaker.tox.tox_ring import ToxBot
 from rainmaker.net.errors import AuthError
+from rainmaker.net import controllers
 from rainmaker.net.controllers import tox_auth_controller, utils_controller, \
-        sync_files_controller, file_parts_controller
+        sync_files_controller, file_parts_controller, paginate_keyset
+from rainmaker.db.main import SyncFile as SyncFileModel
 
 class MockTox(ToxBot):
     ''' Tox Object '''
@@ -79,8 +81,9 @@ def test_sync_files_controller_can_list_and_get():
     def _recv_list(event):
         sync_files = event.val('sync_files')
         print(event)
-        if len(sync_files) > 0 and _recv_list.page < 10:
-            params = {'since': 0, 'page': _recv_list.page + 1}
+        cursor = event.val('cursor')
+        if cursor and _recv_list.page < 10:
+            params = {'since': 0, 'cursor': cursor}
             _recv_list.page += 1
             sim_send(tox1, tox2, 'list_sync_files', params, _recv_list)
 
@@ -99,6 +102,44 @@ def test_sync_files_controller_can_list_and_get():
     assert_raises(AuthError, sim_send, tox1, tox2, 'get_sync_file', {}, _recv_get)
     auto_auth(db, tox1, tox2)
     sim_send(tox1, tox2, 'list_sync_files', {}, _recv_list)
-    assert _recv_list.page == 5
+    # 5 full pages, then an empty last page
+    assert _recv_list.page == 6
 
 
+
+def test_paginate_keyset_follows_cursor():
+    db = init_db()
+    sync = Sync(fake=True)
+    SyncFile(sync, 450, fake=True, is_dir=False)
+    db.add(sync)
+    db.commit()
+    q = db.query(SyncFileModel)
+    seen, sizes, cursor = [], [], None
+    while True:
+        rows, cursor = paginate_keyset(q, SyncFileModel, cursor, ['id'], 200)
+        sizes.append(len(rows))
+        seen += [r['id'] for r in rows]
+        if cursor is None:
+            break
+        # rows changed mid walk move to the end, none are skipped
+        db.query(SyncFileModel).filter(SyncFileModel.id == seen[0]).update(
+            {'file_size': 1})
+    assert sizes == [200, 200, 51]
+    assert len(set(seen)) == 450
+    assert seen[-1] == seen[0]
+
+def test_paginate_keyset_caps_page_bytes():
+    db = init_db()
+    sync = Sync(fake=True)
+    SyncFile(sync, 20, fake=True, is_dir=False)
+    db.add(sync)
+    db.commit()
+    max_page_bytes = controllers.max_page_bytes
+    controllers.max_page_bytes = 100
+    try:
+        rows, cursor = paginate_keyset(db.query(SyncFileModel), SyncFileModel,
+            attrs=['id', 'rel_path'], size=20)
+    finally:
+        controllers.max_page_bytes = max_page_bytes
+    assert 0 < len(rows) < 20
+    assert cursor is not None
@@ -1,9 +1,10 @@
 
-from rainmaker.db import main
+from rainmaker.db import main, views
+from rainmaker.net.events import Event
 from rainmaker.net.controllers import sync_files_controller
 from rainmaker.sync_manager import actions
 from rainmaker.tox.tox_ring import ToxBot
-from rainmaker.tests.factory_helper import SyncRand, Host
+from rainmaker.tests.factory_helper import Sync, SyncRand, Host
 
 def startup():
     db = main.init_db()
@@ -38,3 +39,168 @@ def test_action_sync_with_host_sends_records_and_resolves():
     assert db.query(main.Resolution).count() == hf1count * 2
 
 
+
+def test_recv_sync_files_upserts_by_rid():
+    db, sync = startup()
+    host = sync.hosts[0]
+    def _page(start, count, file_size):
+        return [{'id': i, 'rel_path': 'f%s' % i, 'file_hash': i,
+            'file_size': file_size, 'does_exist': True, 'is_dir': False,
+            'version': 0, 'ver_data': None} for i in range(start, count)]
+    actions.recv_sync_files(db, host, _page(0, 300, 1))
+    db.query(main.HostFile).filter(main.HostFile.rid == 5).update(
+        {'cmp_id': 5, 'cmp_ver': 0})
+    db.commit()
+    actions.recv_sync_files(db, host, _page(200, 400, 2))
+    assert db.query(main.HostFile).count() == 400
+    hf = db.query(main.HostFile).filter(main.HostFile.rid == 250).one()
+    assert hf.host_id == host.id
+    assert hf.file_size == 2
+    # columns not sent are kept
+    hf = db.query(main.HostFile).filter(main.HostFile.rid == 5).one()
+    assert (hf.cmp_id, hf.file_size) == (5, 1)
+
+def _fake_host(db2, sync2, sent):
+    ''' send that answers from sync2's journal, replies are queued '''
+    queue = []
+    def _fake_send(cmd, params=None, reply=None):
+        sent.append(cmd)
+        if cmd == 'get_last_seq':
+            val = {'last_seq': views.sync_last_seq(db2, sync2.id)}
+        elif cmd == 'list_dir_digests':
+            val = {'dirs': views.compare_dirs(db2, sync2.id, params['dirs'],
+                main.file_params)}
+        else:
+            files, seq = views.sync_changes(db2, sync2.id, params['seq'],
+                params['page_size'], params['until'])
+            val = {'seq': seq, 'sync_files': 
+                [f.to_dict(*main.file_params) for f in files]}
+        queue.append((reply, Event(cmd, val)))
+    return _fake_send, queue
+
+def test_sync_with_host_resumes_from_last_seq():
+    db, sync = startup()
+    db2, sync2 = startup()
+    host = sync.hosts[0]
+    sent = []
+    send, queue = _fake_host(db2, sync2, sent)
+    actions.sync_page_size = 2
+    try:
+        actions.sync_with_host(db, host, send, window=1)
+        while queue:
+            reply, event = queue.pop(0)
+            reply(event)
+    finally:
+        actions.sync_page_size = 500
+    sf2count = db2.query(main.SyncFile).count()
+    assert db.query(main.HostFile).count() == sf2count
+    assert host.last_seq == sf2count
+    assert sent.count('list_changes') == (sf2count + 1) // 2
+    # nothing new, only ask for last seq
+    del sent[:]
+    actions.sync_with_host(db, host, send)
+    reply, event = queue.pop()
+    reply(event)
+    assert sent == ['get_last_seq']
+
+def test_sync_with_host_keeps_window_outstanding():
+    db, sync = startup()
+    db2, sync2 = startup()
+    host = sync.hosts[0]
+    sent = []
+    send, queue = _fake_host(db2, sync2, sent)
+    actions.sync_page_size = 1
+    try:
+        actions.sync_with_host(db, host, send, window=3)
+        reply, event = queue.pop()
+        reply(event)
+        assert sent.count('list_changes') == len(queue) == 3
+        # file changes after its range was read
+        sync_file = db2.query(main.SyncFile).order_by(main.SyncFile.id).first()
+        sync_file.file_size += 1
+        db2.commit()
+        # newest reply first, first range arrives last with the stale file
+        reply, event = queue.pop()
+        reply(event)
+        assert host.last_seq == 0
+        while queue:
+            assert len(queue) <= 3
+            reply, event = queue.pop()
+            reply(event)
+    finally:
+        actions.sync_page_size = 500
+    assert host.last_seq == views.sync_last_seq(db2, sync2.id)
+    assert db.query(main.HostFile).count() == \
+        db2.query(main.SyncFile).count()
+    hf = db.query(main.HostFile).filter(
+        main.HostFile.rid == sync_file.id).one()
+    assert (hf.file_size, hf.version) == (sync_file.file_size, 
+        sync_file.version)
+
+def test_reconcile_with_host_descends_into_changed_dirs():
+    paths = ['a', 'd/b', 'd/e/c', 'd/e/f', 'g/h', 'g/i/j']
+    def _replica():
+        db = main.init_db()
+        sync = Sync(fake=True)
+        Host(sync, 1)
+        db.add(sync)
+        for path in paths:
+            sync.sync_files.append(main.SyncFile(rel_path=path, file_hash=1,
+                file_size=1, is_dir=False, does_exist=True))
+        db.commit()
+        return db, sync
+    db, sync = _replica()
+    db2, sync2 = _replica()
+    changed = db2.query(main.SyncFile).filter(
+        main.SyncFile.rel_path == 'd/e/c').one()
+    changed.file_size = 2
+    db2.add(main.SyncFile(sync_id=sync2.id, rel_path='g/k', file_hash=1,
+        file_size=1, is_dir=False, does_exist=True))
+    db2.commit()
+    sent = []
+    def _fake_send(cmd, params=None, reply=None):
+        sent.append(sorted(params['dirs']))
+        reply(Event(cmd, {'dirs': views.compare_dirs(db2, sync2.id, 
+            params['dirs'], main.file_params)}))
+    result = []
+    actions.reconcile_with_host(db, sync.hosts[0], _fake_send, result.extend)
+    assert result == ['d/e/c', 'g/k']
+    # only differing directories are descended into
+    assert sent == [[''], ['d', 'g'], ['d/e']]
+    host_files = db.query(main.HostFile).order_by(main.HostFile.rel_path)
+    assert [(f.rel_path, f.file_size) for f in host_files] == \
+        [('d/e/c', 2), ('g/k', 1)]
+    # nothing differs
+    del sent[:], result[:]
+    actions.reconcile_with_host(db2, sync2.hosts[0], _fake_send, result.extend)
+    assert (sent, result) == ([['']], [])
+
+def test_catch_up_reconciles_instead_of_reading_the_journal():
+    def _replica():
+        db = main.init_db()
+        sync = Sync(fake=True)
+        Host(sync, 1)
+        db.add(sync)
+        for path in ['a', 'd/b', 'd/e/c']:
+            sync.sync_files.append(main.SyncFile(rel_path=path, file_hash=1,
+                file_size=1, is_dir=False, does_exist=True))
+        db.commit()
+        return db, sync
+    db, sync = _replica()
+    db2, sync2 = _replica()
+    changed = db2.query(main.SyncFile).filter(
+        main.SyncFile.rel_path == 'd/e/c').one()
+    changed.file_size = 2
+    db2.commit()
+    host = sync.hosts[0]
+    sent = []
+    send, queue = _fake_host(db2, sync2, sent)
+    actions.catch_up_with_host(db, host, send)
+    while queue:
+        reply, event = queue.pop(0)
+        reply(event)
+    assert sent == ['get_last_seq', 'list_dir_digests', 'list_dir_digests',
+        'list_dir_digests', 'get_last_seq']
+    assert host.last_seq == views.sync_last_seq(db2, sync2.id)
+    assert [f.rel_path for f in db.query(main.HostFile)] == ['d/e/c']
+    assert db.query(main.Resolution).count() > 0
@@ -1,8 +1,13 @@
+import os
 from time import sleep
+from sqlalchemy import event
+from watchdog.events import FileCreatedEvent
+
 from rainmaker.db.main import init_db, Sync, SyncFile
-from rainmaker.file_system import FsActions
-from rainmaker.sync_manager import fs_manager
-from rainmaker.tests import factory_helper
+from rainmaker.file_system import FsActions, HashPool
+from rainmaker.sync_manager import fs_manager, scan_manager
+from rainmaker.sync_manager.scan_manager import scan_sync_bulk
+from rainmaker.tests import factory_helper, test_helper
 
 fs = FsActions()
 
@@ -24,3 +29,166 @@ def test_can_watch_single_sync():
     sync_files = session.query(SyncFile).filter(SyncFile.sync_id == sync.id,
         SyncFile.does_exist == False).all()
     fs_manager.stop()
+
+def _coalesce(*events):
+    pending = {}
+    for event in events:
+        fs_manager.coalesce(pending, *event)
+    return pending
+
+def test_coalesce_collapses_events_by_path():
+    # create and modifies are one create
+    assert _coalesce(('created', 'a'), ('modified', 'a'), 
+        ('modified', 'a')) == {'a': {'op': 'create', 'is_dir': False}}
+    # create then delete cancels
+    assert _coalesce(('created', 'a'), ('modified', 'a'), 
+        ('deleted', 'a')) == {}
+    # move chains are one move
+    assert _coalesce(('moved', 'a', 'b'), ('moved', 'b', 'c'),
+        ('modified', 'c')) == {'c': {'op': 'move', 'src': 'a', 
+            'is_dir': False, 'modified': True}}
+    # moved back is nothing, created then moved is a create
+    assert _coalesce(('moved', 'a', 'b'), ('moved', 'b', 'a'),
+        ('created', 'x'), ('moved', 'x', 'y')) == {
+            'y': {'op': 'create', 'is_dir': False}}
+    # moved then deleted deletes src
+    assert _coalesce(('moved', 'a', 'b'), ('deleted', 'b'), 
+        ('modified', 'd', None, True)) == {
+            'a': {'op': 'delete', 'is_dir': False}}
+
+def test_apply_pending_writes_one_batch():
+    session = init_db()
+    sync = factory_helper.Sync(fake=True)
+    session.add(sync)
+    session.commit()
+    for path, is_dir in [('a', False), ('b', False), ('d', True), 
+            (os.path.join('d', 'e'), False)]:
+        session.add(SyncFile(sync_id=sync.id, rel_path=path, is_dir=is_dir,
+            does_exist=True, stime_start=1))
+    session.commit()
+    pending = _coalesce(('moved', 'a', 'x'), ('moved', 'x', 'y'), 
+        ('created', 'c'), ('modified', 'c'), ('modified', 'b'),
+        ('deleted', 'd', None, True))
+    fs_manager.apply_pending(session, sync, pending)
+    files = {f.rel_path: (f.does_exist, f.stime_start) 
+        for f in session.query(SyncFile)}
+    assert files == {'y': (True, 1), 'b': (True, 0), 'c': (True, 0),
+        'd': (False, 1), os.path.join('d', 'e'): (False, 1)}
+
+def test_worker_commits_batches_in_background():
+    # in memory databases are per thread
+    test_helper.clean_temp_dir()
+    session = init_db(os.path.join(test_helper.user_dir, 'watch.db'))
+    sync = factory_helper.Sync()
+    session.add(sync)
+    session.commit()
+    fs_manager.init()
+    batches = []
+    with HashPool(workers=2) as pool:
+        watch = fs_manager.SyncWatch(session, sync, window=0.1, 
+            hash_pool=pool)
+        watch.on_commit(batches.append)
+        watch.start(interval=0.05)
+        files = factory_helper.Files(sync.path, 3)
+        for x in range(100):
+            if batches:
+                break
+            sleep(0.05)
+        watch.stop()
+    fs_manager.stop()
+    stats = watch.stats()
+    assert (stats['queue_depth'], stats['pending'], stats['oldest_age']) \
+        == (0, 0, 0)
+    assert stats['events_per_sec'] > 0
+    rel_paths = sorted(sync.rel_path(f) for f in files)
+    assert sorted(set(p for b in batches for p in b)) == rel_paths
+    sync_files = session.query(SyncFile).filter(SyncFile.sync_id == sync.id)
+    assert sorted(f.rel_path for f in sync_files) == rel_paths
+    assert all(f.file_hash is not None and f.stime > 0 for f in sync_files)
+
+def test_apply_pending_moves_dirs_with_subtree():
+    session = init_db()
+    sync = factory_helper.Sync(fake=True)
+    session.add(sync)
+    session.commit()
+    join = os.path.join
+    for path, is_dir in [('d', True), (join('d', 'e'), False), 
+            (join('d', 'f'), False)]:
+        session.add(SyncFile(sync_id=sync.id, rel_path=path, is_dir=is_dir,
+            does_exist=True, stime_start=1))
+    session.commit()
+    # watchdog sends moves for everything below a moved directory
+    pending = _coalesce(('moved', 'd', 'm', True), 
+        ('moved', join('d', 'e'), join('m', 'e')),
+        ('moved', join('d', 'f'), join('m', 'f')), 
+        ('modified', join('m', 'f')))
+    fs_manager.apply_pending(session, sync, pending)
+    files = {f.rel_path: (f.does_exist, f.stime_start, f.version)
+        for f in session.query(SyncFile)}
+    # marking m/f for a rescan is not a new version
+    assert files == {'m': (True, 1, 1), join('m', 'e'): (True, 1, 1),
+        join('m', 'f'): (True, 0, 1)}
+
+def test_failed_commits_keep_changes_and_retry():
+    session = init_db()
+    sync = factory_helper.Sync()
+    session.add(sync)
+    session.commit()
+    fs_manager.init()
+    apply_pending = fs_manager.apply_pending
+    def _locked(*args):
+        raise Exception('database is locked')
+    try:
+        watch = fs_manager.SyncWatch(session, sync)
+        path = factory_helper.Files(sync.path, 1)
+        watch.dispatch(FileCreatedEvent(path))
+        fs_manager.apply_pending = _locked
+        watch._commit_safe(force=True)
+        watch._commit_safe(force=True)
+        assert watch.stats()['pending'] == 1
+        assert watch.stats()['failures'] == 2
+        fs_manager.apply_pending = apply_pending
+        # backing off
+        watch._commit_safe()
+        assert watch.stats()['pending'] == 1
+        watch._commit_safe(force=True)
+        assert watch.stats()['failures'] == 0
+        sync_file = session.query(SyncFile).filter(
+            SyncFile.rel_path == sync.rel_path(path)).one()
+        assert sync_file.file_hash is not None
+    finally:
+        fs_manager.apply_pending = apply_pending
+        fs_manager.stop()
+
+def test_rescans_only_write_what_changed():
+    session = init_db()
+    sync = factory_helper.Sync()
+    session.add(sync)
+    session.commit()
+    dirs = factory_helper.Dirs(sync.path, 2)
+    files = factory_helper.Files(dirs[0], 3) + factory_helper.Files(dirs[1], 3)
+    scan_sync_bulk(session, sync)
+    # eg. after an overflow
+    with open(files[0], 'a') as f:
+        f.write('changed')
+    added = factory_helper.Files(dirs[1], 1)
+    fs_manager.apply_pending(session, sync, 
+        {'': {'op': 'rescan', 'is_dir': True}})
+    marked = set(sf.rel_path for sf in session.query(SyncFile).filter(
+        SyncFile.stime_start == 0))
+    assert marked == set(sync.rel_path(f) for f in [files[0], added])
+    # hashed rows are written in batches
+    commits = []
+    def _committed(session):
+        commits.append(session)
+    event.listen(session, 'after_commit', _committed)
+    batch_size = scan_manager.batch_size
+    scan_manager.batch_size = 1
+    try:
+        fs_manager.refresh_sync(session, sync)
+    finally:
+        scan_manager.batch_size = batch_size
+        event.remove(session, 'after_commit', _committed)
+    assert len(commits) == 2
+    assert session.query(SyncFile).filter(SyncFile.stime_start == 0,
+        SyncFile.does_exist == True).count() == 0
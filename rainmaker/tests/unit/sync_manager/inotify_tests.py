@@ -0,0 +1,146 @@
+import os
+import struct
+from time import sleep
+
+from rainmaker.db.main import init_db, SyncFile
+from rainmaker.sync_manager import fs_manager, inotify
+from rainmaker.sync_manager.scan_manager import scan_sync_bulk
+from rainmaker.tests import factory_helper, test_helper
+
+class Recorder(object):
+    ''' handler that keeps what it is sent '''
+    def __init__(self):
+        self.events = []
+        self.rescans = []
+
+    def dispatch(self, event):
+        self.events.append((event.event_type, event.src_path,
+            getattr(event, 'dest_path', None) or None))
+
+    def rescan(self, path):
+        self.rescans.append(path)
+
+def _raw(wd, mask, cookie=0, name=''):
+    name = name.encode()
+    name += b'\0' * (16 - len(name))
+    return struct.pack('iIII', wd, mask, cookie, len(name)) + name
+
+def test_parse_and_pair_batched_events():
+    root = test_helper.user_dir
+    obs = inotify.InotifyObserver()
+    handler = Recorder()
+    obs.handlers.append((root, handler))
+    obs.paths[1], obs.wds[root] = root, 1
+    sub = os.path.join(root, 'sub')
+    obs.paths[2], obs.wds[sub] = sub, 2
+    obs.paths[3], obs.wds[os.path.join(sub, 'deep')] = \
+        os.path.join(sub, 'deep'), 3
+    data = _raw(1, inotify.IN_CREATE, name='a') + \
+        _raw(1, inotify.IN_MOVED_FROM, 7, 'a') + \
+        _raw(1, inotify.IN_MOVED_TO, 7, 'b') + \
+        _raw(1, inotify.IN_MOVED_FROM | inotify.IN_ISDIR, 8, 'sub') + \
+        _raw(1, inotify.IN_MOVED_TO | inotify.IN_ISDIR, 8, 'moved') + \
+        _raw(1, inotify.IN_MOVED_FROM, 9, 'c')
+    events = inotify.parse_events(data)
+    assert [e[3] for e in events] == ['a', 'a', 'b', 'sub', 'moved', 'c']
+    obs.handle(events)
+    join = os.path.join
+    assert handler.events == [('created', join(root, 'a'), None),
+        ('moved', join(root, 'a'), join(root, 'b')),
+        ('moved', sub, join(root, 'moved')),
+        ('deleted', join(root, 'c'), None)]
+    # watches follow the moved directory
+    assert obs.paths[3] == join(root, 'moved', 'deep')
+    # overflow rescans directories with recent events
+    obs.handle([(0, inotify.IN_Q_OVERFLOW, 0, '')])
+    assert handler.rescans == [root]
+    assert obs.stats()['overflows'] == 1
+    # every sync is rescanned in full once events go quiet
+    assert obs.stats()['stale'] == 1
+    obs._idle(obs.last_event)
+    assert handler.rescans == [root]
+    obs._idle(obs.last_event + inotify.overflow_window)
+    assert handler.rescans == [root, root]
+    assert obs.stats()['stale'] == 0
+    obs.join()
+
+def test_new_directories_are_rescanned():
+    test_helper.clean_temp_dir()
+    root = test_helper.user_dir
+    obs = inotify.InotifyObserver()
+    handler = Recorder()
+    obs.handlers.append((root, handler))
+    obs.add_watches([root])
+    # mkdir -p and a write land before the event is read
+    deep = os.path.join(root, 'a', 'b', 'c')
+    os.makedirs(deep)
+    factory_helper.Files(deep, 1)
+    obs.handle([(obs.wds[root], inotify.IN_CREATE | inotify.IN_ISDIR, 0, 
+        'a')])
+    assert handler.events == [('created', os.path.join(root, 'a'), None)]
+    assert handler.rescans == [os.path.join(root, 'a')]
+    assert deep in obs.wds
+    obs.join()
+
+def test_nested_mkdir_files_are_found():
+    test_helper.clean_temp_dir()
+    session = init_db(os.path.join(test_helper.user_dir, 'watch.db'))
+    sync = factory_helper.Sync()
+    session.add(sync)
+    session.commit()
+    fs_manager.init(backend='inotify')
+    try:
+        watch = fs_manager.SyncWatch(session, sync)
+        deep = os.path.join(sync.path, 'a', 'b', 'c')
+        os.makedirs(deep)
+        files = factory_helper.Files(deep, 3)
+        for x in range(50):
+            if watch.stats()['queue_depth'] >= 2:
+                break
+            sleep(0.05)
+        sleep(0.1)
+        watch.commit(force=True)
+        rel_paths = set(f.rel_path for f in session.query(SyncFile).filter(
+            SyncFile.does_exist))
+        assert set(sync.rel_path(f) for f in files) <= rel_paths
+        assert deep in fs_manager.observer.wds
+    finally:
+        fs_manager.stop()
+
+def test_lazy_watches_and_overflow_rescan():
+    # in memory databases are per thread
+    test_helper.clean_temp_dir()
+    session = init_db(os.path.join(test_helper.user_dir, 'watch.db'))
+    sync = factory_helper.Sync()
+    session.add(sync)
+    session.commit()
+    dirs = factory_helper.Dirs(sync.path, 2)
+    fs_manager.init(backend='inotify')
+    try:
+        watch = fs_manager.SyncWatch(session, sync, lazy=True)
+        assert fs_manager.observer.stats()['watches'] == 1
+        scan_sync_bulk(session, sync, on_dirs=watch.watch_dirs)
+        stats = fs_manager.observer.stats()
+        assert stats['watches'] == 3
+        assert stats['bytes_per_watch'] > inotify.kernel_watch_bytes
+        files = factory_helper.Files(dirs[0], 2)
+        for x in range(50):
+            if watch.stats()['queue_depth'] >= 2:
+                break
+            sleep(0.05)
+        watch.commit(force=True)
+        rel_paths = set(f.rel_path for f in session.query(SyncFile))
+        assert set(sync.rel_path(f) for f in files) <= rel_paths
+        # lost events are found by the rescan
+        fs_manager.observer.stop()
+        fs_manager.observer.join()
+        lost = factory_helper.Files(dirs[1], 1)
+        fs_manager.observer = inotify.InotifyObserver()
+        fs_manager.observer.handlers.append((sync.path, watch))
+        fs_manager.observer.handle([(0, inotify.IN_Q_OVERFLOW, 0, '')])
+        watch.commit(force=True)
+        sync_file = session.query(SyncFile).filter(
+            SyncFile.rel_path == sync.rel_path(lost)).one()
+        assert sync_file.does_exist and sync_file.file_hash is not None
+    finally:
+        fs_manager.stop()
@@ -4,7 +4,8 @@ import pprint
 pp = pprint.PrettyPrinter(indent=2, depth=6).pprint
 
 from rainmaker.tests import test_helper
-from rainmaker.db.main import init_db, HostFile, SyncFile
+from rainmaker.db.main import init_db, HostFile, SyncFile, Sync, Host, \
+    Resolution, Download
 from rainmaker.db import views
 from rainmaker.sync_manager import resolver
 
@@ -76,6 +77,37 @@ def test_renamed_conflict():
         [resolver.CONFLICT, resolver.MOVED, 1, 1]
     ])
 
+def test_stream_resolutions_saves_chunks():
+    run = Run('complex_sync')
+    run.session.add(Sync(id=1, path='/sync'))
+    run.session.add(Host(id=1, sync_id=1, pubkey='pk'))
+    run.session.commit()
+    results = run.resolve()
+    host = run.session.query(Host).get(1)
+    chunks = list(resolver.stream_resolutions(run.session, host, 3))
+    assert [len(c) for c in chunks] == [3, 3, 2]
+    assert run.session.query(Resolution).count() == len(results)
+    theirs = [r for r in results if r[0] == resolver.THEIRS_CHANGED]
+    assert run.session.query(Download).count() == len(theirs)
+
+def test_get_downloads_plans_in_bulk():
+    run = Run('complex_sync')
+    sync_files, host_files = views.sync_diff(run.session, 1, 1)
+    resolutions = list(resolver.resolve_all(sync_files, host_files))
+    for r in resolutions:
+        r.sync_id, r.host_id = 1, 1
+    queue = resolver.get_downloads(run.session, resolutions)
+    # dirs first, then smallest files
+    assert queue[0] == 'new_dir'
+    assert len(queue) == 4
+    assert run.session.query(Download).count() == 4
+    # existing downloads are updated
+    assert resolver.get_downloads(run.session, resolutions) == queue
+    assert run.session.query(Download).count() == 4
+    dlo = run.session.query(Download).filter(
+        Download.rel_path == 'modified_file').one()
+    assert dlo.needed_parts.complete == True
+
 class Run(object):
     def __init__(self, test_name):
         session = init_db()
@@ -83,21 +115,44 @@ class Run(object):
         self.session = session
 
     def expect(self, expected):
+        results = self.resolve()
+        for result in results:
+            assert result in expected 
+        return results
+
+    def resolve(self):
+        ''' Resolve all differing files, checked against each engine '''
         sync_files, host_files = views.sync_diff(self.session, 1, 1)
         assert len(sync_files) > 0
         assert len(host_files) > 0
         #pp(host_files)
         #pp(sync_files)
         # process all new files
+        results = []
         while len(sync_files) > 0 or len(host_files) > 0:    
             r = resolver.resolve_files(sync_files, host_files)
             #pp(r)
-            result = [r.status, r.state]
-            result.append(r.sync_file.id if r.sync_file else None)
-            result.append(r.host_file.id if r.host_file else None)
-            #pp(expected)
+            result = self.result(r)
             #pp(result)
-            assert result in expected 
+            results.append(result)
+        # single pass engine gives the same results in the same order
+        self.session.rollback()
+        sync_files, host_files = views.sync_diff(self.session, 1, 1)
+        assert [self.result(r) for r in 
+            resolver.resolve_all(sync_files, host_files)] == results
+        # merge join gives the same results in rel_path order
+        self.session.rollback()
+        assert sorted([self.result(r) for r in 
+            resolver.iter_resolutions(self.session, 1, 1, 2)],
+            key=str) == sorted(results, key=str)
+        self.session.rollback()
+        return results
+
+    def result(self, r):
+        result = [r.status, r.state]
+        result.append(r.sync_file.id if r.sync_file else None)
+        result.append(r.host_file.id if r.host_file else None)
+        return result
 
 def myfd(m):
     print("\n\tid : %s \n\tp : %s\n\tsid : %s\n\tfh : %s\n\tnid : %s" % (m.id, m.path, m.sync_path_id, m.fhash, m.next_id))
@@ -1,6 +1,8 @@
-from rainmaker.db.main import init_db, Sync, SyncFile
+from rainmaker.db.main import init_db, Sync, SyncFile, DirDigest, \
+    ScanCheckpoint
+from rainmaker.db import views
 from rainmaker.sync_manager import scan_manager
-from rainmaker.file_system import FsActions
+from rainmaker.file_system import FsActions, HashPool
 from rainmaker.tests import factory_helper
 
 fs = FsActions()
@@ -37,3 +39,147 @@ def test_can_scan_and_discover_files_deleted():
         join(Sync).filter(Sync.id==sync.id, SyncFile.does_exist==True).all()
     assert len(sync_files) == 24
     
+
+def test_can_bulk_scan_in_batches_and_discover_files_deleted():
+    session = init_db()
+    sync = factory_helper.Sync()
+    session.add(sync)
+    session.commit()
+    dirs = factory_helper.Dirs(sync.path, 5)
+    for d in dirs:
+        factory_helper.Files(d, 5)
+    scan_manager.scan_sync_bulk(session, sync, batch_size=7)
+    sync_files = session.query(SyncFile).\
+        join(Sync).filter(Sync.id==sync.id,
+            SyncFile.does_exist==True).all()
+    assert len(sync_files) == 30
+    fs.rmdir(dirs[0])
+    scan_manager.scan_sync_bulk(session, sync, batch_size=7)
+    sync_files = session.query(SyncFile).\
+        join(Sync).filter(Sync.id==sync.id, SyncFile.does_exist==True).all()
+    assert len(sync_files) == 24
+    assert session.expire_on_commit == True
+
+def test_bulk_scan_skips_unchanged_files():
+    session = init_db()
+    sync = factory_helper.Sync()
+    session.add(sync)
+    session.commit()
+    dirs = factory_helper.Dirs(sync.path, 2)
+    for d in dirs:
+        files = factory_helper.Files(d, 3)
+    stats = scan_manager.scan_sync_bulk(session, sync)
+    assert stats.dirs == 2
+    assert stats.stated == 6
+    assert stats.hashed == 6
+    assert stats.skipped == 0
+    fs.append(files[0], 'changed')
+    stats = scan_manager.scan_sync_bulk(session, sync)
+    assert stats.stated == 6
+    assert stats.hashed == 1
+    assert stats.skipped == 5
+
+def test_bulk_scan_can_hash_with_pool():
+    session = init_db()
+    sync = factory_helper.Sync()
+    session.add(sync)
+    session.commit()
+    factory_helper.Files(sync.path, 10)
+    with HashPool(workers=2) as pool:
+        stats = scan_manager.scan_sync_bulk(session, sync, hash_pool=pool)
+    assert stats.hashed == 10
+    sync_files = session.query(SyncFile).filter(SyncFile.sync_id==sync.id).all()
+    assert len(sync_files) == 10
+    for sf in sync_files:
+        assert sf.file_hash is not None
+        assert sf.stime >= sf.stime_start
+
+def test_changed_scan_only_lists_changed_dirs():
+    session = init_db()
+    sync = factory_helper.Sync()
+    session.add(sync)
+    session.commit()
+    dirs = factory_helper.Dirs(sync.path, 2)
+    nested = factory_helper.Dirs(dirs[1], 1)
+    factory_helper.Files(nested, 2)
+    for d in dirs:
+        files = factory_helper.Files(d, 3)
+    scan_manager.scan_sync_bulk(session, sync)
+    # nothing changed while stopped, files are stat'd but not opened
+    stats = scan_manager.scan_sync_changed(session, sync)
+    assert stats.dirs_unchanged == 4
+    assert stats.dirs == 0
+    assert stats.stated == 8
+    assert stats.skipped == 8
+    assert stats.hashed == 0
+    # written in place, the directory stat does not change
+    edited = files[1]
+    sync_file = session.query(SyncFile).filter(
+        SyncFile.rel_path == sync.rel_path(edited)).one()
+    old_hash = sync_file.file_hash
+    with open(edited, 'r+') as f:
+        f.write('edited in place')
+    stats = scan_manager.scan_sync_changed(session, sync)
+    assert stats.dirs == 0
+    assert stats.hashed == 1
+    session.refresh(sync_file)
+    assert sync_file.file_hash != old_hash
+    # add to one dir, remove from another
+    added = factory_helper.Files(dirs[0], 1)
+    fs.rm(files[0])
+    fs.rmdir(nested)
+    stats = scan_manager.scan_sync_changed(session, sync)
+    assert stats.dirs == 2
+    assert stats.dirs_unchanged == 1
+    assert stats.hashed == 1
+    def _exists(path):
+        return session.query(SyncFile).filter(SyncFile.sync_id == sync.id,
+            SyncFile.rel_path == sync.rel_path(path)).one().does_exist
+    assert _exists(added)
+    assert not _exists(files[0])
+    assert not _exists(nested)
+    assert session.query(SyncFile).filter(SyncFile.sync_id == sync.id,
+        SyncFile.does_exist == True).count() == 2 + 3 + 1 + 2
+    stats = scan_manager.scan_sync_changed(session, sync)
+    assert stats.dirs == 0
+    assert stats.dirs_unchanged == 3
+
+def test_unlisted_dirs_get_no_checkpoint():
+    session = init_db()
+    sync = factory_helper.Sync()
+    session.add(sync)
+    session.commit()
+    dirs = factory_helper.Dirs(sync.path, 2)
+    list_dir = scan_manager._list_dir
+    def _denied(path):
+        if path == dirs[0]:
+            raise PermissionError('denied: %s' % path)
+        return list_dir(path)
+    scan_manager._list_dir = _denied
+    try:
+        scan_manager.scan_sync_bulk(session, sync)
+    finally:
+        scan_manager._list_dir = list_dir
+    paths = set(cp.path for cp in session.query(ScanCheckpoint))
+    assert paths == set(['', sync.rel_path(dirs[1])])
+
+def test_files_deleted_while_stopped_are_journaled():
+    session = init_db()
+    sync = factory_helper.Sync()
+    session.add(sync)
+    session.commit()
+    files = factory_helper.Files(factory_helper.Dirs(sync.path, 1), 3)
+    scan_manager.scan_sync_bulk(session, sync)
+    seq = views.sync_last_seq(session, sync.id)
+    digests = views.get_dir_digests(session, sync.id, [''])[''].digest
+    fs.rm(files[0])
+    scan_manager.scan_sync_bulk(session, sync)
+    changes, _ = views.sync_changes(session, sync.id, seq)
+    assert [f.rel_path for f in changes] == [sync.rel_path(files[0])]
+    assert changes[0].does_exist == False and changes[0].version == 1
+    assert views.get_dir_digests(session, sync.id, [''])[''].digest != \
+        digests
+    incremental = [(d.path, d.digest) for d in session.query(DirDigest)]
+    views.rebuild_dir_digests(session, sync.id)
+    assert sorted(incremental) == sorted((d.path, d.digest) 
+        for d in session.query(DirDigest))
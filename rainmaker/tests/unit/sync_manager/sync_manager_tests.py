@@ -0,0 +1,108 @@
+import os
+from time import sleep
+
+from rainmaker.db.main import init_db, SyncFile
+from rainmaker.sync_manager import fs_manager, sync_manager, actions
+from rainmaker.tests import factory_helper, test_helper
+
+class App(object):
+    device_name = 'test'
+
+class ToxManager(object):
+    ''' stands in for the tox bots '''
+    def __init__(self, spm):
+        self.started = False
+
+    def start(self, start_primary=False):
+        self.started = True
+
+    def stop(self):
+        self.started = False
+
+def test_start_scans_the_sync():
+    # the startup scan runs in a thread, in memory dbs are per thread
+    test_helper.clean_temp_dir()
+    app = App()
+    app.db = init_db(os.path.join(test_helper.user_dir, 'start.db'))
+    sync = factory_helper.Sync()
+    app.db.add(sync)
+    app.db.commit()
+    files = factory_helper.Files(sync.path, 3)
+    fs_manager.init()
+    tox_manager = sync_manager.ToxManager
+    sync_manager.ToxManager = ToxManager
+    try:
+        spm = sync_manager.SyncManager(app).add_sync(sync)
+        spm.start()
+        spm.verify_thread.join(10)
+        assert spm.tox_manager.started
+        rel_paths = set(sf.rel_path for sf in app.db.query(SyncFile).filter(
+            SyncFile.sync_id == sync.id, SyncFile.file_hash != None))
+        assert rel_paths == set(sync.rel_path(f) for f in files)
+        assert app.db.query(SyncFile).count() == 3
+        # the watcher writes from its worker, stop writes what is left
+        added = factory_helper.Files(sync.path, 1)
+        for x in range(50):
+            if spm.fs_manager.watcher.stats()['events_per_sec'] > 0:
+                break
+            sleep(0.05)
+        spm.stop()
+        assert not spm.tox_manager.started
+        app.db.expire_all()
+        sync_file = app.db.query(SyncFile).filter(
+            SyncFile.rel_path == sync.rel_path(added)).one()
+        assert sync_file.file_hash is not None
+    finally:
+        sync_manager.ToxManager = tox_manager
+        fs_manager.stop()
+
+def test_new_hosts_are_reconciled_first():
+    test_helper.clean_temp_dir()
+    app = App()
+    app.db = init_db(os.path.join(test_helper.user_dir, 'hosts.db'))
+    sync = factory_helper.Sync()
+    host = factory_helper.Host(sync, 1)
+    app.db.add(sync)
+    app.db.commit()
+    called = []
+    catch_up, sync_with_host = actions.catch_up_with_host, \
+        actions.sync_with_host
+    actions.catch_up_with_host = lambda db, h, send: called.append('catch_up')
+    actions.sync_with_host = lambda db, h, send: called.append('journal')
+    tox_manager = sync_manager.ToxManager
+    sync_manager.ToxManager = ToxManager
+    try:
+        manager = sync_manager.SyncManager(app)
+        manager.sync_with_host(host, None)
+        host.last_seq = 5
+        app.db.commit()
+        manager.sync_with_host(host, None)
+    finally:
+        actions.catch_up_with_host = catch_up
+        actions.sync_with_host = sync_with_host
+        sync_manager.ToxManager = tox_manager
+    assert called == ['catch_up', 'journal']
+
+def test_verify_adds_lazy_watches():
+    test_helper.clean_temp_dir()
+    app = App()
+    app.db = init_db(os.path.join(test_helper.user_dir, 'lazy.db'))
+    sync = factory_helper.Sync()
+    app.db.add(sync)
+    app.db.commit()
+    dirs = factory_helper.Dirs(sync.path, 2)
+    factory_helper.Dirs(dirs[0], 2)
+    fs_manager.init(backend='inotify')
+    tox_manager = sync_manager.ToxManager
+    sync_manager.ToxManager = ToxManager
+    try:
+        spm = sync_manager.SyncManager(app).add_sync(sync)
+        spm.fs_manager.start()
+        assert fs_manager.observer.stats()['watches'] == 1
+        spm.verify()
+        spm.verify_thread.join(10)
+        assert fs_manager.observer.stats()['watches'] == 5
+        spm.stop()
+    finally:
+        sync_manager.ToxManager = tox_manager
+        fs_manager.stop()
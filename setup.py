@@ -11,6 +11,8 @@ config = {
     'author_email': 'My email.',
     'version': '0.3',
     'install_requires': ['nose', 'twisted', 'watchdog', 'PyTox'],
+    # xxh128 chunk hashes, syncs stay on md5 without it
+    'extras_require': {'xxhash': ['xxhash>=2.0']},
     'packages': ['rainmaker'],
     'scripts': [],
     'name': 'rainmaker'